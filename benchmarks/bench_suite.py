@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: bench_suite.py
+文件作者: gaosiyan
+创建时间: 20260116
+功能说明: 基准测试套件, 在 corpus.py 生成的语料上测试格式化流程各环节的耗时, 结果保存为 JSON 便于前后对比
+
+测试项:
+    utils.format/raw                           逐篇格式化未格式化的文档 (会回写)
+    utils.format/formatted                     逐篇格式化已格式化的文档 (日常增量运行的情况)
+    utils.format/parallel                      execute_in_parallel 并行格式化未格式化的文档
+    RstDocParser.get_image_file_paths/cold     清空解析缓存后逐篇提取图片路径
+    RstDocParser.get_image_file_paths/warm     命中解析缓存
+    rename_files_by_sha1/cold                  无哈希清单, 计算全部图片哈希并重命名
+    rename_files_by_sha1/manifest              哈希清单全部命中
+    RstDocBatchProcessor.format                批处理流水线
+    sphinx_format/cold                         删除编译产出和缓存后全量运行
+    sphinx_format/incremental                  没有任何变化时再次运行
+    sphinx_format/one-doc                      修改一篇文档后再次运行
+每项运行 --repeat 次, 每次运行前恢复语料 (恢复时间不计入), 记录每次耗时, 最好值和中位数.
+
+用法:
+    python benchmarks/bench_suite.py --docs 2000 --images 300 --repeat 3
+    python benchmarks/bench_suite.py --only sphinx_format --jobs auto
+    python benchmarks/bench_suite.py --only rename --compare benchmarks/results/20260116-120000-e57a9b4.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import statistics
+import subprocess
+from typing import Callable, Dict, List
+from sphinx.util.docutils import docutils_namespace
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "source"))
+
+import rst_doc_parser  # noqa: E402
+from utils import format, rename_files_by_sha1, execute_in_parallel  # noqa: E402
+from file_hash_manifest import FileHashManifest  # noqa: E402
+from rst_doc_parser import RstDocParser  # noqa: E402
+from rst_doc_batch_processor import RstDocBatchProcessor  # noqa: E402
+from sphinx_format import sphinx_format  # noqa: E402
+from parallel_build import jobs_argument  # noqa: E402
+from corpus import generate_corpus  # noqa: E402
+
+
+class Corpus:
+    """原始语料和工作副本, 每次运行前从原始语料恢复工作副本"""
+
+    def __init__(self, work_dir: str, docs: int, images: int, seed: int) -> None:
+        self.pristine_dir = os.path.join(work_dir, "pristine")
+        self.root_dir = os.path.join(work_dir, "tree")
+        self.stats = generate_corpus(self.pristine_dir, docs, images, seed)
+        self.source_dir = os.path.join(self.root_dir, "source")
+        self.image_dir = os.path.join(self.source_dir, "_static", "images")
+        self.restore()
+
+    def restore(self) -> None:
+        """恢复 source 目录, 删除编译产出和缓存"""
+        if os.path.isdir(self.root_dir):
+            shutil.rmtree(self.root_dir)
+        shutil.copytree(self.pristine_dir, self.root_dir)
+
+    def rst_file_paths(self) -> List[str]:
+        result = []
+        for root, _, files in os.walk(self.source_dir):
+            result.extend(os.path.join(root, file) for file in files if file.endswith(".rst"))
+        return sorted(result)
+
+
+def run_case(func: Callable[[], None], setup: Callable[[], None] | None, repeat: int) -> dict:
+    """运行 repeat 次, 每次运行前执行 setup (不计时)"""
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            try:
+                func()
+            except SystemExit:
+                # sphinx_format 编译失败时调用 sys.exit(0), 不能当作正常完成计时
+                raise RuntimeError("运行失败, 请检查告警输出") from None
+            runs.append(time.perf_counter() - start)
+    return {"best": min(runs), "median": statistics.median(runs), "runs": runs}
+
+
+def build_cases(corpus: Corpus, skip_sphinx: bool, jobs: int | str = 1) -> Dict[str, tuple]:
+    """测试项 {名称: (函数, 准备函数)}"""
+    rst_file_paths = corpus.rst_file_paths()
+
+    def format_all() -> None:
+        for rst_file_path in rst_file_paths:
+            format(rst_file_path)
+
+    def extract_images() -> None:
+        for rst_file_path in rst_file_paths:
+            RstDocParser(rst_file_path, corpus.source_dir).get_image_file_paths()
+
+    def clear_parser_cache() -> None:
+        rst_doc_parser._DOCTREE_CACHE.clear()
+        rst_doc_parser._METADATA_CACHE.clear()
+
+    def restore_and_clear() -> None:
+        corpus.restore()
+        clear_parser_cache()
+
+    manifest = FileHashManifest()
+
+    def fill_manifest() -> None:
+        corpus.restore()
+        rename_files_by_sha1(corpus.image_dir, manifest)
+
+    def modify_one_doc() -> None:
+        with open(rst_file_paths[len(rst_file_paths) // 2], "a", encoding="utf-8") as file:
+            file.write("\n新增的段落 abc.\n")
+
+    cases = {
+        "utils.format/raw": (format_all, corpus.restore),
+        "utils.format/formatted": (format_all, None),
+        "utils.format/parallel": (lambda: execute_in_parallel(format, rst_file_paths), corpus.restore),
+        "RstDocParser.get_image_file_paths/cold": (extract_images, restore_and_clear),
+        "RstDocParser.get_image_file_paths/warm": (extract_images, None),
+        "rename_files_by_sha1/cold": (lambda: rename_files_by_sha1(corpus.image_dir), corpus.restore),
+        "rename_files_by_sha1/manifest": (lambda: rename_files_by_sha1(corpus.image_dir, manifest), fill_manifest),
+        "RstDocBatchProcessor.format": (
+            lambda: RstDocBatchProcessor(corpus.source_dir, corpus.image_dir).format(),
+            restore_and_clear,
+        ),
+    }
+    if skip_sphinx is False:
+
+        def run_sphinx_format() -> None:
+            # 同一进程中多次创建 Sphinx 应用, 需要与 sphinx-build 一样隔离 docutils 的全局注册,
+            # 否则重复注册节点的告警在严格模式下导致编译失败
+            with docutils_namespace():
+                sphinx_format(root_dir=corpus.root_dir, quiet=True, jobs=jobs)
+
+        cases["sphinx_format/cold"] = (run_sphinx_format, corpus.restore)
+        cases["sphinx_format/incremental"] = (run_sphinx_format, None)
+        cases["sphinx_format/one-doc"] = (run_sphinx_format, modify_one_doc)
+    return cases
+
+
+def git_commit() -> str:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True
+        )
+        return output.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, previous_path: str) -> None:
+    """与之前的结果对比, 比值小于 1 表示变快"""
+    with open(previous_path, "r", encoding="utf-8") as file:
+        previous = json.load(file)
+
+    print(f"对比 {previous_path} ({previous['meta']['commit']})")
+    for name, result in results["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        print(f"    {name:<42} {before['best']:8.3f} 秒 -> {result['best']:8.3f} 秒  {result['best'] / before['best']:.2f}x")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="格式化流程基准测试")
+    arg_parser.add_argument("--docs", type=int, default=2000, help="笔记数")
+    arg_parser.add_argument("--images", type=int, default=300, help="图片数")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="每项重复次数")
+    arg_parser.add_argument("--seed", type=int, default=20260116, help="随机种子")
+    arg_parser.add_argument("--only", default="", help="只运行名称中包含该字符串的测试项")
+    arg_parser.add_argument("--skip-sphinx", action="store_true", help="跳过 sphinx_format 测试项")
+    arg_parser.add_argument(
+        "-j", "--jobs", type=jobs_argument, default=1, help="sphinx_format 的进程数, 默认 1, 与之前的结果可比"
+    )
+    arg_parser.add_argument("--work-dir", help="语料目录, 默认使用临时目录, 结束后删除")
+    arg_parser.add_argument("--output", help="结果文件, 默认 benchmarks/results/<时间>-<提交>.json")
+    arg_parser.add_argument("--compare", help="与之前的结果文件对比")
+    args = arg_parser.parse_args()
+
+    commit = git_commit()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="diary-bench-")
+    try:
+        corpus = Corpus(work_dir, args.docs, args.images, args.seed)
+        print(f"语料: {args.docs} 篇笔记, {args.images} 张图片, {corpus.stats['bytes'] / 1024 / 1024:.1f} MB")
+
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "commit": commit,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "docs": args.docs,
+                "images": args.images,
+                "seed": args.seed,
+                "corpus_bytes": corpus.stats["bytes"],
+                "repeat": args.repeat,
+                "jobs": args.jobs,
+            },
+            "results": {},
+        }
+        for name, (func, setup) in build_cases(corpus, args.skip_sphinx, args.jobs).items():
+            if args.only not in name:
+                continue
+            result = run_case(func, setup, args.repeat)
+            results["results"][name] = result
+            print(f"    {name:<42} 最好 {result['best']:8.3f} 秒, 中位数 {result['median']:8.3f} 秒")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=1)
+    print(f"结果保存在 {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: corpus.py
+文件作者: gaosiyan
+创建时间: 20260116
+功能说明: 基准测试语料生成, 生成与 source/ 结构相同的大规模文档树
+
+生成的目录结构:
+    <root>/source/*.py, extensions/         从项目复制, 使用与项目相同的配置和扩展
+    <root>/source/index.rst                 根目录, toctree 包含所有分类
+    <root>/source/分类N/index.rst           分类目录
+    <root>/source/分类N/笔记M.rst           中英文混排笔记, 包含公式, 代码块和图片引用
+    <root>/source/_static/images/           图片池, 部分以哈希命名, 部分是截图工具的默认命名, 部分没有被引用
+
+同一个随机种子生成的语料完全相同.
+
+用法:
+    python benchmarks/corpus.py /tmp/corpus --docs 2000 --images 300
+"""
+
+import os
+import sys
+import zlib
+import shutil
+import struct
+import random
+import hashlib
+import argparse
+from typing import List
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+
+CHINESE_WORDS = ["微积分", "函数", "极限", "导数", "积分", "连续", "数列", "收敛", "定理", "证明", "文档", "编译"]
+ENGLISH_WORDS = ["Sphinx", "limit", "function", "x", "y", "derivative", "build", "html", "rst", "a", "b"]
+PUNCTUATION = ["，", "。", "、", "：", "；", "！", "？", "（", "）", "“", "”", ",", ".", " "]
+
+# 每个分类目录中的笔记数
+DOCS_PER_CATEGORY = 50
+
+
+def generate_document(
+    rng: random.Random, paragraphs: int = 40, label_prefix: str = "", code_language: str = "python"
+) -> str:
+    """
+    生成一篇中英文混排的文档
+
+    Args:
+        rng: 随机数生成器
+        paragraphs: 段落数
+        label_prefix: 公式标签前缀, 同一个项目中公式标签不能重复
+        code_language: 代码块语言, 代码中有中文标点, 严格模式编译时需要使用 text, 避免 Pygments 词法分析告警
+    """
+    lines = []
+    for index in range(paragraphs):
+        lines.append(f"第{index}节 标题")
+        lines.append("-" * 12)
+        lines.append("")
+        words = []
+        for _ in range(rng.randint(30, 80)):
+            pool = CHINESE_WORDS if rng.random() < 0.6 else ENGLISH_WORDS
+            words.append(rng.choice(pool) + " " * rng.randint(0, 2) + rng.choice(PUNCTUATION))
+            if rng.random() < 0.1:
+                words.append(str(rng.randint(1, 2000)))
+        lines.append("".join(words))
+        lines.append("\n" * rng.randint(1, 3))
+        if index % 5 == 0:
+            lines.append(f".. code-block:: {code_language}\n\n    print（\"中文，abc\"）\n    x  =  1\n")
+        if index % 7 == 0:
+            lines.append(f".. math::\n    :label: {label_prefix}公式{index}\n\n    f(x)  =  x^2\n")
+    return "\n".join(lines)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def generate_png(rng: random.Random, width: int, height: int) -> bytes:
+    """
+    生成一张 RGB PNG, 内容是渐变色块加少量噪点, 与截图的压缩率接近, 不依赖 Pillow
+    """
+    base = [rng.randint(0, 255) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        row = bytearray([0])  # 每行的过滤类型
+        for x in range(width):
+            if rng.random() < 0.02:
+                row += bytes(rng.randint(0, 255) for _ in range(3))
+            else:
+                row += bytes(((base[0] + x) % 256, (base[1] + y) % 256, base[2]))
+        rows.append(bytes(row))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(b"".join(rows), 6))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def _title(text: str, mark: str) -> str:
+    """
+    生成标题, 中文字符按 2 列计算下划线长度
+
+    格式化会在中文和数字之间插入空格, 标题变长, 下划线多留 4 列, 下划线比标题长是合法的
+    """
+    width = sum(2 if ord(char) > 0x2E80 else 1 for char in text) + 4
+    return f"{text}\n{mark * width}\n"
+
+
+def generate_images(image_dir: str, rng: random.Random, count: int) -> List[str]:
+    """
+    生成图片池, 1/3 以 SHA1 命名, 其余使用截图工具的默认命名, 需要重命名
+
+    Returns:
+        图片文件名列表
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    names = []
+    for index in range(count):
+        content = generate_png(rng, rng.randint(32, 160), rng.randint(24, 120))
+        if index % 3 == 0:
+            name = hashlib.sha1(content).hexdigest() + ".png"
+        else:
+            name = f"截图_{index:05d}.png"
+        with open(os.path.join(image_dir, name), "wb") as file:
+            file.write(content)
+        names.append(name)
+    return names
+
+
+def generate_corpus(root_dir: str, docs: int = 2000, images: int = 300, seed: int = 20260116) -> dict:
+    """
+    生成语料
+
+    Args:
+        root_dir: 输出目录, 已存在时先删除
+        docs: 笔记数
+        images: 图片数, 其中约 1/10 不被任何笔记引用
+        seed: 随机种子
+
+    Returns:
+        语料统计 {"docs": ..., "images": ..., "bytes": ...}
+    """
+    rng = random.Random(seed)
+    if os.path.isdir(root_dir):
+        shutil.rmtree(root_dir)
+
+    source_dir = os.path.join(root_dir, "source")
+    os.makedirs(source_dir)
+    # conf.py, 扩展和扩展依赖的模块
+    for name in os.listdir(SOURCE_DIR):
+        if name.endswith(".py"):
+            shutil.copyfile(os.path.join(SOURCE_DIR, name), os.path.join(source_dir, name))
+    shutil.copytree(
+        os.path.join(SOURCE_DIR, "extensions"),
+        os.path.join(source_dir, "extensions"),
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+
+    image_names = generate_images(os.path.join(source_dir, "_static", "images"), rng, images)
+    used_images = image_names[: max(1, len(image_names) * 9 // 10)]
+
+    total_bytes = 0
+    categories = []
+    for doc_index in range(docs):
+        category = f"分类{doc_index // DOCS_PER_CATEGORY:03d}"
+        if not categories or categories[-1][0] != category:
+            categories.append((category, []))
+        note = f"笔记{doc_index:05d}"
+        categories[-1][1].append(note)
+
+        parts = [_title(f"{note} 学习笔记", "="), generate_document(rng, rng.randint(5, 30), f"{note}-", "text")]
+        for image_name in rng.sample(used_images, min(len(used_images), rng.randint(0, 4))):
+            parts.append(f"\n.. figure:: /_static/images/{image_name}\n\n   截图 {image_name}\n")
+        content = "\n".join(parts)
+
+        os.makedirs(os.path.join(source_dir, category), exist_ok=True)
+        with open(os.path.join(source_dir, category, note + ".rst"), "w", encoding="utf-8") as file:
+            file.write(content)
+        total_bytes += len(content.encode("utf-8"))
+
+    for category, notes in categories:
+        toctree = "\n".join(f"   {note}" for note in notes)
+        with open(os.path.join(source_dir, category, "index.rst"), "w", encoding="utf-8") as file:
+            file.write(_title(category, "=") + f"\n.. toctree::\n   :maxdepth: 1\n\n{toctree}\n")
+
+    toctree = "\n".join(f"   {category}/index" for category, _ in categories)
+    with open(os.path.join(source_dir, "index.rst"), "w", encoding="utf-8") as file:
+        file.write(_title("基准测试语料", "=") + f"\n.. toctree::\n   :maxdepth: 1\n\n{toctree}\n")
+
+    return {"docs": docs, "images": images, "bytes": total_bytes}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="生成基准测试语料")
+    arg_parser.add_argument("root_dir", help="输出目录, 已存在时先删除")
+    arg_parser.add_argument("--docs", type=int, default=2000, help="笔记数")
+    arg_parser.add_argument("--images", type=int, default=300, help="图片数")
+    arg_parser.add_argument("--seed", type=int, default=20260116, help="随机种子")
+    args = arg_parser.parse_args()
+
+    stats = generate_corpus(args.root_dir, args.docs, args.images, args.seed)
+    print(f"生成 {stats['docs']} 篇笔记, {stats['images']} 张图片, {stats['bytes'] / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: build_manifest.py
+文件作者: gaosiyan
+创建时间: 20260123
+功能说明: 编译输出清单, 为静态资源加内容哈希, 记录输出文件的哈希并与上次的清单比较, 只发布有变化的文件
+
+资源指纹:
+    _static 和 _images 下的 CSS, JS, 图片和字体复制一份 "名称.<哈希前 10 位>.扩展名", HTML 和 CSS 中的引用
+    改为带哈希的文件名 (去掉 Sphinx 的 ?v= 参数). 内容变化后文件名随之变化, 这些文件可以按 immutable 长期缓存.
+    原文件保留, 由脚本动态加载的资源 (例如搜索分片) 不受影响. 文件名本身就是内容哈希的图片
+    (sphinx_format 按哈希重命名的图片) 不再复制. 增量编译中没有重写的页面仍引用上次的指纹文件名,
+    每次都按原文件名重新映射, 上次的指纹文件在不再需要时删除.
+
+输出清单:
+    {"version": ..., "algorithm": ..., "files": {相对路径: {"digest": ..., "size": ...}}, "immutable": [相对路径]}
+    与上次的清单比较得到 {"added": [...], "changed": [...], "removed": [...]}, 部署时只需上传 added 和 changed,
+    删除 removed.
+
+用法:
+    python source/build_manifest.py                 # 处理 build/html, 清单保存在 .cache/build_manifest.json
+    python source/build_manifest.py build/html --no-fingerprint
+    make manifest                                   # make html 后执行
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from utils import calculate_files_hash_code_parallel, execute_in_parallel, io_bound, write_file_atomic
+from utils import read_hash_algorithm, DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS, TaskError
+
+_MANIFEST_VERSION = 1
+
+# 加指纹的资源目录和扩展名
+ASSET_DIRS = ("_static", "_images")
+ASSET_EXTENSIONS = {
+    ".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".avif", ".ico", ".woff", ".woff2", ".ttf",
+}  # fmt: skip
+
+# 指纹长度 (十六进制位数)
+FINGERPRINT_LENGTH = 10
+
+# 文件名 "名称.<指纹>.扩展名"
+_FINGERPRINTED_RE = re.compile(r"^(?P<stem>.+)\.[0-9a-f]{%d}(?P<ext>\.[^.]+)$" % FINGERPRINT_LENGTH)
+
+# 文件名本身就是内容哈希 (sha1/blake2b 为 40 位)
+_HASH_NAME_RE = re.compile(r"^[0-9a-f]{40,}(?:[-_.][^.]*)?\.[^.]+$")
+
+# HTML 中对资源的相对引用, 例如 "../_static/styles/furo.css?v=354aac6f", srcset 中以逗号或空格分隔
+_HTML_ASSET_RE = re.compile(
+    r"(?<=[\"'(\s,=])(?P<path>(?:\.\./)*(?:%s)/[^\"'\s?#,()<>]+)(?P<query>\?v=[0-9a-zA-Z]+)?" % "|".join(ASSET_DIRS)
+)
+
+# CSS 中的 url(...)
+_CSS_URL_RE = re.compile(r"url\(\s*(?P<quote>[\"']?)(?P<path>[^\"')]+)(?P=quote)\s*\)")
+
+
+class ManifestError(Exception):
+    """输出目录或清单读写失败"""
+
+    pass
+
+
+def _relative_path(path: str, root: str) -> str:
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def _list_files(html_dir: str) -> List[str]:
+    """输出目录中的所有文件, 相对路径, 按路径排序"""
+    files = []
+    for dir_path, dir_names, file_names in os.walk(html_dir):
+        dir_names[:] = [name for name in dir_names if name not in (".doctrees", "__pycache__")]
+        for file_name in file_names:
+            if not file_name.endswith(".tmp"):
+                files.append(_relative_path(os.path.join(dir_path, file_name), html_dir))
+    files.sort()
+    return files
+
+
+def _is_asset(relative_path: str) -> bool:
+    if relative_path.split("/", 1)[0] not in ASSET_DIRS:
+        return False
+    return os.path.splitext(relative_path)[1].lower() in ASSET_EXTENSIONS
+
+
+def _fingerprinted_name(relative_path: str, digest: str) -> str:
+    stem, ext = os.path.splitext(relative_path)
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+
+def _original_path(relative_path: str, files: set) -> str | None:
+    """上次生成的指纹文件对应的原文件, 不是指纹文件时返回 None"""
+    directory, file_name = os.path.split(relative_path)
+    match = _FINGERPRINTED_RE.match(file_name)
+    if match is None:
+        return None
+    original = "/".join(part for part in (directory, match.group("stem") + match.group("ext")) if part)
+    return original if original in files else None
+
+
+def _resolve(reference: str, base_dir: str) -> str:
+    """相对引用转换为输出目录中的相对路径, base_dir 是引用所在文件的目录 (相对路径)"""
+    return os.path.normpath(os.path.join(base_dir, reference)).replace(os.sep, "/")
+
+
+def _target(reference: str, base_dir: str, files: set) -> str:
+    """引用的文件, 引用上次的指纹文件名时为原文件"""
+    target = _resolve(reference, base_dir)
+    return _original_path(target, files) or target
+
+
+def _css_references(content: str) -> List[str]:
+    """CSS 中 url(...) 的相对引用, 不含 data:, http:, 绝对路径和锚点"""
+    references = []
+    for match in _CSS_URL_RE.finditer(content):
+        reference = match.group("path").strip()
+        if not re.match(r"^(?:[a-z][a-z0-9+.-]*:|//|#|/)", reference, re.IGNORECASE):
+            references.append(re.split(r"[?#]", reference, maxsplit=1)[0])
+    return references
+
+
+@io_bound
+def _scan_html(argument: Tuple[str, str, set]) -> set:
+    """HTML 文件引用的资源"""
+    html_dir, relative_path, files = argument
+    base_dir = os.path.dirname(relative_path)
+    with open(os.path.join(html_dir, relative_path), "r", encoding="utf-8") as file:
+        content = file.read()
+    return {_target(match.group("path"), base_dir, files) for match in _HTML_ASSET_RE.finditer(content)}
+
+
+def _rewrite_reference(reference: str, base_dir: str, fingerprints: Dict[str, str], files: set) -> str | None:
+    """引用改为指纹文件名, 不是资源时返回 None"""
+    target = _target(reference, base_dir, files)
+    fingerprinted = fingerprints.get(target)
+    if fingerprinted is None:
+        return None
+    return os.path.relpath(fingerprinted, base_dir or ".").replace(os.sep, "/")
+
+
+@io_bound
+def _rewrite_html(argument: Tuple[str, str, Dict[str, str], set]) -> bool:
+    """改写一个 HTML 文件中的资源引用, 返回文件是否有变化"""
+    html_dir, relative_path, fingerprints, files = argument
+    file_path = os.path.join(html_dir, relative_path)
+    base_dir = os.path.dirname(relative_path)
+    with open(file_path, "r", encoding="utf-8") as file:
+        content = file.read()
+
+    def replace(match: re.Match) -> str:
+        rewritten = _rewrite_reference(match.group("path"), base_dir, fingerprints, files)
+        return match.group(0) if rewritten is None else rewritten
+
+    new_content = _HTML_ASSET_RE.sub(replace, content)
+    if new_content == content:
+        return False
+    write_file_atomic(file_path, new_content)
+    return True
+
+
+def _rewrite_css(html_dir: str, relative_path: str, fingerprints: Dict[str, str], files: set) -> bool:
+    """改写 CSS 中 url(...) 引用的资源, 返回文件是否有变化"""
+    file_path = os.path.join(html_dir, relative_path)
+    base_dir = os.path.dirname(relative_path)
+    with open(file_path, "r", encoding="utf-8") as file:
+        content = file.read()
+
+    def replace(match: re.Match) -> str:
+        references = _css_references(match.group(0))
+        rewritten = _rewrite_reference(references[0], base_dir, fingerprints, files) if references else None
+        if rewritten is None:
+            return match.group(0)
+        quote = match.group("quote")
+        return f"url({quote}{rewritten}{quote})"
+
+    new_content = _CSS_URL_RE.sub(replace, content)
+    if new_content == content:
+        return False
+    write_file_atomic(file_path, new_content)
+    return True
+
+
+def _hash_files(html_dir: str, relative_paths: List[str], algorithm: str) -> Dict[str, str]:
+    digests = calculate_files_hash_code_parallel([os.path.join(html_dir, path) for path in relative_paths], algorithm)
+    result = {}
+    for path, digest in zip(relative_paths, digests):
+        if digest is None:
+            raise ManifestError(f"文件 {path} 读取失败")
+        result[path] = digest
+    return result
+
+
+def fingerprint_assets(html_dir: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> Tuple[Dict[str, str], int]:
+    """
+    为资源生成指纹文件, 改写 HTML 和 CSS 中的引用
+
+    只处理 HTML 和其中的 CSS 引用到的资源, 由脚本加载的文件 (例如搜索分片) 不复制.
+    先处理 CSS 以外的资源, 再改写 CSS 中的引用并计算 CSS 的指纹, 最后改写 HTML.
+
+    Args:
+        html_dir: HTML 输出目录
+        algorithm: 哈希算法
+
+    Returns:
+        ({原文件相对路径: 指纹文件相对路径}, 改写的 HTML 文件数)
+    """
+    files = set(_list_files(html_dir))
+    previous = {path for path in files if _is_asset(path) and _original_path(path, files) is not None}
+    html_files = sorted(path for path in files if path.endswith(".html"))
+
+    referenced = set()
+    results = execute_in_parallel(_scan_html, [(html_dir, path, files) for path in html_files])
+    for path, result in zip(html_files, results):
+        if isinstance(result, TaskError):
+            raise ManifestError(f"{path} 读取失败: {result.error}")
+        referenced |= result
+    for path in [path for path in referenced if path.endswith(".css") and path in files]:
+        with open(os.path.join(html_dir, path), "r", encoding="utf-8") as file:
+            base_dir = os.path.dirname(path)
+            referenced.update(_target(reference, base_dir, files) for reference in _css_references(file.read()))
+    assets = sorted(path for path in referenced if path in files and _is_asset(path) and path not in previous)
+
+    fingerprints: Dict[str, str] = {}
+
+    def add_fingerprints(paths: List[str]) -> None:
+        for path in paths:
+            if _HASH_NAME_RE.match(os.path.basename(path)):
+                fingerprints[path] = path  # 文件名已经是内容哈希, 不用复制
+        paths = [path for path in paths if path not in fingerprints]
+        for path, digest in _hash_files(html_dir, paths, algorithm).items():
+            fingerprinted = _fingerprinted_name(path, digest)
+            target = os.path.join(html_dir, fingerprinted)
+            if os.path.isfile(target) is False:
+                shutil.copy2(os.path.join(html_dir, path), target)
+            fingerprints[path] = fingerprinted
+
+    # CSS 中引用的图片和字体先加指纹, CSS 改写后再计算自己的指纹
+    stylesheets = [path for path in assets if path.endswith(".css")]
+    add_fingerprints([path for path in assets if not path.endswith(".css")])
+    for path in stylesheets:
+        _rewrite_css(html_dir, path, fingerprints, files)
+    add_fingerprints(stylesheets)
+
+    # 删除不再使用的指纹文件
+    current = set(fingerprints.values())
+    for path in previous - current:
+        os.remove(os.path.join(html_dir, path))
+    files = (files - previous) | current
+
+    results = execute_in_parallel(_rewrite_html, [(html_dir, path, fingerprints, files) for path in html_files])
+    rewritten = 0
+    for path, result in zip(html_files, results):
+        if isinstance(result, TaskError):
+            raise ManifestError(f"{path} 改写失败: {result.error}")
+        rewritten += bool(result)
+    return fingerprints, rewritten
+
+
+def load_manifest(manifest_path: str) -> dict | None:
+    """读取上次的清单, 不存在或格式不对时返回 None"""
+    if os.path.isfile(manifest_path) is False:
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != _MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def diff_manifests(previous: dict | None, current: dict) -> Dict[str, List[str]]:
+    """两次清单的差异, previous 为 None 时全部文件都是新增"""
+    old_files = previous["files"] if previous is not None and previous.get("algorithm") == current["algorithm"] else {}
+    new_files = current["files"]
+    return {
+        "added": sorted(path for path in new_files if path not in old_files),
+        "changed": sorted(
+            path for path in new_files if path in old_files and old_files[path]["digest"] != new_files[path]["digest"]
+        ),
+        "removed": sorted(path for path in old_files if path not in new_files),
+    }
+
+
+def build_manifest(
+    html_dir: str,
+    manifest_path: str,
+    diff_path: str | None = None,
+    fingerprint: bool = True,
+    algorithm: str = DEFAULT_HASH_ALGORITHM,
+) -> Dict[str, List[str]]:
+    """
+    生成输出清单, 保存到 manifest_path, 与上次的清单比较
+
+    Args:
+        html_dir: HTML 输出目录
+        manifest_path: 清单文件, 放在 build 目录之外, make clean 后仍可比较
+        diff_path: 差异文件, 为 None 时不保存
+        fingerprint: 为 True 时先为资源加指纹
+        algorithm: 哈希算法
+
+    Returns:
+        {"added": [...], "changed": [...], "removed": [...]}
+    """
+    if os.path.isdir(html_dir) is False:
+        raise ManifestError(f"输出目录 {html_dir} 不存在")
+
+    fingerprints = fingerprint_assets(html_dir, algorithm)[0] if fingerprint else {}
+    files = _list_files(html_dir)
+    digests = _hash_files(html_dir, files, algorithm)
+    manifest = {
+        "version": _MANIFEST_VERSION,
+        "algorithm": algorithm,
+        "files": {
+            path: {"digest": digests[path], "size": os.path.getsize(os.path.join(html_dir, path))} for path in files
+        },
+        "immutable": sorted(set(fingerprints.values())),
+    }
+
+    diff = diff_manifests(load_manifest(manifest_path), manifest)
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    write_file_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=1))
+    if diff_path is not None:
+        os.makedirs(os.path.dirname(diff_path) or ".", exist_ok=True)
+        write_file_atomic(diff_path, json.dumps(diff, ensure_ascii=False, indent=1))
+    return diff
+
+
+def print_diff(diff: Dict[str, List[str]]) -> None:
+    print(f"输出清单: 新增 {len(diff['added'])} 个文件, 修改 {len(diff['changed'])} 个, 删除 {len(diff['removed'])} 个.")
+
+
+if __name__ == "__main__":
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="为编译输出的静态资源加内容哈希, 生成输出清单和差异")
+    arg_parser.add_argument("html_dir", nargs="?", default=os.path.join(root_dir, "build", "html"), help="HTML 输出目录")
+    arg_parser.add_argument(
+        "--manifest", default=os.path.join(root_dir, ".cache", "build_manifest.json"), help="清单文件"
+    )
+    arg_parser.add_argument("--diff", default=os.path.join(root_dir, "build", "deploy_diff.json"), help="差异文件")
+    arg_parser.add_argument("--no-fingerprint", action="store_true", help="不为静态资源加内容哈希")
+    arg_parser.add_argument(
+        "--hash",
+        choices=sorted(HASH_ALGORITHMS),
+        help="哈希算法, 默认使用 conf.py 中的 image_hash_algorithm, 与 sphinx_format.py 生成的清单一致",
+    )
+    args = arg_parser.parse_args()
+    algorithm = args.hash or read_hash_algorithm(os.path.join(root_dir, "source"))
+
+    try:
+        result = build_manifest(
+            args.html_dir, args.manifest, args.diff, fingerprint=not args.no_fingerprint, algorithm=algorithm
+        )
+    except ManifestError as e:
+        print(e)
+        sys.exit(1)
+    print_diff(result)
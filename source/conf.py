@@ -21,11 +21,18 @@ release = "0.0.1"
 
 extensions = [
     "extensions.giscus",  # 添加 giscus 扩展
+    "extensions.image_index",  # 图片引用双向索引
+    "extensions.responsive_images",  # 输出 image_optimizer 生成的 WebP/AVIF 变体
+    "extensions.search_index",  # 分词缓存和按需加载的分片搜索索引
+    "extensions.zotero_cite",  # :cite: 角色, 直接读取 zotero.sqlite
+    "extensions.zotero_sources",  # related-sources 指令, 在 Zotero 附件全文中检索相关文献
 ]
 
 # https://giscus.app/zh-CN
 # Giscus 配置
 # 重要：你需要从 https://giscus.app 获取这些值
+giscus_repo = "gaosiyan/Discussions"  # 评论仓库
+giscus_repo_id = "R_kgDOPbjS8g"  # 仓库ID
 giscus_category = "Announcements"  # 你的分类名
 giscus_category_id = "DIC_kwDOPbjS8s4CuAmL"  # 你的分类ID，需要替换为实际值
 
@@ -37,6 +44,21 @@ giscus_position = "bottom"  # 输入框位置：bottom, top
 giscus_theme = "light"  # 主题：light, dark, transparent_dark, preferred_color_scheme
 giscus_lang = "zh_CN"  # 语言
 giscus_loading = "lazy"  # 加载方式：lazy, eager
+giscus_auto_inject = False  # 为 True 时所有页面自动添加评论区, 不需要 .. giscus:: 指令
+
+# Zotero 文献引用, 只读打开数据库, 按数据库哈希缓存
+zotero_database = os.path.abspath(os.path.join("..", "zotero", "zotero.sqlite"))
+zotero_cache_dir = os.path.abspath(os.path.join("..", ".cache", "zotero"))
+# 附件全文索引保存在 zotero_cache_dir/fulltext.sqlite, 附件目录为 zotero_database 同目录下的 storage
+# 引用格式, 为空时使用内置的 GB/T 7714 格式, 可选 zotero/styles 下的样式名, 例如 "apa", "ieee"
+zotero_csl_style = ""
+
+# 响应式图片, image_optimizer 的输出目录, 由 sphinx_format 生成, 目录不存在时图片原样输出
+responsive_images_dir = os.path.abspath(os.path.join("..", ".cache", "images"))
+responsive_images_sizes = "(max-width: 960px) 100vw, 960px"
+
+# 图片命名使用的哈希算法 (sha1, blake2b), sphinx_format.py --hash 切换算法时重命名全部图片并改写这一行
+image_hash_algorithm = "sha1"
 
 templates_path = ["_templates"]
 exclude_patterns = []
@@ -67,3 +89,7 @@ math_eqref_format = "公式-{number} "
 math_numfig = True  # True 表示启用公式的编号
 
 html_search_language = 'zh'  # 支持中文搜索,要先安装 jieba 插件 pixi add jieba
+
+# 中文搜索索引, 分词结果缓存在 .cache 中, --full 不会删除
+search_segment_cache = os.path.abspath(os.path.join("..", ".cache", "search_segments.pickle"))
+search_shard_count = 64  # 搜索页面按查询词只加载对应的词条分片
@@ -0,0 +1,1555 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: csl_renderer.py
+文件作者: gaosiyan
+创建时间: 20260121
+功能说明: CSL 引文格式渲染, 把 zotero/styles/*.csl 编译为内存中的节点树, 按 CSL-JSON 条目生成参考文献和引用
+
+编译:
+    每个样式的 XML 只解析一次, 编译为节点对象: 宏引用直接指向编译后的宏, 术语在编译时按语言环境查好,
+    格式 (字体, 大小写, 引号, 前后缀) 预先整理好. 编译结果按样式文件哈希序列化到缓存目录,
+    样式文件没有变化时直接反序列化, 不再解析 XML.
+
+渲染:
+    render_bibliography 一次渲染一批条目, 每个 (样式, 条目) 的结果在内存中缓存, 同一页或同一次编译中
+    重复出现的条目直接复用. 输出为只含 <i> <b> <sup> <sub> <span class="csl-sc"> 的 HTML 片段, html_to_text 转为纯文本.
+
+支持 CSL 1.0.2 中的常用部分: 宏, choose (type/variable/is-numeric/is-uncertain-date/locator/position),
+group 的变量为空时省略, names (et-al, substitute, 姓名倒序, 缩写名), 本地化日期, number, label,
+排序键, subsequent-author-substitute. 不支持引用消歧 (disambiguate, year-suffix) 和引用合并 (collapse).
+语言环境内置 en-US 术语, 样式中的 <locale> 覆盖内置术语. 中文姓名不倒序, 不加空格.
+
+用法:
+    python source/csl_renderer.py apa                      # 用 apa.csl 列出文献库中全部条目
+    python source/csl_renderer.py ieee finneyTuoMaSiWeiJiFen2003 --text
+"""
+
+import os
+import re
+import sys
+import time
+import pickle
+import argparse
+import xml.etree.ElementTree as ET
+from html import escape, unescape
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from utils import calculate_file_hash_code
+from file_hash_manifest import FileHashManifest
+
+CSL_NS = "{http://purl.org/net/xbiblio/csl}"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+_COMPILER_VERSION = 1
+
+# 内置 en-US 术语 {(名称, 形式): (单数, 复数)}
+EN_US_TERMS: Dict[Tuple[str, str], Tuple[str, str]] = {
+    ("accessed", "long"): ("accessed", "accessed"),
+    ("ad", "long"): ("AD", "AD"),
+    ("and", "long"): ("and", "and"),
+    ("and", "symbol"): ("&", "&"),
+    ("and others", "long"): ("and others", "and others"),
+    ("anonymous", "long"): ("anonymous", "anonymous"),
+    ("anonymous", "short"): ("anon.", "anon."),
+    ("at", "long"): ("at", "at"),
+    ("available at", "long"): ("available at", "available at"),
+    ("bc", "long"): ("BC", "BC"),
+    ("by", "long"): ("by", "by"),
+    ("circa", "long"): ("circa", "circa"),
+    ("circa", "short"): ("c.", "c."),
+    ("cited", "long"): ("cited", "cited"),
+    ("et-al", "long"): ("et al.", "et al."),
+    ("forthcoming", "long"): ("forthcoming", "forthcoming"),
+    ("from", "long"): ("from", "from"),
+    ("ibid", "long"): ("ibid.", "ibid."),
+    ("in", "long"): ("in", "in"),
+    ("in press", "long"): ("in press", "in press"),
+    ("internet", "long"): ("internet", "internet"),
+    ("interview", "long"): ("interview", "interview"),
+    ("letter", "long"): ("letter", "letter"),
+    ("no date", "long"): ("no date", "no date"),
+    ("no date", "short"): ("n.d.", "n.d."),
+    ("no-place", "long"): ("no place", "no place"),
+    ("no-place", "short"): ("n.p.", "n.p."),
+    ("no-publisher", "long"): ("no publisher", "no publisher"),
+    ("no-publisher", "short"): ("n.p.", "n.p."),
+    ("online", "long"): ("online", "online"),
+    ("presented at", "long"): ("presented at the", "presented at the"),
+    ("reference", "long"): ("reference", "references"),
+    ("reference", "short"): ("ref.", "refs."),
+    ("retrieved", "long"): ("retrieved", "retrieved"),
+    ("scale", "long"): ("scale", "scale"),
+    ("version", "long"): ("version", "version"),
+    ("open-quote", "long"): ("“", "“"),
+    ("close-quote", "long"): ("”", "”"),
+    ("open-inner-quote", "long"): ("‘", "‘"),
+    ("close-inner-quote", "long"): ("’", "’"),
+    ("page-range-delimiter", "long"): ("–", "–"),
+    ("colon", "long"): (":", ":"),
+    ("comma", "long"): (",", ","),
+    ("semicolon", "long"): (";", ";"),
+    ("ordinal", "long"): ("th", "th"),
+    ("ordinal-01", "long"): ("st", "st"),
+    ("ordinal-02", "long"): ("nd", "nd"),
+    ("ordinal-03", "long"): ("rd", "rd"),
+    ("ordinal-11", "long"): ("th", "th"),
+    ("ordinal-12", "long"): ("th", "th"),
+    ("ordinal-13", "long"): ("th", "th"),
+    # 定位词和编号变量
+    ("book", "long"): ("book", "books"),
+    ("book", "short"): ("bk.", "bks."),
+    ("chapter", "long"): ("chapter", "chapters"),
+    ("chapter", "short"): ("chap.", "chaps."),
+    ("column", "long"): ("column", "columns"),
+    ("column", "short"): ("col.", "cols."),
+    ("figure", "long"): ("figure", "figures"),
+    ("figure", "short"): ("fig.", "figs."),
+    ("folio", "long"): ("folio", "folios"),
+    ("folio", "short"): ("fol.", "fols."),
+    ("issue", "long"): ("number", "numbers"),
+    ("issue", "short"): ("no.", "nos."),
+    ("line", "long"): ("line", "lines"),
+    ("line", "short"): ("l.", "ll."),
+    ("note", "long"): ("note", "notes"),
+    ("note", "short"): ("n.", "nn."),
+    ("number", "long"): ("number", "numbers"),
+    ("number", "short"): ("no.", "nos."),
+    ("opus", "long"): ("opus", "opera"),
+    ("opus", "short"): ("op.", "opp."),
+    ("page", "long"): ("page", "pages"),
+    ("page", "short"): ("p.", "pp."),
+    ("page", "symbol"): ("p.", "pp."),
+    ("number-of-pages", "long"): ("page", "pages"),
+    ("number-of-pages", "short"): ("p.", "pp."),
+    ("paragraph", "long"): ("paragraph", "paragraph"),
+    ("paragraph", "short"): ("para.", "paras."),
+    ("paragraph", "symbol"): ("¶", "¶¶"),
+    ("part", "long"): ("part", "parts"),
+    ("part", "short"): ("pt.", "pts."),
+    ("section", "long"): ("section", "sections"),
+    ("section", "short"): ("sec.", "secs."),
+    ("section", "symbol"): ("§", "§§"),
+    ("sub verbo", "long"): ("sub verbo", "sub verbis"),
+    ("sub verbo", "short"): ("s.v.", "s.vv."),
+    ("verse", "long"): ("verse", "verses"),
+    ("verse", "short"): ("v.", "vv."),
+    ("volume", "long"): ("volume", "volumes"),
+    ("volume", "short"): ("vol.", "vols."),
+    ("number-of-volumes", "long"): ("volume", "volumes"),
+    ("number-of-volumes", "short"): ("vol.", "vols."),
+    ("edition", "long"): ("edition", "editions"),
+    ("edition", "short"): ("ed.", "eds."),
+    # 角色
+    ("author", "long"): ("", ""),
+    ("collection-editor", "long"): ("editor", "editors"),
+    ("collection-editor", "short"): ("ed.", "eds."),
+    ("composer", "long"): ("composer", "composers"),
+    ("composer", "short"): ("comp.", "comps."),
+    ("container-author", "long"): ("", ""),
+    ("director", "long"): ("director", "directors"),
+    ("director", "short"): ("dir.", "dirs."),
+    ("director", "verb"): ("directed by", "directed by"),
+    ("editor", "long"): ("editor", "editors"),
+    ("editor", "short"): ("ed.", "eds."),
+    ("editor", "verb"): ("edited by", "edited by"),
+    ("editor", "verb-short"): ("ed. by", "ed. by"),
+    ("editorial-director", "long"): ("editor", "editors"),
+    ("editorial-director", "short"): ("ed.", "eds."),
+    ("editortranslator", "long"): ("editor & translator", "editors & translators"),
+    ("editortranslator", "short"): ("ed. & tran.", "eds. & trans."),
+    ("editortranslator", "verb"): ("edited & translated by", "edited & translated by"),
+    ("illustrator", "long"): ("illustrator", "illustrators"),
+    ("illustrator", "short"): ("ill.", "ills."),
+    ("illustrator", "verb"): ("illustrated by", "illustrated by"),
+    ("interviewer", "long"): ("interviewer", "interviewers"),
+    ("interviewer", "verb"): ("interview by", "interview by"),
+    ("recipient", "verb"): ("to", "to"),
+    ("reviewed-author", "verb"): ("by", "by"),
+    ("translator", "long"): ("translator", "translators"),
+    ("translator", "short"): ("tran.", "trans."),
+    ("translator", "verb"): ("translated by", "translated by"),
+    ("translator", "verb-short"): ("trans.", "trans."),
+    ("container-author", "verb"): ("by", "by"),
+    # 季节
+    ("season-01", "long"): ("Spring", "Spring"),
+    ("season-02", "long"): ("Summer", "Summer"),
+    ("season-03", "long"): ("Autumn", "Autumn"),
+    ("season-04", "long"): ("Winter", "Winter"),
+}
+
+_MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+for _index, _month in enumerate(_MONTHS, start=1):
+    EN_US_TERMS[(f"month-{_index:02d}", "long")] = (_month, _month)
+    _short = _month if len(_month) <= 4 else _month[:3] + "."
+    EN_US_TERMS[(f"month-{_index:02d}", "short")] = (_short, _short)
+_LONG_ORDINALS = ("first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth")
+for _index, _ordinal in enumerate(_LONG_ORDINALS, start=1):
+    EN_US_TERMS[(f"long-ordinal-{_index:02d}", "long")] = (_ordinal, _ordinal)
+
+# 内置 en-US 本地化日期 {形式: (分隔符, [日期部分的属性])}
+EN_US_DATES = {
+    "text": (
+        "",
+        [{"name": "month", "suffix": " "}, {"name": "day", "suffix": ", "}, {"name": "year"}],
+    ),
+    "numeric": (
+        "",
+        [
+            {"name": "month", "form": "numeric-leading-zeros", "suffix": "/"},
+            {"name": "day", "form": "numeric-leading-zeros", "suffix": "/"},
+            {"name": "year"},
+        ],
+    ),
+}
+
+# 术语形式的回退顺序
+_FORM_FALLBACKS = {
+    "long": ("long",),
+    "short": ("short", "long"),
+    "symbol": ("symbol", "short", "long"),
+    "verb": ("verb", "long"),
+    "verb-short": ("verb-short", "verb", "long"),
+}
+
+# 姓名变量
+NAME_VARIABLES = {
+    "author",
+    "chair",
+    "collection-editor",
+    "compiler",
+    "composer",
+    "container-author",
+    "contributor",
+    "curator",
+    "director",
+    "editor",
+    "editorial-director",
+    "editor-translator",
+    "executive-producer",
+    "guest",
+    "host",
+    "illustrator",
+    "interviewer",
+    "narrator",
+    "organizer",
+    "original-author",
+    "performer",
+    "producer",
+    "recipient",
+    "reviewed-author",
+    "script-writer",
+    "series-creator",
+    "translator",
+}
+
+DATE_VARIABLES = {"accessed", "available-date", "event-date", "issued", "original-date", "submitted"}
+
+# 可以按数字处理的变量, label 按这些变量的值决定单复数
+_NUMBER_LABELS = {
+    "locator": "page",
+    "page": "page",
+    "number-of-pages": "number-of-pages",
+    "number-of-volumes": "number-of-volumes",
+    "chapter-number": "chapter",
+    "collection-number": "number",
+    "edition": "edition",
+    "issue": "issue",
+    "number": "number",
+    "volume": "volume",
+}
+
+# 引用中 label 可以取的定位词
+_LOCATOR_TERMS = {
+    "book", "chapter", "column", "figure", "folio", "issue", "line", "note", "opus", "page",
+    "paragraph", "part", "section", "sub verbo", "verse", "volume",
+}  # fmt: skip
+
+# choose 的条件属性
+_CONDITIONS = ("type", "variable", "is-numeric", "is-uncertain-date", "locator", "position", "disambiguate")
+
+# 继承的姓名选项: 样式, citation, bibliography 元素上的属性, 由 name 和 names 元素覆盖
+_INHERITED_NAME_OPTIONS = (
+    "and",
+    "delimiter-precedes-et-al",
+    "delimiter-precedes-last",
+    "et-al-min",
+    "et-al-use-first",
+    "et-al-use-last",
+    "initialize",
+    "initialize-with",
+    "name-as-sort-order",
+    "sort-separator",
+    "form",
+    "delimiter",
+    "demote-non-dropping-particle",
+    "initialize-with-hyphen",
+)
+
+_TITLE_STOP_WORDS = {
+    "a", "an", "and", "as", "at", "but", "by", "down", "for", "from", "in", "into", "nor", "of", "on", "onto",
+    "or", "over", "so", "the", "till", "to", "up", "via", "with", "yet",
+}  # fmt: skip
+
+_CJK_RE = re.compile("[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]")
+_TAG_RE = re.compile(r"(<[^>]+>)")
+_NUMERIC_RE = re.compile(r"^[a-zA-Z]*\d+[a-zA-Z]*(\s*(?:[-–&,]|and)\s*[a-zA-Z]*\d+[a-zA-Z]*)*$")
+_PLURAL_RE = re.compile(r"\d\s*(?:[-–&,]|and)\s*\d")
+
+
+class CslError(Exception):
+    """CSL 样式解析或编译失败"""
+
+    pass
+
+
+# ---------------------------------------------------------------- 文本处理
+
+
+def _map_text(html: str, func) -> str:
+    """对 HTML 片段中标签以外的文本调用 func, func 接收和返回未转义的文本"""
+    parts = _TAG_RE.split(html)
+    for index in range(0, len(parts), 2):
+        if parts[index]:
+            parts[index] = escape(func(unescape(parts[index])), quote=False)
+    return "".join(parts)
+
+
+def _capitalize_first(text: str) -> str:
+    for index, char in enumerate(text):
+        if char.isalpha():
+            return text[:index] + char.upper() + text[index + 1 :]
+    return text
+
+
+def _title_case(text: str) -> str:
+    words = re.split(r"(\s+)", text)
+    result = []
+    after_colon = True
+    last_index = max((index for index, word in enumerate(words) if word.strip()), default=0)
+    for index, word in enumerate(words):
+        if not word.strip():
+            result.append(word)
+            continue
+        lower = word.lower()
+        # 已经含有大写字母 (缩写, 专有名词) 的词不改
+        if word == lower and (after_colon or index == last_index or lower.strip("\"'“‘(") not in _TITLE_STOP_WORDS):
+            word = _capitalize_first(word)
+        result.append(word)
+        after_colon = word.endswith((":", "?", "!"))
+    return "".join(result)
+
+
+_TEXT_CASES = {
+    "lowercase": str.lower,
+    "uppercase": str.upper,
+    "capitalize-first": _capitalize_first,
+    "capitalize-all": lambda text: re.sub(r"\b([a-z])", lambda match: match.group(1).upper(), text),
+    "sentence": _capitalize_first,
+    "title": _title_case,
+}
+
+
+def _apply_text_case(html: str, text_case: str, item: dict) -> str:
+    if text_case == "title":
+        # 只对英文标题使用标题大小写
+        language = str(item.get("language", "en")).lower()
+        if not language.startswith("en") or _CJK_RE.search(html):
+            return html
+    if text_case in ("capitalize-first", "sentence"):
+        # 只改第一个文字片段
+        parts = _TAG_RE.split(html)
+        for index in range(0, len(parts), 2):
+            if parts[index].strip():
+                parts[index] = escape(_capitalize_first(unescape(parts[index])), quote=False)
+                break
+        return "".join(parts)
+    return _map_text(html, _TEXT_CASES[text_case])
+
+
+def html_to_text(html: str) -> str:
+    """去掉渲染结果中的标签"""
+    return unescape(_TAG_RE.sub("", html))
+
+
+def _clean(html: str) -> str:
+    """整理拼接产生的重复标点和空格, 按美式规则把句点和逗号移到右引号内"""
+    html = re.sub(r"([.?!])((?:</[a-z]+>)*)\.", r"\1\2", html)
+    html = re.sub(r",((?:</[a-z]+>)*),", r",\1", html)
+    html = re.sub(r"(”|’)([.,])", r"\2\1", html)
+    html = re.sub(r" {2,}", " ", html)
+    return html.strip()
+
+
+def _is_numeric(value) -> bool:
+    if isinstance(value, int):
+        return True
+    return isinstance(value, str) and _NUMERIC_RE.match(value.strip()) is not None
+
+
+def _ordinal_suffix(number: int, terms: dict) -> str:
+    if 11 <= number % 100 <= 13:
+        return terms.get(f"ordinal-{number % 100:02d}", terms.get("ordinal", "th"))
+    return terms.get(f"ordinal-{number % 10:02d}", terms.get("ordinal", "th"))
+
+
+def _roman(number: int) -> str:
+    result = ""
+    for value, numeral in (
+        (1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"),
+        (50, "l"), (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i"),
+    ):  # fmt: skip
+        while number >= value:
+            result += numeral
+            number -= value
+    return result
+
+
+def _format_page_range(value: str, page_format: str, delimiter: str) -> str:
+    """页码范围, page-range-format 为 expanded/minimal/minimal-two/chicago"""
+
+    def replace(match: re.Match) -> str:
+        first, last = match.group(1), match.group(2)
+        if page_format and first.isdigit() and last.isdigit() and len(last) <= len(first):
+            last = first[: len(first) - len(last)] + last  # 先展开 "123-45" -> "123-145"
+            if page_format in ("minimal", "minimal-two", "chicago", "chicago-15", "chicago-16"):
+                keep = 2 if page_format != "minimal" and len(last) >= 2 else 1
+                index = 0
+                while index < len(first) - keep and first[index] == last[index]:
+                    index += 1
+                last = last[index:]
+        return first + delimiter + last
+
+    return re.sub(r"(\w+)\s*[-–]+\s*(\w+)", replace, value)
+
+
+# ---------------------------------------------------------------- 编译后的节点
+
+
+class _Formatting:
+    """前后缀, 字体, 大小写和引号"""
+
+    __slots__ = ("prefix", "suffix", "open_tags", "close_tags", "text_case", "strip_periods", "quotes")
+
+    def __init__(self, element: ET.Element, terms: dict) -> None:
+        attrib = element.attrib
+        self.prefix = escape(attrib.get("prefix", ""), quote=False)
+        self.suffix = escape(attrib.get("suffix", ""), quote=False)
+        tags = []
+        if attrib.get("font-style") in ("italic", "oblique"):
+            tags.append("i")
+        if attrib.get("font-weight") == "bold":
+            tags.append("b")
+        if attrib.get("font-variant") == "small-caps":
+            tags.append('span class="csl-sc"')
+        if attrib.get("vertical-align") == "sup":
+            tags.append("sup")
+        elif attrib.get("vertical-align") == "sub":
+            tags.append("sub")
+        self.open_tags = "".join(f"<{tag}>" for tag in tags)
+        self.close_tags = "".join(f"</{tag.split()[0]}>" for tag in reversed(tags))
+        self.text_case = attrib.get("text-case")
+        self.strip_periods = attrib.get("strip-periods") == "true"
+        self.quotes = (
+            (escape(terms.get("open-quote", "“")), escape(terms.get("close-quote", "”")))
+            if attrib.get("quotes") == "true"
+            else None
+        )
+
+    def apply(self, html: str, context: "_Context") -> str:
+        if not html:
+            return ""
+        if self.strip_periods:
+            html = _map_text(html, lambda text: text.replace(".", ""))
+        if self.text_case is not None:
+            html = _apply_text_case(html, self.text_case, context.item)
+        if self.quotes is not None:
+            html = self.quotes[0] + html + self.quotes[1]
+        return self.prefix + self.open_tags + html + self.close_tags + self.suffix
+
+
+class _Frame:
+    """变量调用计数, group 中调用了变量但全部为空时整个 group 省略"""
+
+    __slots__ = ("called", "rendered")
+
+    def __init__(self) -> None:
+        self.called = 0
+        self.rendered = 0
+
+
+class _Context:
+    """渲染一个条目时的状态"""
+
+    __slots__ = ("style", "item", "mode", "name_options", "frames", "suppressed", "used", "citation_number",
+                 "locator", "label", "sort_mode", "first_names")  # fmt: skip
+
+    def __init__(self, style: "CslStyle", item: dict, mode: str, citation_number: int | None = None) -> None:
+        self.style = style
+        self.item = item
+        self.mode = mode
+        self.name_options = style.name_options[mode]
+        self.frames = [_Frame()]
+        self.suppressed: set = set()
+        self.used: set = set()
+        self.citation_number = citation_number
+        self.locator = item.get("locator")
+        self.label = item.get("label", "page")
+        self.sort_mode = False
+        self.first_names: str | None = None  # 第一个 names 的输出, 用于 subsequent-author-substitute
+
+    def variable(self, name: str):
+        """取变量值并计数, 被 substitute 用过的变量视为空"""
+        frame = self.frames[-1]
+        frame.called += 1
+        if name in self.suppressed:
+            return None
+        if name == "citation-number":
+            value = self.citation_number
+        elif name == "locator":
+            value = self.locator
+        else:
+            value = self.item.get(name)
+        if value in (None, "", []):
+            return None
+        frame.rendered += 1
+        self.used.add(name)
+        return value
+
+
+def _render_children(children: Sequence, context: _Context, delimiter: str = "") -> str:
+    """依次渲染子节点, 用 delimiter 连接非空输出; choose 选中分支的子节点也用外层的 delimiter 连接"""
+    outputs = []
+    for child in children:
+        output = child.render(context, delimiter) if isinstance(child, _Choose) else child.render(context)
+        if output:
+            outputs.append(output)
+    return delimiter.join(outputs)
+
+
+class _Text:
+    __slots__ = ("kind", "value", "form", "plural", "formatting", "macro")
+
+    def __init__(self, kind: str, value, form: str, plural: str, formatting: _Formatting) -> None:
+        self.kind = kind  # variable / macro / term / value
+        self.value = value  # 变量名, 宏名, (单数, 复数) 术语或文本
+        self.form = form
+        self.plural = plural
+        self.formatting = formatting
+        self.macro: "_Macro | None" = None
+
+    def render(self, context: _Context) -> str:
+        if self.kind == "macro":
+            html = self.macro.render(context)
+        elif self.kind == "term":
+            html = escape(self.value[1] if self.plural == "multiple" else self.value[0], quote=False)
+        elif self.kind == "value":
+            html = self.value
+        else:
+            html = self._render_variable(context)
+        return self.formatting.apply(html, context)
+
+    def _render_variable(self, context: _Context) -> str:
+        name = self.value
+        value = None
+        if self.form == "short":
+            value = context.variable(name + "-short")
+            if value is None and name == "container-title":
+                value = context.variable("journalAbbreviation")
+        if value is None:
+            value = context.variable(name)
+        if value is None:
+            return ""
+        if isinstance(value, (list, dict)):
+            return ""  # 姓名和日期变量只能由 names 和 date 输出
+        value = str(value)
+        if name in ("page", "locator"):
+            style = context.style
+            value = _format_page_range(value, style.page_range_format, style.terms.get("page-range-delimiter", "–"))
+        return escape(value, quote=False)
+
+
+class _Macro:
+    __slots__ = ("name", "children")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.children: List = []
+
+    def render(self, context: _Context) -> str:
+        return _render_children(self.children, context)
+
+
+class _Group:
+    __slots__ = ("children", "delimiter", "formatting")
+
+    def __init__(self, children: List, delimiter: str, formatting: _Formatting) -> None:
+        self.children = children
+        self.delimiter = delimiter
+        self.formatting = formatting
+
+    def render(self, context: _Context) -> str:
+        frame = _Frame()
+        context.frames.append(frame)
+        try:
+            html = _render_children(self.children, context, self.delimiter)
+        finally:
+            context.frames.pop()
+        parent = context.frames[-1]
+        parent.called += frame.called
+        if frame.called and not frame.rendered:
+            return ""
+        if html:
+            parent.rendered += frame.rendered
+        return self.formatting.apply(html, context)
+
+
+class _Condition:
+    __slots__ = ("match", "tests")
+
+    def __init__(self, match: str, tests: List[Tuple[str, str]]) -> None:
+        self.match = match
+        self.tests = tests  # [(条件, 值)]
+
+    def evaluate(self, context: _Context) -> bool:
+        results = (self._test(kind, value, context) for kind, value in self.tests)
+        if self.match == "any":
+            return any(results)
+        if self.match == "none":
+            return not any(results)
+        return all(results)
+
+    @staticmethod
+    def _test(kind: str, value: str, context: _Context) -> bool:
+        item = context.item
+        if kind == "type":
+            return item.get("type") == value
+        if kind == "variable":
+            if value == "locator":
+                return bool(context.locator)
+            if value == "citation-number":
+                return context.citation_number is not None
+            return value not in context.suppressed and item.get(value) not in (None, "", [])
+        if kind == "is-numeric":
+            return _is_numeric(context.locator if value == "locator" else item.get(value))
+        if kind == "is-uncertain-date":
+            date = item.get(value)
+            return isinstance(date, dict) and bool(date.get("circa"))
+        if kind == "locator":
+            return bool(context.locator) and context.label == value
+        if kind == "position":
+            # 参考文献中没有位置, 引用都按第一次出现处理
+            return context.mode == "citation" and value == "first"
+        return False  # disambiguate
+
+
+class _Choose:
+    __slots__ = ("branches",)
+
+    def __init__(self, branches: List[Tuple[_Condition | None, List]]) -> None:
+        self.branches = branches
+
+    def render(self, context: _Context, delimiter: str = "") -> str:
+        for condition, children in self.branches:
+            if condition is None or condition.evaluate(context):
+                return _render_children(children, context, delimiter)
+        return ""
+
+
+class _Label:
+    __slots__ = ("variable", "terms", "plural", "formatting")
+
+    def __init__(self, variable: str, terms: Dict[str, Tuple[str, str]], plural: str, formatting: _Formatting) -> None:
+        self.variable = variable
+        self.terms = terms  # {术语名: (单数, 复数)}, 编译时按 form 查好
+        self.plural = plural
+        self.formatting = formatting
+
+    def term(self, name: str, count: int, context: _Context) -> str:
+        single, multiple = self.terms.get(name, ("", ""))
+        if self.plural == "always" or (self.plural == "contextual" and count > 1):
+            text = multiple
+        else:
+            text = single
+        return self.formatting.apply(escape(text, quote=False), context)
+
+    def render(self, context: _Context) -> str:
+        if self.variable == "locator":
+            value, name = context.locator, context.label
+        else:
+            value, name = context.item.get(self.variable), _NUMBER_LABELS.get(self.variable, self.variable)
+        if value in (None, ""):
+            return ""
+        if self.variable in ("number-of-pages", "number-of-volumes") and str(value).isdigit():
+            count = int(value)
+        else:
+            count = 2 if _PLURAL_RE.search(str(value)) else 1
+        return self.term(name, count, context)
+
+
+class _Name:
+    __slots__ = ("options", "and_terms", "formatting")
+
+    def __init__(self, options: dict, and_terms: Tuple[str, str], formatting: _Formatting) -> None:
+        self.options = options  # 元素上显式写出的选项
+        self.and_terms = and_terms  # ("and" 术语, 符号)
+        self.formatting = formatting
+
+    def format_person(self, person: dict, inverted: bool, options: dict) -> str:
+        if "literal" in person:
+            return escape(person["literal"], quote=False)
+        family = person.get("family", "")
+        given = person.get("given", "")
+        if _CJK_RE.search(family + given):
+            return escape(family if options.get("form") == "short" else family + given, quote=False)
+
+        particle = person.get("non-dropping-particle", "")
+        dropping = person.get("dropping-particle", "")
+        suffix = person.get("suffix", "")
+        if options.get("form") == "short":
+            return escape(" ".join(part for part in (particle, family) if part), quote=False)
+
+        initialize_with = options.get("initialize-with")
+        if given and initialize_with is not None and options.get("initialize") != "false":
+            given = _initials(given, initialize_with, options.get("initialize-with-hyphen") != "false")
+
+        if not inverted:
+            text = " ".join(part for part in (given, dropping, particle, family, suffix) if part)
+        else:
+            separator = options.get("sort-separator", ", ")
+            if options.get("demote-non-dropping-particle", "display-and-sort") == "never":
+                head = " ".join(part for part in (particle, family) if part)
+                tail = " ".join(part for part in (given, dropping) if part)
+            else:
+                head = family
+                tail = " ".join(part for part in (given, dropping, particle) if part)
+            text = separator.join(part for part in (head, tail, suffix) if part)
+        return escape(text, quote=False)
+
+    def render_list(self, persons: List[dict], context: _Context, et_al: "_EtAl | None") -> str:
+        options = {**context.name_options, **self.options}
+        if context.sort_mode:
+            options["name-as-sort-order"] = "all"
+        count = len(persons)
+        et_al_min = int(options.get("et-al-min", 0) or 0)
+        et_al_use_first = int(options.get("et-al-use-first", 0) or 0)
+        truncated = bool(et_al_min and et_al_use_first and count >= et_al_min)
+        shown = persons[:et_al_use_first] if truncated else persons
+        if options.get("form") == "count":
+            return str(len(shown))
+
+        sort_order = options.get("name-as-sort-order")
+        names = [
+            self.format_person(person, sort_order == "all" or (sort_order == "first" and index == 0), options)
+            for index, person in enumerate(shown)
+        ]
+        delimiter = escape(options.get("delimiter", ", "), quote=False)
+        last_inverted = sort_order == "all" or (sort_order == "first" and len(names) == 1)
+
+        if truncated:
+            if options.get("et-al-use-last") == "true" and count > et_al_use_first + 1:
+                last = self.format_person(persons[-1], sort_order == "all", options)
+                return self.formatting.apply(delimiter.join(names) + delimiter + "… " + last, context)
+            if et_al is None or not et_al.text:
+                et_al_text = escape(context.style.terms.get("et-al", "et al."), quote=False)
+            else:
+                et_al_text = et_al.formatting.apply(et_al.text, context)
+            precedes = _delimiter_precedes(
+                options.get("delimiter-precedes-et-al", "contextual"), len(names), last_inverted
+            )
+            return self.formatting.apply(delimiter.join(names) + (delimiter if precedes else " ") + et_al_text, context)
+
+        if len(names) == 1:
+            return self.formatting.apply(names[0], context)
+        and_option = options.get("and")
+        if and_option not in ("text", "symbol"):
+            return self.formatting.apply(delimiter.join(names), context)
+        conjunction = escape(self.and_terms[0] if and_option == "text" else self.and_terms[1], quote=False)
+        second_last_inverted = sort_order == "all" or (sort_order == "first" and len(names) == 2)
+        precedes = _delimiter_precedes(
+            options.get("delimiter-precedes-last", "contextual"), len(names), second_last_inverted
+        )
+        html = delimiter.join(names[:-1]) + (delimiter if precedes else " ") + conjunction + " " + names[-1]
+        return self.formatting.apply(html, context)
+
+
+def _delimiter_precedes(option: str, count: int, inverted: bool) -> bool:
+    if option == "always":
+        return True
+    if option == "never":
+        return False
+    if option == "after-inverted-name":
+        return inverted
+    return count > 2 if option == "contextual" else False
+
+
+def _initials(given: str, initialize_with: str, hyphen: bool) -> str:
+    """"Mark Jean-Paul" -> "M. J.-P." """
+    result = []
+    for word in given.split():
+        pieces = [piece.rstrip(".") for piece in word.split("-") if piece.rstrip(".")]
+        if not pieces:
+            continue
+        initials = [piece[0].upper() + initialize_with for piece in pieces]
+        if hyphen:
+            # "J. P." -> "J.-P."
+            result.append("".join(initial.rstrip() + "-" for initial in initials[:-1]) + initials[-1])
+        else:
+            result.append("".join(initials))
+    return "".join(result).strip()
+
+
+class _EtAl:
+    __slots__ = ("text", "formatting")
+
+    def __init__(self, text: str, formatting: _Formatting) -> None:
+        self.text = text
+        self.formatting = formatting
+
+
+class _Names:
+    __slots__ = ("variables", "name", "et_al", "label", "label_first", "substitute", "delimiter", "formatting")
+
+    def __init__(self, variables: List[str], delimiter: str, formatting: _Formatting) -> None:
+        self.variables = variables
+        self.name: _Name | None = None
+        self.et_al: _EtAl | None = None
+        self.label: _Label | None = None
+        self.label_first = False
+        self.substitute: List = []
+        self.delimiter = delimiter
+        self.formatting = formatting
+
+    def render(self, context: _Context) -> str:
+        outputs = []
+        variables = self.variables
+        # 编者和译者相同时合并为 editortranslator
+        if "editor" in variables and "translator" in variables:
+            item = context.item
+            if item.get("editor") and item.get("editor") == item.get("translator"):
+                variables = [variable for variable in variables if variable != "translator"]
+
+        for variable in variables:
+            persons = context.variable(variable)
+            if not persons:
+                continue
+            html = self.name.render_list(persons, context, self.et_al) if self.name is not None else ""
+            if self.label is not None and html:
+                term_name = variable
+                if variable == "editor" and variable in variables and variables is not self.variables:
+                    term_name = "editortranslator"
+                label = self.label.term(term_name, len(persons), context)
+                html = label + html if self.label_first else html + label
+            if html:
+                outputs.append(html)
+
+        if outputs:
+            html = self.formatting.apply(escape(self.delimiter, quote=False).join(outputs), context)
+            if context.first_names is None and context.mode == "bibliography":
+                context.first_names = html
+            return html
+
+        for child in self.substitute:
+            used = set(context.used)
+            html = child.render(context)
+            if html:
+                # 用作替代的变量在后面不再输出
+                context.suppressed |= context.used - used
+                if context.first_names is None and context.mode == "bibliography":
+                    context.first_names = html
+                return html
+        return ""
+
+
+class _DatePart:
+    __slots__ = ("name", "form", "formatting", "range_delimiter")
+
+    def __init__(self, name: str, form: str, formatting: _Formatting, range_delimiter: str) -> None:
+        self.name = name
+        self.form = form
+        self.formatting = formatting
+        self.range_delimiter = range_delimiter
+
+    def render(self, parts: List[int], context: _Context) -> str:
+        terms = context.style.terms
+        if self.name == "year":
+            if not parts:
+                return ""
+            year = parts[0]
+            text = str(abs(year))
+            if self.form == "short":
+                text = text[-2:]
+            if year < 0:
+                text += terms.get("bc", "BC")
+        elif self.name == "month":
+            if len(parts) < 2 or not parts[1]:
+                return ""
+            month = parts[1]
+            if 13 <= month <= 16:
+                text = terms.get(f"season-{month - 12:02d}", "")
+            elif self.form == "numeric":
+                text = str(month)
+            elif self.form == "numeric-leading-zeros":
+                text = f"{month:02d}"
+            else:
+                text = context.style.month_terms[self.form == "short"].get(month, str(month))
+        else:
+            if len(parts) < 3 or not parts[2]:
+                return ""
+            day = parts[2]
+            if self.form == "numeric-leading-zeros":
+                text = f"{day:02d}"
+            elif self.form == "ordinal":
+                text = f"{day}{_ordinal_suffix(day, terms)}"
+            else:
+                text = str(day)
+        return self.formatting.apply(escape(text, quote=False), context)
+
+
+class _Date:
+    __slots__ = ("variable", "parts", "delimiter", "formatting")
+
+    def __init__(self, variable: str, parts: List[_DatePart], delimiter: str, formatting: _Formatting) -> None:
+        self.variable = variable
+        self.parts = parts
+        self.delimiter = delimiter
+        self.formatting = formatting
+
+    def render(self, context: _Context) -> str:
+        value = context.variable(self.variable)
+        if not isinstance(value, dict):
+            return ""
+        if "date-parts" not in value:
+            literal = value.get("literal") or value.get("raw") or ""
+            return self.formatting.apply(escape(str(literal), quote=False), context)
+
+        dates = [[int(part) for part in parts if str(part).lstrip("-").isdigit()] for parts in value["date-parts"]]
+        dates = [parts for parts in dates if parts]
+        if not dates:
+            return ""
+        rendered = [self._render_date(parts, context) for parts in dates[:2]]
+        if len(rendered) == 2 and rendered[0] != rendered[1]:
+            delimiter = self.parts[-1].range_delimiter if self.parts else "–"
+            html = rendered[0] + escape(delimiter, quote=False) + rendered[1]
+        else:
+            html = rendered[0]
+        return self.formatting.apply(html, context)
+
+    def _render_date(self, parts: List[int], context: _Context) -> str:
+        outputs = [output for output in (part.render(parts, context) for part in self.parts) if output]
+        return escape(self.delimiter, quote=False).join(outputs).strip().rstrip(",")
+
+
+class _Number:
+    __slots__ = ("variable", "form", "formatting")
+
+    def __init__(self, variable: str, form: str, formatting: _Formatting) -> None:
+        self.variable = variable
+        self.form = form
+        self.formatting = formatting
+
+    def render(self, context: _Context) -> str:
+        value = context.variable(self.variable)
+        if value is None:
+            return ""
+        text = str(value).strip()
+        if text.isdigit():
+            number = int(text)
+            terms = context.style.terms
+            if self.form == "ordinal":
+                text = f"{number}{_ordinal_suffix(number, terms)}"
+            elif self.form == "long-ordinal":
+                text = terms.get(f"long-ordinal-{number:02d}", f"{number}{_ordinal_suffix(number, terms)}")
+            elif self.form == "roman":
+                text = _roman(number)
+            else:
+                text = str(number)
+        return self.formatting.apply(escape(text, quote=False), context)
+
+
+class _Layout:
+    __slots__ = ("children", "delimiter", "formatting")
+
+    def __init__(self, children: List, delimiter: str, formatting: _Formatting) -> None:
+        self.children = children
+        self.delimiter = delimiter
+        self.formatting = formatting
+
+
+class _SortKey:
+    __slots__ = ("variable", "macro", "descending", "names_min", "names_use_first")
+
+    def __init__(self, variable: str | None, macro: _Macro | None, descending: bool, names_min, names_use_first):
+        self.variable = variable
+        self.macro = macro
+        self.descending = descending
+        self.names_min = names_min
+        self.names_use_first = names_use_first
+
+
+# ---------------------------------------------------------------- 样式
+
+
+class CslStyle:
+    """编译后的 CSL 样式, 可以序列化; 渲染结果缓存在 _memo 中, 不随样式序列化"""
+
+    def __init__(self, path: str, digest: str) -> None:
+        self.path = path
+        self.digest = digest
+        self.title = ""
+        self.style_class = "in-text"
+        self.terms: Dict[str, str] = {}
+        self.month_terms: Tuple[Dict[int, str], Dict[int, str]] = ({}, {})
+        self.page_range_format = ""
+        self.name_options: Dict[str, dict] = {"citation": {}, "bibliography": {}}
+        self.macros: Dict[str, _Macro] = {}
+        self.layouts: Dict[str, _Layout | None] = {"citation": None, "bibliography": None}
+        self.sort_keys: Dict[str, List[_SortKey]] = {"citation": [], "bibliography": []}
+        self.bibliography_options: Dict[str, str] = {}
+        self.uses_citation_number = False
+        self._memo: Dict[tuple, tuple] = {}  # {(模式, 条目 id, 编号): (条目, 结果, 第一个 names 的输出)}
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_memo"] = {}
+        return state
+
+    @property
+    def is_numeric(self) -> bool:
+        """引用是否为编号, 例如 ieee, vancouver"""
+        return self.uses_citation_number
+
+    def _render_item(self, item: dict, mode: str, citation_number: int | None) -> Tuple[str, str | None]:
+        """渲染一个条目, 按 (模式, 条目, 编号) 缓存, 条目内容变化时重新渲染"""
+        number = citation_number if self.uses_citation_number else None
+        key = (mode, item.get("id"), number)
+        cached = self._memo.get(key)
+        if cached is not None and (cached[0] is item or cached[0] == item):
+            return cached[1], cached[2]
+
+        layout = self.layouts[mode]
+        context = _Context(self, item, mode, citation_number)
+        children = layout.children
+        if mode == "bibliography" and self.bibliography_options.get("second-field-align") and len(children) > 1:
+            # 编号单独成列, 输出为一行时和正文之间留一个空格
+            first = _render_children(children[:1], context)
+            rest = _render_children(children[1:], context)
+            html = f"{first} {rest}" if first and rest else first or rest
+        else:
+            html = _render_children(children, context)
+        if mode == "bibliography" and html:
+            # citation 的 layout 前后缀加在整处引用上, 不加在单个条目上
+            html = _clean(layout.formatting.apply(html, context))
+        self._memo[key] = (item, html, context.first_names)
+        return html, context.first_names
+
+    def _sort_value(self, key: _SortKey, item: dict, mode: str, citation_number: int | None):
+        context = _Context(self, item, mode, citation_number)
+        context.sort_mode = True
+        if key.names_min is not None:
+            context.name_options = {
+                **context.name_options,
+                "et-al-min": key.names_min,
+                "et-al-use-first": key.names_use_first,
+            }
+        if key.macro is not None:
+            return html_to_text(key.macro.render(context)).lower()
+        variable = key.variable
+        if variable == "citation-number":
+            return citation_number or 0
+        value = item.get(variable)
+        if value in (None, "", []):
+            return None
+        if variable in NAME_VARIABLES and isinstance(value, list):
+            return " ".join(
+                person.get("literal") or f"{person.get('family', '')} {person.get('given', '')}" for person in value
+            ).lower()
+        if variable in DATE_VARIABLES and isinstance(value, dict):
+            parts = (value.get("date-parts") or [[]])[0]
+            return "".join(f"{int(part):04d}" for part in parts[:3]) if parts else value.get("literal", "")
+        if _is_numeric(value) and str(value).strip().isdigit():
+            return int(str(value).strip())
+        return str(value).lower()
+
+    def sort(
+        self, items: List[dict], mode: str = "bibliography", citation_numbers: Sequence[int] | None = None
+    ) -> List[int]:
+        """按样式的排序键排序, 返回排序后的下标; 排序键为空的条目排在最后"""
+        order = list(range(len(items)))
+        numbers = citation_numbers or [index + 1 for index in order]
+        keys = self.sort_keys[mode]
+        if not keys:
+            return order
+        values = [self._sort_values(items[index], mode, numbers[index]) for index in order]
+        for position in reversed(range(len(keys))):
+            present = [index for index in order if values[index][position] is not None]
+            missing = [index for index in order if values[index][position] is None]
+            present.sort(
+                key=lambda index: (isinstance(values[index][position], str), values[index][position]),
+                reverse=keys[position].descending,
+            )
+            order = present + missing
+        return order
+
+    def _sort_values(self, item: dict, mode: str, citation_number: int | None) -> tuple:
+        """条目的全部排序键, 和渲染结果一样缓存"""
+        number = citation_number if self.uses_citation_number else None
+        memo_key = ("sort", mode, item.get("id"), number)
+        cached = self._memo.get(memo_key)
+        if cached is not None and (cached[0] is item or cached[0] == item):
+            return cached[1]
+        values = tuple(self._sort_value(key, item, mode, citation_number) for key in self.sort_keys[mode])
+        self._memo[memo_key] = (item, values, None)
+        return values
+
+    def render_bibliography(
+        self, items: Sequence[dict], citation_numbers: Sequence[int] | None = None
+    ) -> List[Tuple[str, str]]:
+        """
+        渲染参考文献列表
+
+        Args:
+            items: CSL-JSON 条目
+            citation_numbers: 条目的引用编号, 编号样式使用, 为 None 时按 items 的顺序编号
+
+        Returns:
+            按样式排序的 [(条目 id, HTML)]
+        """
+        if self.layouts["bibliography"] is None:
+            raise CslError(f"样式 {self.title} 没有 bibliography")
+        items = list(items)
+        numbers = list(citation_numbers) if citation_numbers is not None else list(range(1, len(items) + 1))
+        substitute = self.bibliography_options.get("subsequent-author-substitute")
+
+        result = []
+        previous_names = None
+        for index in self.sort(items, "bibliography", numbers):
+            html, names = self._render_item(items[index], "bibliography", numbers[index])
+            if substitute is not None and names and names == previous_names:
+                html = html.replace(names, escape(substitute, quote=False), 1)
+            previous_names = names
+            result.append((items[index].get("id"), html))
+        return result
+
+    def render_citation(
+        self, items: Sequence[dict], citation_numbers: Sequence[int] | None = None, anchors: bool = False
+    ) -> str:
+        """
+        渲染一处引用, 多个条目按 citation 的 layout 分隔符连接
+
+        Args:
+            items: CSL-JSON 条目
+            citation_numbers: 条目的引用编号, 为 None 时按 items 的顺序编号
+            anchors: 为 True 时每个条目包在 <a href="#cite-<条目 id>"> 中, 由调用方转换为链接
+        """
+        layout = self.layouts["citation"]
+        if layout is None:
+            raise CslError(f"样式 {self.title} 没有 citation")
+        items = list(items)
+        numbers = list(citation_numbers) if citation_numbers is not None else list(range(1, len(items) + 1))
+        outputs = []
+        for index in self.sort(items, "citation", numbers):
+            html, _ = self._render_item(items[index], "citation", numbers[index])
+            if html and anchors:
+                html = f'<a href="#cite-{escape(str(items[index].get("id")))}">{html}</a>'
+            if html:
+                outputs.append(html)
+        html = escape(layout.delimiter, quote=False).join(outputs)
+        return _clean(layout.formatting.apply(html, _Context(self, {}, "citation"))) if html else ""
+
+
+class _Compiler:
+    """把 CSL XML 编译为节点树"""
+
+    def __init__(self, root: ET.Element, style: CslStyle) -> None:
+        self.root = root
+        self.style = style
+        self.terms: Dict[Tuple[str, str], Tuple[str, str]] = dict(EN_US_TERMS)
+        self.dates = dict(EN_US_DATES)
+        self._load_locales()
+
+    @staticmethod
+    def _tag(element: ET.Element) -> str:
+        return element.tag.replace(CSL_NS, "")
+
+    def _load_locales(self) -> None:
+        """样式中语言为空或英文的 <locale> 覆盖内置术语"""
+        default_locale = self.root.get("default-locale", "en-US")
+        for locale in self.root.findall(f"{CSL_NS}locale"):
+            lang = locale.get(XML_LANG, "")
+            if lang and not (lang == default_locale or lang.split("-")[0] == "en" == default_locale.split("-")[0]):
+                continue
+            for term in locale.iter(f"{CSL_NS}term"):
+                name, form = term.get("name"), term.get("form", "long")
+                single = term.find(f"{CSL_NS}single")
+                multiple = term.find(f"{CSL_NS}multiple")
+                if single is not None:
+                    value = (single.text or "", multiple.text if multiple is not None else single.text or "")
+                else:
+                    value = (term.text or "", term.text or "")
+                self.terms[(name, form)] = value
+            for date in locale.findall(f"{CSL_NS}date"):
+                self.dates[date.get("form")] = (
+                    date.get("delimiter", ""),
+                    [dict(part.attrib) for part in date.findall(f"{CSL_NS}date-part")],
+                )
+
+    def term(self, name: str, form: str = "long") -> Tuple[str, str]:
+        for candidate in _FORM_FALLBACKS.get(form, (form, "long")):
+            value = self.terms.get((name, candidate))
+            if value is not None:
+                return value
+        return ("", "")
+
+    def compile(self) -> CslStyle:
+        style = self.style
+        root = self.root
+        info = root.find(f"{CSL_NS}info")
+        if info is not None:
+            style.title = (info.findtext(f"{CSL_NS}title") or "").strip()
+        style.style_class = root.get("class", "in-text")
+        style.page_range_format = root.get("page-range-format", "")
+        style.terms = {name: value[0] for (name, form), value in self.terms.items() if form == "long"}
+        style.month_terms = (
+            {index: self.term(f"month-{index:02d}", "long")[0] for index in range(1, 13)},
+            {index: self.term(f"month-{index:02d}", "short")[0] for index in range(1, 13)},
+        )
+
+        inherited = {name: root.get(name) for name in _INHERITED_NAME_OPTIONS if root.get(name) is not None}
+        # 样式上的 name-form / name-delimiter / names-delimiter 对应 name 的 form / delimiter
+        for attribute, option in (("name-form", "form"), ("name-delimiter", "delimiter")):
+            if root.get(attribute) is not None:
+                inherited[option] = root.get(attribute)
+
+        # 先创建所有宏, 宏之间可以相互引用
+        macro_elements = root.findall(f"{CSL_NS}macro")
+        for element in macro_elements:
+            style.macros[element.get("name")] = _Macro(element.get("name"))
+        for element in macro_elements:
+            style.macros[element.get("name")].children = self.compile_children(element)
+
+        for mode in ("citation", "bibliography"):
+            element = root.find(f"{CSL_NS}{mode}")
+            if element is None:
+                continue
+            options = dict(inherited)
+            for name in _INHERITED_NAME_OPTIONS:
+                if element.get(name) is not None:
+                    options[name] = element.get(name)
+            for attribute, option in (("name-form", "form"), ("name-delimiter", "delimiter")):
+                if element.get(attribute) is not None:
+                    options[option] = element.get(attribute)
+            style.name_options[mode] = options
+            if mode == "bibliography":
+                style.bibliography_options = {
+                    name: value for name, value in element.attrib.items() if name not in _INHERITED_NAME_OPTIONS
+                }
+
+            layout = element.find(f"{CSL_NS}layout")
+            if layout is not None:
+                style.layouts[mode] = _Layout(
+                    self.compile_children(layout), layout.get("delimiter", ""), _Formatting(layout, style.terms)
+                )
+            sort = element.find(f"{CSL_NS}sort")
+            if sort is not None:
+                for key in sort.findall(f"{CSL_NS}key"):
+                    macro = style.macros.get(key.get("macro")) if key.get("macro") else None
+                    style.sort_keys[mode].append(
+                        _SortKey(
+                            key.get("variable"),
+                            macro,
+                            key.get("sort") == "descending",
+                            key.get("names-min"),
+                            key.get("names-use-first"),
+                        )
+                    )
+        return style
+
+    def compile_children(self, element: ET.Element) -> List:
+        nodes = []
+        for child in element:
+            node = self.compile_element(child)
+            if node is not None:
+                nodes.append(node)
+        return nodes
+
+    def formatting(self, element: ET.Element) -> _Formatting:
+        return _Formatting(element, self.style.terms if self.style.terms else {"open-quote": "“", "close-quote": "”"})
+
+    def compile_element(self, element: ET.Element):
+        tag = self._tag(element)
+        attrib = element.attrib
+        if tag == "text":
+            formatting = self.formatting(element)
+            if "macro" in attrib:
+                node = _Text("macro", attrib["macro"], "", "", formatting)
+                node.macro = self.style.macros.get(attrib["macro"])
+                if node.macro is None:
+                    raise CslError(f"宏 {attrib['macro']} 未定义")
+                return node
+            if "term" in attrib:
+                value = self.term(attrib["term"], attrib.get("form", "long"))
+                plural = "multiple" if attrib.get("plural") == "true" else "single"
+                return _Text("term", value, attrib.get("form", "long"), plural, formatting)
+            if "value" in attrib:
+                return _Text("value", escape(attrib["value"], quote=False), "", "", formatting)
+            if "variable" in attrib:
+                if attrib["variable"] == "citation-number":
+                    self.style.uses_citation_number = True
+                return _Text("variable", attrib["variable"], attrib.get("form", "long"), "", formatting)
+            return None
+        if tag == "group":
+            return _Group(self.compile_children(element), attrib.get("delimiter", ""), self.formatting(element))
+        if tag == "choose":
+            branches = []
+            for branch in element:
+                branch_tag = self._tag(branch)
+                if branch_tag == "else":
+                    condition = None
+                else:
+                    tests = []
+                    for kind in _CONDITIONS:
+                        for value in branch.get(kind, "").split():
+                            tests.append((kind, value))
+                    condition = _Condition(branch.get("match", "all"), tests)
+                branches.append((condition, self.compile_children(branch)))
+            return _Choose(branches)
+        if tag == "names":
+            return self.compile_names(element)
+        if tag == "label":
+            return self.compile_label(element, attrib.get("variable", ""))
+        if tag == "date":
+            return self.compile_date(element)
+        if tag == "number":
+            return _Number(attrib.get("variable", ""), attrib.get("form", "numeric"), self.formatting(element))
+        return None
+
+    def compile_label(self, element: ET.Element, variable: str) -> _Label:
+        form = element.get("form", "long")
+        # 只需要定位词, 编号变量和角色的术语
+        names = set(_NUMBER_LABELS.values()) | NAME_VARIABLES | _LOCATOR_TERMS | {"editortranslator"}
+        terms = {name: self.term(name, form) for name in names}
+        return _Label(variable, terms, element.get("plural", "contextual"), self.formatting(element))
+
+    def compile_names(self, element: ET.Element, parent: _Names | None = None) -> _Names:
+        node = _Names(element.get("variable", "").split(), element.get("delimiter", ""), self.formatting(element))
+        seen_name = False
+        for child in element:
+            tag = self._tag(child)
+            if tag == "name":
+                options = {name: child.get(name) for name in _INHERITED_NAME_OPTIONS if child.get(name) is not None}
+                node.name = _Name(options, (self.term("and")[0], "&"), self.formatting(child))
+                seen_name = True
+            elif tag == "et-al":
+                term = child.get("term", "et-al")
+                node.et_al = _EtAl(escape(self.term(term)[0], quote=False), self.formatting(child))
+            elif tag == "label":
+                node.label = self.compile_label(child, "")
+                node.label_first = not seen_name
+            elif tag == "substitute":
+                for substitute_child in child:
+                    if self._tag(substitute_child) == "names":
+                        node.substitute.append(self.compile_names(substitute_child, node))
+                    else:
+                        compiled = self.compile_element(substitute_child)
+                        if compiled is not None:
+                            node.substitute.append(compiled)
+        if parent is not None and len(element) == 0:
+            # substitute 中没有子元素的 names 沿用外层的 name, et-al 和 label
+            node.name, node.et_al = parent.name, parent.et_al
+            node.label, node.label_first = parent.label, parent.label_first
+            if not node.delimiter:
+                node.delimiter = parent.delimiter
+        if node.name is None:
+            node.name = _Name({}, (self.term("and")[0], "&"), self.formatting(ET.Element("name")))
+        return node
+
+    def compile_date(self, element: ET.Element) -> _Date:
+        form = element.get("form")
+        overrides = {part.get("name"): part for part in element.findall(f"{CSL_NS}date-part")}
+        parts = []
+        if form in self.dates:
+            # 本地化日期, 按 date-parts 截取, 子元素只覆盖形式和格式
+            wanted = {"year-month-day": ("year", "month", "day"), "year-month": ("year", "month"), "year": ("year",)}
+            allowed = wanted[element.get("date-parts", "year-month-day")]
+            delimiter, locale_parts = self.dates[form]
+            for locale_part in locale_parts:
+                name = locale_part["name"]
+                if name not in allowed:
+                    continue
+                attributes = {"form": "numeric" if name == "day" else "long", **locale_part}
+                override = overrides.get(name)
+                if override is not None:
+                    # 本地化日期的前后缀不能覆盖
+                    for key, value in override.attrib.items():
+                        if key not in ("prefix", "suffix", "name"):
+                            attributes[key] = value
+                part_element = ET.Element("date-part", attributes)
+                parts.append(
+                    _DatePart(
+                        name,
+                        attributes["form"],
+                        self.formatting(part_element),
+                        attributes.get("range-delimiter", "–"),
+                    )
+                )
+            # 截取后最后一部分的后缀 (例如 "May 5, " 中的 ", ") 不再需要
+            if parts:
+                last = parts[-1].formatting
+                last.suffix = last.suffix if last.suffix.strip() not in (",", "/", "") else ""
+        else:
+            for part in element.findall(f"{CSL_NS}date-part"):
+                name = part.get("name")
+                default_form = "numeric" if name == "day" else "long"
+                parts.append(
+                    _DatePart(
+                        name,
+                        part.get("form", default_form),
+                        self.formatting(part),
+                        part.get("range-delimiter", "–"),
+                    )
+                )
+            delimiter = element.get("delimiter", "")
+        return _Date(element.get("variable", ""), parts, delimiter, self.formatting(element))
+
+
+def compile_style(path: str, digest: str = "") -> CslStyle:
+    """解析并编译 CSL 文件"""
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError) as e:
+        raise CslError(f"样式 {path} 解析失败: {e}") from e
+    if root.tag != f"{CSL_NS}style":
+        raise CslError(f"{path} 不是 CSL 样式")
+    style = CslStyle(path, digest)
+    # 术语先于节点编译, 引号等格式需要用到
+    compiler = _Compiler(root, style)
+    style.terms = {name: value[0] for (name, form), value in compiler.terms.items() if form == "long"}
+    return compiler.compile()
+
+
+# 当前进程中已加载的样式 {(路径, 哈希): 样式}, 常驻进程中多次编译共用渲染缓存
+_LOADED_STYLES: Dict[Tuple[str, str], CslStyle] = {}
+
+
+def load_style(path: str, cache_dir: str | None = None) -> CslStyle:
+    """
+    读取样式, 样式文件没有变化时使用缓存的编译结果
+
+    Args:
+        path: .csl 文件路径
+        cache_dir: 缓存目录, 编译结果保存为 csl/<样式名>-<哈希>.pickle, 为 None 时不缓存
+    """
+    if os.path.isfile(path) is False:
+        raise CslError(f"样式 {path} 不存在")
+
+    manifest = FileHashManifest(os.path.join(cache_dir, "csl_manifest.json") if cache_dir else None)
+    stat = os.stat(path)
+    digest = manifest.lookup(path, stat)
+    if digest is None:
+        digest = calculate_file_hash_code(path)
+        if digest is None:
+            raise CslError(f"样式 {path} 读取失败")
+        manifest.update(path, digest, stat)
+        manifest.save()
+
+    style = _LOADED_STYLES.get((path, digest))
+    if style is not None:
+        return style
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, "csl", f"{name}-{digest[:16]}.pickle") if cache_dir else None
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as file:
+                data = pickle.load(file)
+            if data["version"] == _COMPILER_VERSION:
+                style = data["style"]
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError, TypeError):
+            style = None  # 缓存损坏或编译器版本变化时重新编译
+
+    if style is None:
+        style = compile_style(path, digest)
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # 删除同一样式旧版本的编译结果
+            stale = re.compile(re.escape(name) + r"-[0-9a-f]{16}\.pickle")
+            for file_name in os.listdir(os.path.dirname(cache_path)):
+                if stale.fullmatch(file_name):
+                    os.remove(os.path.join(os.path.dirname(cache_path), file_name))
+            temp_path = cache_path + ".tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump({"version": _COMPILER_VERSION, "style": style}, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+
+    style.path = path
+    _LOADED_STYLES[(path, digest)] = style
+    return style
+
+
+def resolve_style_path(style: str, styles_dir: str) -> str:
+    """样式名 (例如 apa) 或 .csl 文件路径"""
+    if style.endswith(".csl"):
+        return style if os.path.isabs(style) else os.path.join(styles_dir, style)
+    return os.path.join(styles_dir, style + ".csl")
+
+
+if __name__ == "__main__":
+    from zotero_library import ZoteroLibrary, ZoteroError
+
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="用 CSL 样式渲染 Zotero 文献库中的条目")
+    arg_parser.add_argument("style", help="样式名, 例如 apa, 或 .csl 文件路径")
+    arg_parser.add_argument("citekeys", nargs="*", help="引用键, 为空时渲染全部条目")
+    arg_parser.add_argument("--text", action="store_true", help="输出纯文本")
+    arg_parser.add_argument("--styles", default=os.path.join(root_dir, "zotero", "styles"), help="样式目录")
+    arg_parser.add_argument("--db", default=os.path.join(root_dir, "zotero", "zotero.sqlite"), help="zotero.sqlite 路径")
+    arg_parser.add_argument("--cache", default=os.path.join(root_dir, ".cache", "zotero"), help="缓存目录")
+    args = arg_parser.parse_args()
+
+    try:
+        start_time = time.perf_counter()
+        csl_style = load_style(resolve_style_path(args.style, args.styles), args.cache)
+        load_elapsed = time.perf_counter() - start_time
+        library_items = ZoteroLibrary(args.db, cache_dir=args.cache).load()
+    except (CslError, ZoteroError) as e:
+        print(e)
+        sys.exit(1)
+
+    citekeys = args.citekeys or sorted(library_items)
+    missing = [citekey for citekey in citekeys if citekey not in library_items]
+    if missing:
+        print(f"未找到文献 {', '.join(missing)}")
+    selected = [library_items[citekey] for citekey in citekeys if citekey in library_items]
+
+    start_time = time.perf_counter()
+    entries = csl_style.render_bibliography(selected)
+    render_elapsed = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    csl_style.render_bibliography(selected)
+    cached_elapsed = time.perf_counter() - start_time
+
+    print(csl_style.title)
+    for citekey, html in entries:
+        print(f"    {html_to_text(html) if args.text else html}")
+    if selected and csl_style.layouts["citation"] is not None:
+        citation = csl_style.render_citation(selected)
+        print(f"引用: {html_to_text(citation) if args.text else citation}")
+    print(
+        f"读取样式 {load_elapsed * 1000:.1f} ms, 渲染 {len(entries)} 条 {render_elapsed * 1000:.1f} ms, "
+        f"再次渲染 (缓存) {cached_elapsed * 1000:.2f} ms"
+    )
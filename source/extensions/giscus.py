@@ -1,87 +1,191 @@
 # extensions/giscus.py
+"""giscus 评论扩展
+
+评论区的 HTML 在 config-inited 时按配置生成一次, 之后每个页面直接复用;
+指令只在文档中留下一个占位节点, 输出 HTML 时替换为评论区, 指令带选项时才按模板重新填充.
+giscus.css 只添加到有评论区的页面.
+
+配置 (conf.py):
+    giscus_repo = 'owner/repo'                 # 评论仓库
+    giscus_repo_id = 'R_xxx'                   # 仓库 ID, 从 https://giscus.app 获取
+    giscus_category = 'Announcements'          # 分类名
+    giscus_category_id = 'DIC_xxx'             # 分类 ID
+    giscus_auto_inject = False                 # 为 True 时所有页面末尾自动添加评论区, 不需要写指令
+    其余 giscus_mapping, giscus_theme 等见 setup
+
+在文档开头添加 :nogiscus: 字段可以让该页面不自动添加评论区.
+"""
+
+import os
+from html import escape
+from string import Template
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
 from sphinx.application import Sphinx
+from sphinx.errors import ConfigError
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# 选项名 -> (配置名, 允许的值), 允许的值为 None 时不检查
+OPTIONS = {
+    'mapping': ('giscus_mapping', {'pathname', 'url', 'title', 'og:title', 'specific', 'number'}),
+    'reactions': ('giscus_reactions', {'0', '1'}),
+    'metadata': ('giscus_metadata', {'0', '1'}),
+    'position': ('giscus_position', {'top', 'bottom'}),
+    'theme': ('giscus_theme', None),
+    'lang': ('giscus_lang', None),
+    'loading': ('giscus_loading', {'lazy', 'eager'}),
+}
+
+EMBED_TEMPLATE = Template('''
+<div class="giscus-container" style="margin-top: 3rem; padding-top: 2rem; border-top: 1px solid #e1e4e8;">
+    <script src="https://giscus.app/client.js"
+            data-repo="$repo"
+            data-repo-id="$repo_id"
+            data-category="$category"
+            data-category-id="$category_id"
+            data-mapping="$mapping"
+            data-strict="0"
+            data-reactions-enabled="$reactions"
+            data-emit-metadata="$metadata"
+            data-input-position="$position"
+            data-theme="$theme"
+            data-lang="$lang"
+            data-loading="$loading"
+            crossorigin="anonymous"
+            async>
+    </script>
+</div>
+''')
+
+
+def check_option(name, value):
+    """检查选项的值, 不合法时返回错误信息"""
+    allowed = OPTIONS[name][1]
+    if allowed is not None and value not in allowed:
+        return f'giscus 选项 {name} 的值 {value!r} 不合法, 可选值: {", ".join(sorted(allowed))}'
+    return None
+
+
+class GiscusEmbed:
+    """按配置生成的评论区 HTML, 每次编译只生成一次"""
+
+    def __init__(self, config):
+        missing = [name for name in ('giscus_repo', 'giscus_repo_id', 'giscus_category_id') if not config[name]]
+        if missing:
+            # 缺少仓库配置时不输出评论区, 不影响编译
+            logger.warning(f'giscus 配置缺少 {", ".join(missing)}, 不输出评论区')
+            self.enabled = False
+        else:
+            self.enabled = True
+        if config.giscus_repo and config.giscus_repo.count('/') != 1:
+            raise ConfigError(f'giscus_repo 应为 owner/repo 格式: {config.giscus_repo!r}')
+
+        self.values = {
+            'repo': config.giscus_repo,
+            'repo_id': config.giscus_repo_id,
+            'category': config.giscus_category,
+            'category_id': config.giscus_category_id,
+        }
+        for name, (config_name, _) in OPTIONS.items():
+            value = str(config[config_name])
+            error = check_option(name, value)
+            if error is not None:
+                raise ConfigError(error)
+            self.values[name] = value
+
+        self.html = self._substitute(self.values) if self.enabled else ''
+
+    @staticmethod
+    def _substitute(values):
+        return EMBED_TEMPLATE.substitute({key: escape(value) for key, value in values.items()})
+
+    def render(self, options):
+        """生成评论区 HTML, 没有选项时返回预先生成的结果"""
+        if not options or not self.enabled:
+            return self.html
+        return self._substitute({**self.values, **options})
+
+
+class giscus_comments(nodes.General, nodes.Element):
+    """评论区占位节点, node['options'] 保存指令选项"""
+
 
 class GiscusComments(Directive):
     """添加 giscus 评论的指令
-    
+
     用法:
     .. giscus::
-    
+
     或自定义主题:
     .. giscus::
        :theme: dark
-       
+
     或自定义语言:
     .. giscus::
        :lang: en
-       
+
     或禁用反应:
     .. giscus::
        :reactions: 0
     """
-    
-    option_spec = {
-        'mapping': directives.unchanged,
-        'reactions': directives.unchanged,
-        'metadata': directives.unchanged,
-        'position': directives.unchanged,
-        'theme': directives.unchanged,
-        'lang': directives.unchanged,
-        'loading': directives.unchanged,
-    }
-    
+
+    option_spec = {name: directives.unchanged for name in OPTIONS}
+
     def run(self):
-        # 获取 Sphinx 应用配置
-        app = self.state.document.settings.env.app
-        config = app.config
-        
-        # 使用配置或选项中的值（选项优先）
-        mapping = self.options.get('mapping', getattr(config, 'giscus_mapping', 'pathname'))
-        reactions = self.options.get('reactions', getattr(config, 'giscus_reactions', '1'))
-        metadata = self.options.get('metadata', getattr(config, 'giscus_metadata', '0'))
-        position = self.options.get('position', getattr(config, 'giscus_position', 'bottom'))
-        theme = self.options.get('theme', getattr(config, 'giscus_theme', 'light'))
-        lang = self.options.get('lang', getattr(config, 'giscus_lang', 'zh-CN'))
-        loading = self.options.get('loading', getattr(config, 'giscus_loading', 'lazy'))
-        
-        # 你的固定配置
-        repo = "gaosiyan/Discussions"
-        repo_id = "R_kgDOPbjS8g"
-        
-        # 注意：你需要设置正确的分类名和分类ID
-        # 可以从 https://giscus.app 获取，或者从你的仓库 Discussions 设置中获取
-        category = getattr(config, 'giscus_category', 'Announcements')
-        category_id = getattr(config, 'giscus_category_id', '')
-        
-        # 构建 HTML
-        html = f'''
-<div class="giscus-container" style="margin-top: 3rem; padding-top: 2rem; border-top: 1px solid #e1e4e8;">
-    <script src="https://giscus.app/client.js"
-            data-repo="{repo}"
-            data-repo-id="{repo_id}"
-            data-category="{category}"
-            data-category-id="{category_id}"
-            data-mapping="{mapping}"
-            data-strict="0"
-            data-reactions-enabled="{reactions}"
-            data-emit-metadata="{metadata}"
-            data-input-position="{position}"
-            data-theme="{theme}"
-            data-lang="{lang}"
-            data-loading="{loading}"
-            crossorigin="anonymous"
-            async>
-    </script>
-</div>
-'''
-        return [nodes.raw('', html, format='html')]
+        # 只记录与配置不同的选项, 输出时使用预先生成的 HTML
+        for name, value in self.options.items():
+            error = check_option(name, value)
+            if error is not None:
+                raise self.error(error)
+        return [giscus_comments(options=dict(self.options))]
+
+
+def visit_giscus_html(self, node):
+    self.body.append(self.builder.app.giscus_embed.render(node['options']))
+    raise nodes.SkipNode
+
+
+def skip_giscus(self, node):
+    raise nodes.SkipNode
+
+
+def on_config_inited(app, config):
+    """检查配置, 生成评论区 HTML"""
+    app.giscus_embed = GiscusEmbed(config)
+
+    # giscus.css 不存在时不添加, 避免页面引用不存在的文件
+    app.giscus_css_file = None
+    if config.giscus_css_file:
+        for static_path in config.html_static_path:
+            if os.path.isfile(os.path.join(app.confdir, static_path, config.giscus_css_file)):
+                app.giscus_css_file = config.giscus_css_file
+                break
+
+
+def on_html_page_context(app, pagename, templatename, context, doctree):
+    """只在有评论区的页面添加样式, 开启 giscus_auto_inject 时在页面末尾添加评论区"""
+    if doctree is None or not app.giscus_embed.enabled:
+        return  # 搜索, 索引等生成的页面
+
+    has_directive = next(iter(doctree.findall(giscus_comments)), None) is not None
+    if not has_directive:
+        if not app.config.giscus_auto_inject or 'nogiscus' in app.env.metadata.get(pagename, {}):
+            return
+        if 'body' in context:
+            context['body'] += app.giscus_embed.html
+
+    if app.giscus_css_file:
+        app.add_css_file(app.giscus_css_file)
+
 
 def setup(app: Sphinx):
     """设置 Sphinx 扩展"""
-    
+
     # 添加配置项（可在 conf.py 中覆盖）
+    app.add_config_value('giscus_repo', '', 'html')
+    app.add_config_value('giscus_repo_id', '', 'html')
     app.add_config_value('giscus_category', 'Announcements', 'html')
     app.add_config_value('giscus_category_id', '', 'html')
     app.add_config_value('giscus_mapping', 'pathname', 'html')
@@ -91,15 +195,25 @@ def setup(app: Sphinx):
     app.add_config_value('giscus_theme', 'light', 'html')
     app.add_config_value('giscus_lang', 'zh-CN', 'html')
     app.add_config_value('giscus_loading', 'lazy', 'html')
-    
-    # 注册指令
+    app.add_config_value('giscus_auto_inject', False, 'html')
+    app.add_config_value('giscus_css_file', 'giscus.css', 'html')
+
+    # 注册指令和节点, 非 HTML 输出时忽略评论区
     app.add_directive("giscus", GiscusComments)
-    
-    # 添加 CSS 样式
-    app.add_css_file('giscus.css')
-    
+    app.add_node(
+        giscus_comments,
+        html=(visit_giscus_html, None),
+        latex=(skip_giscus, None),
+        text=(skip_giscus, None),
+        man=(skip_giscus, None),
+        texinfo=(skip_giscus, None),
+    )
+
+    app.connect('config-inited', on_config_inited)
+    app.connect('html-page-context', on_html_page_context)
+
     return {
-        'version': '0.1',
+        'version': '0.2',
         'parallel_read_safe': True,
         'parallel_write_safe': True,
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: image_index.py
+文件作者: gaosiyan
+创建时间: 20260112
+功能说明: 图片引用双向索引扩展, 图片 -> 文档 和 文档 -> 图片
+
+索引挂在 env 上, 随 environment.pickle 一起保存, 由 env-purge-doc / doctree-read 事件增量维护,
+每次编译结束后另存一份 JSON 到 doctrees 目录, 不启动 Sphinx 的脚本也可以直接查询.
+
+用法:
+    from extensions.image_index import ImageIndex
+
+    index = ImageIndex.load("build/doctrees/image_index.json")
+    index.get_documents("_static/images/1.png")  # 删除这张图片会影响哪些文档
+    index.find_orphans(["_static/images/1.png", "_static/images/2.png"])  # 没有被引用的图片
+"""
+
+import os
+import json
+from typing import Dict, Iterable, List, Set
+from docutils import nodes
+from sphinx.application import Sphinx
+
+# 索引文件名, 保存在 doctrees 目录
+INDEX_FILE_NAME = "image_index.json"
+
+# 索引文件格式版本, 结构变化时递增, 旧文件视为不存在
+_INDEX_VERSION = 1
+
+
+class ImageIndex:
+    """
+    图片引用双向索引, 图片路径与 env.images 的键一致, 是相对 source 目录的路径, 例如 _static/images/1.png
+    """
+
+    def __init__(self) -> None:
+        self.image_to_docs: Dict[str, Set[str]] = {}
+        self.doc_to_images: Dict[str, Set[str]] = {}
+
+    def add_document(self, docname: str, image_paths: Iterable[str]) -> None:
+        """记录文档引用的图片, 覆盖该文档之前的记录"""
+        self.purge_document(docname)
+        image_paths = set(image_paths)
+        if not image_paths:
+            return
+
+        self.doc_to_images[docname] = image_paths
+        for image_path in image_paths:
+            self.image_to_docs.setdefault(image_path, set()).add(docname)
+
+    def purge_document(self, docname: str) -> None:
+        """删除文档的记录"""
+        for image_path in self.doc_to_images.pop(docname, ()):
+            docs = self.image_to_docs.get(image_path)
+            if docs is not None:
+                docs.discard(docname)
+                if not docs:
+                    del self.image_to_docs[image_path]
+
+    def merge(self, other: "ImageIndex", docnames: Iterable[str]) -> None:
+        """合并并行读取时子进程中 docnames 的记录"""
+        for docname in docnames:
+            self.add_document(docname, other.doc_to_images.get(docname, ()))
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """图片重命名后同步更新索引"""
+        docs = self.image_to_docs.pop(old_path, None)
+        if docs is None:
+            return
+
+        self.image_to_docs.setdefault(new_path, set()).update(docs)
+        for docname in docs:
+            images = self.doc_to_images[docname]
+            images.discard(old_path)
+            images.add(new_path)
+
+    def get_documents(self, image_path: str) -> Set[str]:
+        """引用该图片的文档, 即删除该图片后会出错的文档"""
+        return self.image_to_docs.get(image_path, set())
+
+    def get_images(self, docname: str) -> Set[str]:
+        """文档引用的图片"""
+        return self.doc_to_images.get(docname, set())
+
+    def is_used(self, image_path: str) -> bool:
+        """图片是否被文档引用"""
+        return image_path in self.image_to_docs
+
+    def find_orphans(self, image_paths: Iterable[str]) -> List[str]:
+        """返回 image_paths 中没有被任何文档引用的图片"""
+        return [image_path for image_path in image_paths if image_path not in self.image_to_docs]
+
+    @classmethod
+    def from_env_images(cls, images) -> "ImageIndex":
+        """
+        从 env.images 构建索引, env.images 结构如下:
+        {'_static/1.png': ({'sphinx/基础教程', 'sphinx/项目部署'}, '1.png')}
+        """
+        index = cls()
+        for image_path, (docnames, _) in images.items():
+            for docname in docnames:
+                index.doc_to_images.setdefault(docname, set()).add(image_path)
+            index.image_to_docs[image_path] = set(docnames)
+        return index
+
+    @classmethod
+    def load(cls, index_path: str) -> "ImageIndex | None":
+        """从 JSON 文件加载索引, 文件不存在, 损坏或版本不一致时返回 None"""
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("version") != _INDEX_VERSION:
+            return None
+
+        index = cls()
+        for docname, image_paths in data["documents"].items():
+            index.add_document(docname, image_paths)
+        return index
+
+    def save(self, index_path: str) -> None:
+        """保存为 JSON 文件, 内容没有变化时不回写"""
+        data = {
+            "version": _INDEX_VERSION,
+            "images": {image_path: sorted(docs) for image_path, docs in sorted(self.image_to_docs.items())},
+            "documents": {docname: sorted(images) for docname, images in sorted(self.doc_to_images.items())},
+        }
+        text = json.dumps(data, ensure_ascii=False, indent=1)
+
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                if file.read() == text:
+                    return
+        except OSError:
+            pass
+
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temp_path, index_path)
+
+
+def get_image_index(app: Sphinx) -> ImageIndex:
+    """返回 env 上的索引, 新建的 env 或旧版本的 env 从 env.images 重建"""
+    env = app.env
+    index = getattr(env, "image_index", None)
+    if index is None:
+        index = ImageIndex.from_env_images(env.images)
+        env.image_index = index
+    return index
+
+
+def _collect_image_paths(doctree: nodes.document) -> Set[str]:
+    """
+    收集文档中的本地图片路径
+
+    内置的 ImageCollector 同样在 doctree-read 中运行并且先于扩展注册, 此时 candidates 已是相对 source 目录的路径,
+    "?" 对应远程图片, 不属于本地图片
+    """
+    image_paths = set()
+    for node in doctree.findall(nodes.image):
+        for mimetype, image_path in node.get("candidates", {}).items():
+            if mimetype != "?":
+                image_paths.add(image_path)
+    return image_paths
+
+
+def _on_env_purge_doc(app: Sphinx, env, docname: str) -> None:
+    get_image_index(app).purge_document(docname)
+
+
+def _on_doctree_read(app: Sphinx, doctree: nodes.document) -> None:
+    get_image_index(app).add_document(app.env.docname, _collect_image_paths(doctree))
+
+
+def _on_env_merge_info(app: Sphinx, env, docnames: Set[str], other) -> None:
+    other_index = getattr(other, "image_index", None)
+    if other_index is not None:
+        get_image_index(app).merge(other_index, docnames)
+
+
+def _on_build_finished(app: Sphinx, exception: Exception | None) -> None:
+    if exception is None:
+        get_image_index(app).save(os.path.join(app.doctreedir, INDEX_FILE_NAME))
+
+
+def setup(app: Sphinx):
+    """设置 Sphinx 扩展"""
+
+    app.connect("env-purge-doc", _on_env_purge_doc)
+    app.connect("doctree-read", _on_doctree_read)
+    app.connect("env-merge-info", _on_env_merge_info)
+    app.connect("build-finished", _on_build_finished)
+
+    return {
+        "version": "0.1",
+        "env_version": _INDEX_VERSION,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
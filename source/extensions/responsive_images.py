@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: responsive_images.py
+文件作者: gaosiyan
+创建时间: 20260113
+功能说明: 响应式图片扩展, 把 image_optimizer 生成的变体输出为 <picture> + srcset
+
+页面中的 <img src="../_images/1.png"> 改写为:
+<picture>
+    <source type="image/avif" srcset="../_images/variants/1-480w.avif 480w, ..." sizes="...">
+    <source type="image/webp" srcset="../_images/variants/1-480w.webp 480w, ..." sizes="...">
+    <img src="../_images/1.png" loading="lazy" ...>
+</picture>
+
+没有处理记录的图片原样输出. 编译结束后把用到的变体和无损重新压缩的 PNG 复制到输出目录.
+
+配置:
+    responsive_images_dir = "../.cache/images"  # image_optimizer 的输出目录, 为空时不启用
+    responsive_images_sizes = "(max-width: 960px) 100vw, 960px"
+"""
+
+import os
+import re
+import json
+import shutil
+from typing import Dict, Set
+from sphinx.application import Sphinx
+
+from extensions.image_index import get_image_index
+
+# 与 image_optimizer.VARIANTS_FILE_NAME 一致, 扩展不依赖 Pillow, 因此不导入 image_optimizer
+VARIANTS_FILE_NAME = "variants.json"
+
+_MIME_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+# 优先级高的格式在前, 浏览器使用第一个支持的 <source>
+_FORMAT_ORDER = ("avif", "webp")
+
+# Sphinx 输出的图片都在 _images 目录中, 捕获 src 的目录前缀和文件名
+_IMG_PATTERN = re.compile(r'<img\b(?P<before>[^>]*?)\bsrc="(?P<prefix>[^"]*?_images/)(?P<name>[^"/]+)"(?P<after>[^>]*?)/?>')
+
+_records: Dict[str, dict] = {}
+
+
+def _load_records(app: Sphinx) -> Dict[str, dict]:
+    """读取 image_optimizer 的处理记录"""
+    records_dir = app.config.responsive_images_dir
+    if not records_dir:
+        return {}
+
+    try:
+        with open(os.path.join(records_dir, VARIANTS_FILE_NAME), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _on_env_get_outdated(app: Sphinx, env, added: Set[str], changed: Set[str], removed: Set[str]):
+    """
+    每次编译开始时重新读取处理记录, 引用了新处理的图片的文档需要重新输出页面
+    """
+    global _records
+    _records = _load_records(app)
+
+    known = getattr(env, "responsive_image_digests", {})
+    current = {name: record["digest"] for name, record in _records.items()}
+    env.responsive_image_digests = current
+
+    updated_names = {name for name in current.keys() | known.keys() if current.get(name) != known.get(name)}
+    if not updated_names:
+        return []
+
+    docnames = set()
+    for image_path, docs in get_image_index(app).image_to_docs.items():
+        if os.path.basename(image_path) in updated_names:
+            docnames.update(docs)
+    return sorted(docnames - removed)
+
+
+def _build_picture(match: re.Match, sizes: str) -> str:
+    """把一个 <img> 改写为 <picture>"""
+    record = _records.get(match.group("name"))
+    if record is None or not record["variants"]:
+        return match.group()
+
+    prefix = match.group("prefix")
+    sources = []
+    for format in _FORMAT_ORDER:
+        variants = [variant for variant in record["variants"] if variant["format"] == format]
+        if variants:
+            srcset = ", ".join(f'{prefix}variants/{variant["file"]} {variant["width"]}w' for variant in variants)
+            sources.append(f'<source type="{_MIME_TYPES[format]}" srcset="{srcset}" sizes="{sizes}">')
+
+    before, after = match.group("before"), match.group("after")
+    attributes = before + after
+    extra = ""
+    if "loading=" not in attributes:
+        extra += ' loading="lazy"'
+    if "width=" not in attributes and "height=" not in attributes and "style=" not in attributes:
+        # 写明原始尺寸, 图片加载前就能占好位置, 避免页面跳动
+        extra += f' width="{record["width"]}" height="{record["height"]}"'
+
+    img = f'<img{before}src="{prefix}{match.group("name")}"{after.rstrip()}{extra} />'
+    return "<picture>" + "".join(sources) + img + "</picture>"
+
+
+def _on_html_page_context(app: Sphinx, pagename: str, templatename: str, context: dict, doctree) -> None:
+    if not _records or "body" not in context:
+        return
+
+    sizes = app.config.responsive_images_sizes
+    context["body"] = _IMG_PATTERN.sub(lambda match: _build_picture(match, sizes), context["body"])
+
+
+def _copy_if_needed(src: str, dest: str) -> None:
+    """目标文件大小不同时才复制"""
+    if os.path.isfile(dest) and os.path.getsize(dest) == os.path.getsize(src):
+        return
+    shutil.copyfile(src, dest)
+
+
+def _on_build_finished(app: Sphinx, exception: Exception | None) -> None:
+    """复制变体, 用无损重新压缩的 PNG 覆盖 Sphinx 复制的原图"""
+    if exception is not None or not _records or app.builder.format != "html":
+        return
+
+    records_dir = app.config.responsive_images_dir
+    images_dir = os.path.join(app.outdir, "_images")
+    variants_dir = os.path.join(images_dir, "variants")
+    if os.path.isdir(images_dir) is False:
+        return
+
+    os.makedirs(variants_dir, exist_ok=True)
+    for name in os.listdir(images_dir):
+        record = _records.get(name)
+        if record is None:
+            continue
+
+        if record["png"] is not None:
+            _copy_if_needed(os.path.join(records_dir, record["png"]), os.path.join(images_dir, name))
+        for variant in record["variants"]:
+            _copy_if_needed(os.path.join(records_dir, variant["file"]), os.path.join(variants_dir, variant["file"]))
+
+
+def setup(app: Sphinx):
+    """设置 Sphinx 扩展"""
+
+    app.add_config_value("responsive_images_dir", "", "html")
+    app.add_config_value("responsive_images_sizes", "(max-width: 960px) 100vw, 960px", "html")
+
+    app.connect("env-get-outdated", _on_env_get_outdated)
+    app.connect("html-page-context", _on_html_page_context)
+    app.connect("build-finished", _on_build_finished)
+
+    return {
+        "version": "0.1",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
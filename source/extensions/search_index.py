@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: search_index.py
+文件作者: gaosiyan
+创建时间: 20260117
+功能说明: 中文搜索索引扩展, 缓存 jieba 分词结果, 把 searchindex.js 拆分为按需加载的分片
+
+html_search_language = 'zh' 时 Sphinx 用 jieba 对每篇文档分词, 生成一个完整的 searchindex.js,
+浏览器必须下载并解析整个文件后才能开始第一次搜索. 本扩展做三件事:
+
+1. 分词缓存: 按文档内容哈希缓存分词结果, 跨编译保存在 search_segment_cache 文件中,
+   内容没有变化的文档 (例如因为目录变化被重新输出) 不再调用 jieba;
+2. 分片索引: 完整索引保存在 doctrees 目录中, 供 Sphinx 增量编译加载;
+   输出目录中的 searchindex.js 只包含文档列表和标题, 词条按首字符拆分为 search_shard_count 个分片,
+   搜索页面只加载查询词所在的分片, 其余分片在第一次搜索后后台加载, 用于部分匹配;
+3. 词典预加载: 同一进程中 jieba 词典只加载一次, 并推迟到第一次真正分词时加载,
+   分词缓存全部命中时不加载词典.
+
+配置:
+    search_segment_cache = "../.cache/search_segments.pickle"  # 分词缓存文件, 为空时不缓存
+    search_shard_count = 64  # 分片数, 为 0 时不拆分, 输出 Sphinx 原始的 searchindex.js
+    search_jieba_preload = True  # 同一进程中只加载一次 jieba 词典
+"""
+
+import os
+import json
+import pickle
+from hashlib import sha1
+from typing import Dict, List
+from sphinx.application import Sphinx
+from sphinx.search import js_index
+from sphinx.util import logging
+
+try:
+    # Sphinx 的内部接口, 不存在时不缓存分词结果
+    from sphinx.search import WordStore, _feed_visit_nodes
+except ImportError:
+    WordStore = None
+
+logger = logging.getLogger(__name__)
+
+# 完整索引在 doctrees 目录中的文件名, 与 environment.pickle 一起保存
+FULL_INDEX_FILE_NAME = "searchindex.js"
+
+# 输出目录中分片和加载脚本所在的目录
+SHARD_DIR = "_static/search"
+
+_CACHE_VERSION = 1
+
+# 搜索页面加载的脚本, 在 Search.query 之前加载查询词所在的分片
+_LOADER_SCRIPT = """\
+(function () {
+    const base = new URL(".", document.currentScript.src);
+    const shardCount = %(shard_count)d;
+    const loading = new Map();
+
+    const loadShard = (id) => {
+        if (!loading.has(id)) {
+            loading.set(id, new Promise((resolve) => {
+                const script = document.createElement("script");
+                script.src = new URL("terms-" + id + ".js", base);
+                script.onload = resolve;
+                script.onerror = resolve;  // 分片加载失败时仍然执行搜索
+                document.body.appendChild(script);
+            }));
+        }
+        return loading.get(id);
+    };
+
+    Search.addShard = (shard) => {
+        Object.assign(Search._index.terms, shard.terms);
+        Object.assign(Search._index.titleterms, shard.titleterms);
+    };
+
+    const query = Search.query;
+    Search.query = (text) => {
+        const ids = new Set();
+        splitQuery(text.toLowerCase().trim()).forEach((term) => {
+            term = term.replace(/^-/, "");
+            if (term) ids.add(term.codePointAt(0) %% shardCount);
+        });
+        Promise.all([...ids].map(loadShard)).then(() => {
+            query(text);
+            // 部分匹配需要全部词条, 第一次搜索后在后台加载其余分片
+            for (let id = 0; id < shardCount; id++) loadShard(id);
+        });
+    };
+})();
+"""
+
+
+def shard_of(term: str, shard_count: int) -> int:
+    """词条所在的分片, 与加载脚本中的 codePointAt(0) % shardCount 一致"""
+    return ord(term[0]) % shard_count
+
+
+def load_jieba_dictionary_once() -> None:
+    """
+    同一进程中只加载一次 jieba 词典, 并推迟到第一次分词时加载
+
+    中文搜索每次编译都会调用 jieba.load_userdict 把词典重新加载一遍, 逐词 add_word 数十万次, 耗时数秒;
+    并且重复加载会累加词频总数, 同一进程中多次编译的分词结果会逐渐漂移. 常驻进程和两次编译都只需加载一次.
+    """
+    from sphinx.search import zh
+
+    if getattr(zh.jieba_load_userdict, "loaded_paths", None) is not None:
+        return
+
+    load_userdict = zh.jieba_load_userdict
+    cut_for_search = zh.cut_for_search
+    loaded_paths = set()
+    pending_paths = []
+
+    def load_userdict_once(dict_path: str) -> None:
+        if dict_path not in loaded_paths:
+            loaded_paths.add(dict_path)
+            pending_paths.append(dict_path)
+
+    def cut_for_search_loaded(sentence: str, HMM: bool = True):
+        while pending_paths:
+            load_userdict(pending_paths.pop(0))
+        return cut_for_search(sentence, HMM)
+
+    load_userdict_once.loaded_paths = loaded_paths
+    zh.jieba_load_userdict = load_userdict_once
+    zh.cut_for_search = cut_for_search_loaded
+
+
+class _Fragment:
+    """待分词的文本片段在 fragments 中的位置, 收集阶段代替分词结果占位"""
+
+    __slots__ = ("index",)
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+
+
+class SegmentCache:
+    """
+    按文档缓存分词结果 {docname: (内容哈希, words, title_words, latin_terms)}
+
+    内容哈希由文档中所有待分词的文本片段及其位置计算, 与 Sphinx 分词时看到的输入完全一致.
+    """
+
+    def __init__(self, cache_path: str, signature: tuple) -> None:
+        """
+        cache_path: 缓存文件, 为空时只在内存中缓存
+        signature: jieba 版本和搜索配置, 变化时缓存失效
+        """
+        self.cache_path = cache_path
+        self.signature = signature
+        self.documents: Dict[str, tuple] = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as file:
+                    data = pickle.load(file)
+                if data["version"] == _CACHE_VERSION and data["signature"] == signature:
+                    self.documents = data["documents"]
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+                pass  # 缓存损坏时重新分词
+
+    def collect(self, lang, docname: str, doctree) -> "WordStore":
+        """代替 IndexBuilder._word_collector, 内容没有变化时直接返回缓存的分词结果"""
+        fragments: List[str] = []
+
+        def record(text: str) -> list:
+            fragments.append(text)
+            return [_Fragment(len(fragments) - 1)]
+
+        word_store = WordStore()
+        _feed_visit_nodes(doctree, word_store=word_store, split=record, language=lang.lang)
+
+        def layout(words: list) -> list:
+            return [word.index if isinstance(word, _Fragment) else word for word in words]
+
+        key = sha1(
+            pickle.dumps((fragments, layout(word_store.words), layout(word_store.title_words)), protocol=4)
+        ).hexdigest()
+
+        entry = self.documents.get(docname)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            _, word_store.words, word_store.title_words, latin_terms = entry
+            if latin_terms:
+                lang.latin_terms.update(latin_terms)
+            return word_store
+
+        self.misses += 1
+        results = [lang.split(text) for text in fragments]
+
+        def expand(words: list) -> List[str]:
+            expanded = []
+            for word in words:
+                if isinstance(word, _Fragment):
+                    expanded.extend(results[word.index])
+                else:
+                    expanded.append(word)
+            return expanded
+
+        word_store.words = expand(word_store.words)
+        word_store.title_words = expand(word_store.title_words)
+
+        # 中文搜索的 stem 依赖 split 收集的拉丁词, 命中缓存时需要补上
+        latin_terms = ()
+        if hasattr(lang, "latin_terms"):
+            latin_terms = tuple(
+                sorted({term.strip() for text in fragments for term in lang.latin1_letters.findall(text)})
+            )
+
+        # IndexBuilder.feed 只把词条加入集合, 与顺序和重复次数无关, 缓存去重后的词条
+        self.documents[docname] = (
+            key,
+            list(dict.fromkeys(word_store.words)),
+            list(dict.fromkeys(word_store.title_words)),
+            latin_terms,
+        )
+        self._dirty = True
+        return word_store
+
+    def save(self, docnames) -> None:
+        """删除已不存在的文档后保存"""
+        removed = self.documents.keys() - set(docnames)
+        for docname in removed:
+            del self.documents[docname]
+        if not self.cache_path or (self._dirty is False and not removed):
+            return
+
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            pickle.dump(
+                {"version": _CACHE_VERSION, "signature": self.signature, "documents": self.documents},
+                file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(temp_path, self.cache_path)
+        self._dirty = False
+
+
+def _cache_signature(app: Sphinx) -> tuple:
+    try:
+        import jieba
+
+        jieba_version = jieba.__version__
+    except ImportError:
+        jieba_version = None
+    options = sorted((key, str(value)) for key, value in app.config.html_search_options.items())
+    return (jieba_version, app.config.html_search_language or app.config.language, tuple(options))
+
+
+def _full_index_path(app: Sphinx) -> str:
+    return os.path.join(app.doctreedir, FULL_INDEX_FILE_NAME)
+
+
+def _on_config_inited(app: Sphinx, config) -> None:
+    if config.search_jieba_preload:
+        load_jieba_dictionary_once()
+
+
+def _on_builder_inited(app: Sphinx) -> None:
+    builder = app.builder
+    if builder.format != "html" or getattr(builder, "search", False) is False:
+        return
+
+    if app.config.search_shard_count > 0:
+        # 完整索引保存在 doctrees 目录中, Sphinx 增量编译时从这里加载, 输出目录中只放分片
+        full_index_path = _full_index_path(app)
+        output_index_path = os.path.join(app.outdir, builder.searchindex_filename)
+        if os.path.isfile(full_index_path) is False and os.path.isfile(output_index_path):
+            # 之前未拆分时的完整索引, 迁移一次, 避免增量编译丢失未修改文档的词条
+            with open(output_index_path, "r", encoding="utf-8") as file:
+                content = file.read()
+            if '"shards":' not in content:
+                os.makedirs(app.doctreedir, exist_ok=True)
+                with open(full_index_path, "w", encoding="utf-8") as file:
+                    file.write(content)
+        builder.searchindex_filename = os.path.relpath(full_index_path, app.outdir)
+
+    if WordStore is None:
+        return
+
+    # 缓存放在 builder 上, 不随 environment.pickle 保存
+    cache = builder.search_segment_cache = SegmentCache(app.config.search_segment_cache, _cache_signature(app))
+    prepare_writing = builder.prepare_writing
+
+    def prepare_writing_with_cache(docnames) -> None:
+        prepare_writing(docnames)  # 每次编译重新创建 indexer
+        indexer = builder.indexer
+        if indexer is None:
+            return
+
+        feed = indexer.feed
+
+        def feed_with_cache(docname: str, filename, title: str, doctree) -> None:
+            indexer._word_collector = lambda doctree: cache.collect(indexer.lang, docname, doctree)
+            feed(docname, filename, title, doctree)
+
+        indexer.feed = feed_with_cache
+
+    builder.prepare_writing = prepare_writing_with_cache
+
+
+def _write_if_changed(file_path: str, content: str) -> bool:
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            if file.read() == content:
+                return False
+    except OSError:
+        pass
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(temp_path, file_path)
+    return True
+
+
+def write_shards(full_index_path: str, output_dir: str, shard_count: int) -> int:
+    """
+    把完整索引拆分为元数据和词条分片
+
+    Args:
+        full_index_path: Sphinx 输出的完整索引
+        output_dir: HTML 输出目录
+        shard_count: 分片数
+
+    Returns:
+        内容有变化的文件数
+    """
+    with open(full_index_path, "r", encoding="utf-8") as file:
+        frozen = js_index.load(file)
+
+    shards = [{"terms": {}, "titleterms": {}} for _ in range(shard_count)]
+    for field in ("terms", "titleterms"):
+        for term, docs in frozen.pop(field).items():
+            shards[shard_of(term, shard_count)][field][term] = docs
+
+    # 元数据保留 Sphinx 的格式, terms 和 titleterms 由分片填充
+    frozen["terms"], frozen["titleterms"], frozen["shards"] = {}, {}, shard_count
+    changed = _write_if_changed(os.path.join(output_dir, "searchindex.js"), js_index.dumps(frozen))
+
+    shard_dir = os.path.join(output_dir, SHARD_DIR)
+    os.makedirs(shard_dir, exist_ok=True)
+    expected = {"loader.js"}
+    changed += _write_if_changed(os.path.join(shard_dir, "loader.js"), _LOADER_SCRIPT % {"shard_count": shard_count})
+    for index, shard in enumerate(shards):
+        name = f"terms-{index}.js"
+        expected.add(name)
+        data = json.dumps(shard, separators=(",", ":"), sort_keys=True, ensure_ascii=False)
+        changed += _write_if_changed(os.path.join(shard_dir, name), f"Search.addShard({data})")
+
+    # 分片数减少后残留的分片
+    for name in os.listdir(shard_dir):
+        if name not in expected:
+            os.remove(os.path.join(shard_dir, name))
+    return changed
+
+
+def _on_html_page_context(app: Sphinx, pagename: str, templatename: str, context: dict, doctree) -> None:
+    if pagename == "search" and app.config.search_shard_count > 0:
+        # defer: 在 searchtools.js 之后, 页面 DOMContentLoaded 执行第一次搜索之前运行
+        app.add_js_file("search/loader.js", defer="defer")
+
+
+def _on_build_finished(app: Sphinx, exception: Exception | None) -> None:
+    if exception is not None or app.builder.format != "html" or getattr(app.builder, "search", False) is False:
+        return
+
+    cache = getattr(app.builder, "search_segment_cache", None)
+    if cache is not None:
+        cache.save(app.env.all_docs)
+        if cache.hits or cache.misses:
+            logger.info(f"分词缓存: 命中 {cache.hits} 篇, 重新分词 {cache.misses} 篇")
+        cache.hits = cache.misses = 0
+
+    full_index_path = _full_index_path(app)
+    if app.config.search_shard_count > 0 and os.path.isfile(full_index_path):
+        write_shards(full_index_path, app.outdir, app.config.search_shard_count)
+
+
+def setup(app: Sphinx):
+    """设置 Sphinx 扩展"""
+
+    app.add_config_value("search_segment_cache", "", "env")
+    app.add_config_value("search_shard_count", 64, "html")
+    app.add_config_value("search_jieba_preload", True, "env")
+
+    app.connect("config-inited", _on_config_inited)
+    app.connect("builder-inited", _on_builder_inited)
+    app.connect("html-page-context", _on_html_page_context)
+    app.connect("build-finished", _on_build_finished)
+
+    return {
+        "version": "0.1",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
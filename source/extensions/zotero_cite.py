@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: zotero_cite.py
+文件作者: gaosiyan
+创建时间: 20260118
+功能说明: Zotero 文献引用扩展, 编译时直接读取 zotero.sqlite 解析 :cite: 角色, 不需要从 Zotero 导出
+
+用法:
+    托马斯微积分 :cite:`finneyTuoMaSiWeiJiFen2003` 中的定义.
+    多个文献 :cite:`finneyTuoMaSiWeiJiFen2003,markwickertSignalsSystemsDummies2013`
+
+    .. bibliography::
+
+引用输出为 (作者, 年份), 鼠标悬停显示完整条目; 页面中有 bibliography 指令时, 引用链接到参考文献列表,
+列表按 GB/T 7714 的格式输出本页引用的文献. 引用键见 python source/zotero_library.py.
+
+设置 zotero_csl_style 后引用和参考文献改用 CSL 样式 (csl_renderer.py) 渲染, 编号样式 (ieee 等)
+按本页中第一次引用的顺序编号. 样式在每次编译开始时读取一次, 编译结果按样式文件哈希缓存.
+
+文献库在每次编译开始时读取一次, 数据库没有变化时读取缓存, 耗时毫秒级.
+数据库变化后, 有引用的文档会被重新读取 (env.note_dependency).
+
+配置:
+    zotero_database = "../zotero/zotero.sqlite"  # 为空或文件不存在时不读取, 引用全部告警
+    zotero_bbt_database = ""  # Better BibTeX 数据库, 为空时使用 zotero.sqlite 同目录下的 better-bibtex.sqlite
+    zotero_cache_dir = "../.cache/zotero"  # 为空时不缓存
+    zotero_csl_style = ""  # CSL 样式名 (例如 apa, ieee) 或 .csl 路径, 为空时使用内置的 GB/T 7714 格式
+    zotero_styles_dir = ""  # 样式目录, 为空时使用 zotero_database 同目录下的 styles
+"""
+
+import os
+from html.parser import HTMLParser
+from typing import Dict, List
+from docutils import nodes
+from docutils.parsers.rst import Directive
+from sphinx.application import Sphinx
+from sphinx.util import logging
+
+from zotero_library import ZoteroLibrary, ZoteroError
+from csl_renderer import CslError, CslStyle, html_to_text, load_style, resolve_style_path
+
+logger = logging.getLogger(__name__)
+
+# CSL 类型 -> GB/T 7714 文献类型标识
+_TYPE_MARKS = {
+    "book": "M",
+    "chapter": "M",
+    "article-journal": "J",
+    "article-magazine": "J",
+    "article-newspaper": "N",
+    "paper-conference": "C",
+    "thesis": "D",
+    "report": "R",
+    "patent": "P",
+    "standard": "S",
+    "dataset": "DS",
+    "software": "CP",
+    "webpage": "EB/OL",
+    "post-weblog": "EB/OL",
+    "post": "EB/OL",
+}
+
+
+class zotero_citation(nodes.Inline, nodes.Element):
+    """引用占位节点, node['keys'] 为引用键列表, 在 doctree-read 时替换"""
+
+
+class zotero_bibliography(nodes.General, nodes.Element):
+    """参考文献列表占位节点, 在 doctree-read 时替换为本页引用的文献"""
+
+
+def _name(person: dict) -> str:
+    return person.get("family") or person.get("literal", "")
+
+
+def _year(item: dict) -> str:
+    issued = item.get("issued") or {}
+    if "date-parts" in issued:
+        return str(issued["date-parts"][0][0])
+    return issued.get("literal", "n.d.")
+
+
+def format_citation(item: dict) -> str:
+    """行内引用 "作者, 年份", 两个作者用 & 连接, 三个及以上只写第一作者加 "等" """
+    authors = [_name(person) for person in item.get("author") or item.get("editor") or []]
+    if not authors:
+        names = item.get("title", item["id"])
+    elif len(authors) == 1:
+        names = authors[0]
+    elif len(authors) == 2:
+        names = f"{authors[0]} & {authors[1]}"
+    else:
+        names = f"{authors[0]} 等"
+    return f"{names}, {_year(item)}"
+
+
+def format_reference(item: dict) -> str:
+    """参考文献条目, 按 GB/T 7714 著录: 作者. 题名[类型]. 出版地: 出版者, 年份: 页码."""
+    authors = [_name(person) for person in item.get("author") or item.get("editor") or []]
+    text = ""
+    if authors:
+        text += ", ".join(authors[:3]) + (", 等" if len(authors) > 3 else "") + ". "
+
+    text += item.get("title", item["id"])
+    text += f"[{_TYPE_MARKS.get(item['type'], 'Z')}]"
+    if "container-title" in item:
+        text += f"//{item['container-title']}"
+    text += ". "
+
+    publisher = item.get("publisher", "")
+    if "publisher-place" in item and publisher:
+        publisher = f"{item['publisher-place']}: {publisher}"
+    text += ", ".join(part for part in (publisher, _year(item)) if part)
+    if "volume" in item:
+        text += f", {item['volume']}"
+        if "issue" in item:
+            text += f"({item['issue']})"
+    if "page" in item:
+        text += f": {item['page']}"
+    text += "."
+    if "DOI" in item:
+        text += f" DOI:{item['DOI']}."
+    return text
+
+
+# CSL 渲染结果中的标签 -> docutils 节点
+_HTML_NODES = {
+    "i": nodes.emphasis,
+    "b": nodes.strong,
+    "sup": nodes.superscript,
+    "sub": nodes.subscript,
+}
+
+
+class _HtmlNodeBuilder(HTMLParser):
+    """把 csl_renderer 输出的 HTML 片段转换为 docutils 行内节点, <a href="#cite-键"> 转换为引用链接"""
+
+    def __init__(self, link_factory) -> None:
+        super().__init__(convert_charrefs=True)
+        self.link_factory = link_factory
+        self.stack = [nodes.inline()]
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag == "a":
+            node = self.link_factory(attributes.get("href", "").removeprefix("#cite-"))
+        elif tag == "span":
+            node = nodes.inline(classes=(attributes.get("class") or "").split())
+        else:
+            node = _HTML_NODES.get(tag, nodes.inline)()
+        self.stack[-1] += node
+        self.stack.append(node)
+
+    def handle_endtag(self, tag):
+        if len(self.stack) > 1:
+            self.stack.pop()
+
+    def handle_data(self, data):
+        self.stack[-1] += nodes.Text(data)
+
+
+def html_to_nodes(html: str, link_factory=None) -> List[nodes.Node]:
+    """CSL 渲染结果转换为节点列表, link_factory(键) 返回引用链接节点"""
+    builder = _HtmlNodeBuilder(link_factory or (lambda key: nodes.inline()))
+    builder.feed(html)
+    builder.close()
+    return builder.stack[0].children
+
+
+def cite_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
+    """:cite:`key1,key2` 角色"""
+    env = inliner.document.settings.env
+    keys = [key.strip() for key in text.split(",") if key.strip()]
+
+    zotero_db = env.config.zotero_database
+    if zotero_db and os.path.isfile(zotero_db):
+        env.note_dependency(zotero_db)  # 数据库变化时重新读取本文档
+    style = getattr(env.app, "zotero_style", None)
+    if style is not None:
+        env.note_dependency(style.path)  # 样式文件变化时重新渲染
+
+    node = zotero_citation(rawtext, keys=keys)
+    node.line = lineno
+    return [node], []
+
+
+class Bibliography(Directive):
+    """参考文献列表指令, 列出本页引用的文献
+
+    用法:
+    .. bibliography::
+    """
+
+    def run(self):
+        return [zotero_bibliography()]
+
+
+def _on_doctree_read(app: Sphinx, doctree: nodes.document) -> None:
+    """把引用和参考文献占位节点替换为最终节点"""
+    items: Dict[str, dict] = getattr(app, "zotero_items", {})
+    style: CslStyle | None = getattr(app, "zotero_style", None)
+    if style is not None:
+        _replace_with_csl(app, doctree, items, style)
+        return
+
+    cited: List[str] = []
+    citations = list(doctree.findall(zotero_citation))
+    for node in citations:
+        for key in node["keys"]:
+            if key not in items:
+                logger.warning(f"未找到文献 {key}", location=(app.env.docname, node.line))
+            elif key not in cited:
+                cited.append(key)
+
+    bibliographies = list(doctree.findall(zotero_bibliography))
+    for node in citations:
+        parts = [nodes.Text("(")]
+        for index, key in enumerate(node["keys"]):
+            if index:
+                parts.append(nodes.Text("; "))
+            item = items.get(key)
+            if item is None:
+                parts.append(nodes.Text(key))
+            elif bibliographies:
+                parts.append(
+                    nodes.reference("", format_citation(item), refid=f"cite-{key}", reftitle=format_reference(item))
+                )
+            else:
+                parts.append(nodes.abbreviation("", format_citation(item), explanation=format_reference(item)))
+        parts.append(nodes.Text(")"))
+        node.replace_self(nodes.inline("", "", *parts, classes=["zotero-cite"]))
+
+    for index, node in enumerate(bibliographies):
+        entries = nodes.enumerated_list(classes=["zotero-bibliography"])
+        for key in cited:
+            paragraph = nodes.paragraph("", format_reference(items[key]))
+            # 一页中有多个 bibliography 时只有第一个作为链接目标
+            entries += nodes.list_item("", paragraph, ids=[f"cite-{key}"] if index == 0 else [])
+        node.replace_self(entries)
+
+
+def _replace_with_csl(app: Sphinx, doctree: nodes.document, items: Dict[str, dict], style: CslStyle) -> None:
+    """用 CSL 样式渲染引用和参考文献, 本页引用的条目一次渲染"""
+    cited: List[str] = []
+    citations = list(doctree.findall(zotero_citation))
+    for node in citations:
+        for key in node["keys"]:
+            if key not in items:
+                logger.warning(f"未找到文献 {key}", location=(app.env.docname, node.line))
+            elif key not in cited:
+                cited.append(key)
+
+    # 编号为本页中第一次引用的顺序, 参考文献按样式排序
+    numbers = {key: index + 1 for index, key in enumerate(cited)}
+    entries = style.render_bibliography([items[key] for key in cited], [numbers[key] for key in cited])
+    references = {key: html_to_text(html) for key, html in entries}
+    bibliographies = list(doctree.findall(zotero_bibliography))
+
+    def link(key: str) -> nodes.Element:
+        if bibliographies:
+            return nodes.reference("", "", refid=f"cite-{key}", reftitle=references.get(key, key))
+        return nodes.abbreviation("", "", explanation=references.get(key, key))
+
+    for node in citations:
+        keys = [key for key in node["keys"] if key in items]
+        html = style.render_citation([items[key] for key in keys], [numbers[key] for key in keys], anchors=True)
+        parts = html_to_nodes(html, link)
+        missing = [key for key in node["keys"] if key not in items]
+        if missing:
+            parts.append(nodes.Text((" " if parts else "") + ", ".join(missing)))
+        node.replace_self(nodes.inline("", "", *parts, classes=["zotero-cite", "csl-citation"]))
+
+    for index, node in enumerate(bibliographies):
+        container = nodes.container(classes=["zotero-bibliography", "csl-bibliography"])
+        for key, html in entries:
+            # 一页中有多个 bibliography 时只有第一个作为链接目标
+            paragraph = nodes.paragraph("", "", *html_to_nodes(html), ids=[f"cite-{key}"] if index == 0 else [])
+            container += paragraph
+        node.replace_self(container)
+
+
+def _on_builder_inited(app: Sphinx) -> None:
+    """每次编译读取一次文献库, 数据库没有变化时读取缓存"""
+    app.zotero_items = {}
+    zotero_db = app.config.zotero_database
+    if not zotero_db:
+        return
+    if os.path.isfile(zotero_db) is False:
+        logger.info(f"未找到 Zotero 数据库 {zotero_db}, 不解析文献引用")
+        return
+
+    library = ZoteroLibrary(zotero_db, app.config.zotero_bbt_database or None, app.config.zotero_cache_dir or None)
+    try:
+        app.zotero_items = library.load()
+    except ZoteroError as e:
+        logger.warning(str(e))
+
+
+def _load_style(app: Sphinx) -> None:
+    """读取 CSL 样式, 样式文件没有变化时使用缓存的编译结果"""
+    app.zotero_style = None
+    config = app.config
+    if not config.zotero_csl_style:
+        return
+    styles_dir = config.zotero_styles_dir
+    if not styles_dir and config.zotero_database:
+        styles_dir = os.path.join(os.path.dirname(config.zotero_database), "styles")
+    try:
+        app.zotero_style = load_style(
+            resolve_style_path(config.zotero_csl_style, styles_dir), config.zotero_cache_dir or None
+        )
+    except CslError as e:
+        logger.warning(f"{e}, 使用内置的 GB/T 7714 格式")
+
+
+def setup(app: Sphinx):
+    """设置 Sphinx 扩展"""
+
+    app.add_config_value("zotero_database", "", "env")
+    app.add_config_value("zotero_bbt_database", "", "env")
+    app.add_config_value("zotero_cache_dir", "", "")
+    app.add_config_value("zotero_csl_style", "", "env")
+    app.add_config_value("zotero_styles_dir", "", "env")
+
+    app.add_node(zotero_citation)
+    app.add_node(zotero_bibliography)
+    app.add_role("cite", cite_role)
+    app.add_directive("bibliography", Bibliography)
+
+    app.connect("builder-inited", _on_builder_inited)
+    app.connect("builder-inited", _load_style)
+    app.connect("doctree-read", _on_doctree_read)
+
+    return {
+        "version": "0.1",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: zotero_sources.py
+文件作者: gaosiyan
+创建时间: 20260119
+功能说明: 相关文献扩展, 编译时在 Zotero 附件全文索引 (zotero_fulltext.py) 中检索, 在笔记中列出相关的文献
+
+用法:
+    .. related-sources:: 正确推理
+       :limit: 3
+
+    不写检索词时使用所在章节的标题检索.
+
+每个结果链接到 zotero://select/library/items/<条目键>, 点击在 Zotero 中选中该文献, 下面附上命中的原文摘要.
+全文索引在每次编译开始时增量更新, 索引变化后有 related-sources 指令的文档会被重新读取 (env.note_dependency).
+
+配置:
+    zotero_storage_dir = ""  # 附件目录, 为空时使用 zotero_database 同目录下的 storage
+    zotero_fulltext_index = ""  # 索引文件, 为空时使用 zotero_cache_dir 下的 fulltext.sqlite, 都为空时不检索
+"""
+
+import os
+from docutils import nodes
+from docutils.parsers.rst import Directive, directives
+from sphinx.application import Sphinx
+from sphinx.util import logging
+
+from zotero_library import ZoteroError
+from zotero_fulltext import FullTextIndex, FullTextError
+from extensions.zotero_cite import format_citation
+
+logger = logging.getLogger(__name__)
+
+# 摘要中命中词的标记, 生成节点时替换为 strong
+_HIGHLIGHT = ("\x02", "\x03")
+
+
+def _snippet_nodes(snippet: str) -> list:
+    """把 "…\x02词\x03…" 转换为文本和加粗节点"""
+    result = []
+    for index, part in enumerate(snippet.replace(_HIGHLIGHT[1], _HIGHLIGHT[0]).split(_HIGHLIGHT[0])):
+        if part:
+            result.append(nodes.strong(part, part) if index % 2 else nodes.Text(part))
+    return result
+
+
+class RelatedSources(Directive):
+    """相关文献指令
+
+    用法:
+    .. related-sources:: 检索词
+       :limit: 5
+    """
+
+    optional_arguments = 1
+    final_argument_whitespace = True
+    option_spec = {"limit": directives.positive_int}
+
+    def run(self):
+        env = self.state.document.settings.env
+        index_path = getattr(env.app, "zotero_fulltext_index", None)
+        if index_path is None:
+            return []
+        env.note_dependency(index_path)  # 索引变化时重新读取本文档
+
+        if self.arguments:
+            query = self.arguments[0]
+        else:
+            # 章节在解析内容之前已经加入文档树, 所在章节的标题可以直接取到
+            section = self.state.parent
+            while section is not None and not isinstance(section, nodes.section):
+                section = section.parent
+            if section is None:
+                raise self.error("related-sources 不在章节中时需要写检索词")
+            query = section.next_node(nodes.title).astext()
+
+        try:
+            with FullTextIndex(index_path, "") as index:
+                results = index.search(query, self.options.get("limit", 5), _HIGHLIGHT)
+        except FullTextError as e:
+            logger.warning(str(e), location=(env.docname, self.lineno))
+            return []
+
+        items = getattr(env.app, "zotero_items", {})
+        entries = nodes.bullet_list(classes=["zotero-sources"])
+        for result in results:
+            title = result["title"]
+            if result["citekey"] in items:
+                title += f" ({format_citation(items[result['citekey']])})"
+            key = result["item_key"] or result["attachment_key"]
+            reference = nodes.reference("", title, refuri=f"zotero://select/library/items/{key}")
+            snippet = nodes.paragraph("", "", *_snippet_nodes(result["snippet"]), classes=["zotero-source-snippet"])
+            entries += nodes.list_item("", nodes.paragraph("", "", reference), snippet)
+        return [entries] if results else []
+
+
+def _on_builder_inited(app: Sphinx) -> None:
+    """每次编译增量更新一次全文索引, 附件没有变化时耗时毫秒级"""
+    app.zotero_fulltext_index = None
+    config = app.config
+    index_path = config.zotero_fulltext_index
+    if not index_path and config.zotero_cache_dir:
+        index_path = os.path.join(config.zotero_cache_dir, "fulltext.sqlite")
+    if not index_path:
+        return
+
+    storage_dir = config.zotero_storage_dir
+    if not storage_dir and config.zotero_database:
+        storage_dir = os.path.join(os.path.dirname(config.zotero_database), "storage")
+    if not storage_dir or os.path.isdir(storage_dir) is False:
+        logger.info(f"未找到 Zotero 附件目录 {storage_dir}, 不检索相关文献")
+        return
+
+    zotero_db = config.zotero_database or None
+    with FullTextIndex(index_path, storage_dir, zotero_db, config.zotero_cache_dir or None) as index:
+        try:
+            updated, removed = index.update()
+        except (FullTextError, ZoteroError) as e:
+            logger.warning(str(e))
+            return
+    if updated or removed:
+        logger.info(f"Zotero 全文索引: 重新索引 {updated} 个附件, 删除 {removed} 个")
+    app.zotero_fulltext_index = index_path
+
+
+def setup(app: Sphinx):
+    """设置 Sphinx 扩展"""
+
+    app.setup_extension("extensions.zotero_cite")  # zotero_database, zotero_cache_dir 配置和文献库
+    app.add_config_value("zotero_storage_dir", "", "env")
+    app.add_config_value("zotero_fulltext_index", "", "env")
+
+    app.add_directive("related-sources", RelatedSources)
+    app.connect("builder-inited", _on_builder_inited)
+
+    return {
+        "version": "0.1",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
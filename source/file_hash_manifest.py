@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: file_hash_manifest.py
+文件作者: gaosiyan
+创建时间: 20260105
+功能说明: 文件哈希清单, 按 (路径, 大小, mtime, inode) 缓存文件哈希, 避免重复读取未变化的文件
+"""
+
+import os
+import json
+from typing import Dict, Iterable
+
+
+class FileHashManifest:
+    """
+    持久化到 JSON 文件的文件哈希清单, 结构如下:
+    {"/path/to/1.png": {"size": 1024, "mtime_ns": 1766833110783521000, "inode": 123, "algorithm": "sha1", "digest": "34281dec..."}}
+
+    文件的 stat 信息与清单一致时直接返回记录的哈希, 不再读取文件内容.
+    """
+
+    def __init__(self, manifest_path: str | None = None) -> None:
+        """
+        manifest_path: 清单文件路径, 为 None 时只在内存中使用, 不落盘
+        """
+        self.manifest_path = manifest_path
+        self.entries: Dict[str, dict] = {}
+        self._dirty = False
+
+        if manifest_path is not None and os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                # 清单损坏时当作空清单, 下次保存时重建
+                self.entries = {}
+
+    def lookup(self, file_path: str, stat: os.stat_result | None = None, algorithm: str = "sha1") -> str | None:
+        """
+        查询文件哈希
+
+        Args:
+            file_path: 文件路径
+            stat: 文件的 stat 结果, 为 None 时现场获取
+            algorithm: 哈希算法, 与记录的算法不一致时视为未命中
+
+        Returns:
+            stat 信息和算法一致时返回记录的哈希, 否则返回 None
+        """
+        entry = self.entries.get(self._key(file_path))
+        if entry is None or entry.get("algorithm", "sha1") != algorithm:
+            return None
+
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return None
+
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns and entry["inode"] == stat.st_ino:
+            return entry["digest"]
+
+        return None
+
+    def update(
+        self, file_path: str, digest: str, stat: os.stat_result | None = None, algorithm: str = "sha1"
+    ) -> None:
+        """记录文件哈希"""
+        if stat is None:
+            stat = os.stat(file_path)
+
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "inode": stat.st_ino,
+            "algorithm": algorithm,
+            "digest": digest,
+        }
+        key = self._key(file_path)
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self._dirty = True
+
+    def retain(self, file_paths: Iterable[str], root: str) -> None:
+        """删除 root 目录下不在 file_paths 中的记录"""
+        keep = {self._key(file_path) for file_path in file_paths}
+        prefix = self._key(root) + os.sep
+        for key in list(self.entries):
+            if key.startswith(prefix) and key not in keep:
+                del self.entries[key]
+                self._dirty = True
+
+    def save(self) -> None:
+        """清单有变化时写回文件"""
+        if self.manifest_path is None or self._dirty is False:
+            return
+
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.entries, file, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.manifest_path)
+        self._dirty = False
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        return os.path.normcase(os.path.abspath(file_path))
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: image_optimizer.py
+文件作者: gaosiyan
+创建时间: 20260113
+功能说明: 图片优化, 无损重新压缩 PNG, 生成缩小尺寸和 WebP/AVIF 格式的变体, 由 extensions.responsive_images 输出 srcset
+
+源图片保持不变 (文件名是内容哈希, 改写源图片会导致重新命名), 优化结果保存在缓存目录中, 以源图片哈希命名,
+每张图片只处理一次. 缓存目录中的 variants.json 记录所有图片的处理结果, 结构如下:
+{"34281dec....png": {"version": 1, "digest": "34281dec...", "width": 1920, "height": 1080, "png": "34281dec....png",
+                                  "variants": [{"file": "34281dec...-480w.webp", "format": "webp", "width": 480}, ...]}}
+
+依赖 Pillow, 未安装时跳过本步骤, 编译结果与优化前一致.
+"""
+
+import os
+import json
+from functools import partial
+from typing import Dict, List
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow 是可选依赖
+    Image = None
+    features = None
+
+from utils import calculate_file_hash_code, execute_in_parallel, DEFAULT_HASH_ALGORITHM, TaskError
+from file_hash_manifest import FileHashManifest
+
+# 记录文件名, 保存在输出目录中
+VARIANTS_FILE_NAME = "variants.json"
+
+# 缩小尺寸的宽度, 只生成小于原图宽度的尺寸
+VARIANT_WIDTHS = (480, 960, 1440)
+
+# 支持优化的图片格式
+IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg"})
+
+# 处理规则变化时递增, 使旧的处理结果失效
+_OPTIMIZER_VERSION = 1
+
+
+def is_available() -> bool:
+    """是否安装了 Pillow"""
+    return Image is not None
+
+
+def _variant_formats() -> List[str]:
+    """当前 Pillow 支持的现代格式"""
+    formats = []
+    for name in ("webp", "avif"):
+        if features.check(name):
+            formats.append(name)
+    return formats
+
+
+def _save_variant(image: "Image.Image", file_path: str, format: str) -> None:
+    """按格式保存变体, 先写入临时文件再替换, 中断时不会留下写了一半的文件"""
+    temp_path = file_path + ".tmp"
+    if format == "png":
+        image.save(temp_path, "PNG", optimize=True)
+    elif format == "webp":
+        # 截图以大块纯色和文字为主, 无损 WebP 通常比 PNG 小很多
+        image.save(temp_path, "WEBP", lossless=True, method=6)
+    else:
+        image.save(temp_path, "AVIF", quality=80, speed=4)
+    os.replace(temp_path, file_path)
+
+
+def optimize_image(image_path: str, output_dir: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> dict:
+    """
+    优化单张图片, 作为模块级函数可以派发到进程池中执行
+
+    Args:
+        image_path: 源图片路径
+        output_dir: 输出目录
+        algorithm: 哈希算法, 输出文件以源图片哈希命名
+
+    Returns:
+        处理结果, 见模块说明
+    """
+    digest = calculate_file_hash_code(image_path, algorithm)
+    if digest is None:
+        raise OSError(f"错误! 图片 {image_path} 读取失败.")
+
+    extension = os.path.splitext(image_path)[1].lower()
+    record = {"version": _OPTIMIZER_VERSION, "digest": digest, "png": None, "variants": []}
+
+    with Image.open(image_path) as image:
+        image.load()
+        record["width"], record["height"] = image.size
+
+        if extension == ".png":
+            # 无损重新压缩, 结果更小时才使用
+            png_name = digest + ".png"
+            png_path = os.path.join(output_dir, png_name)
+            _save_variant(image, png_path, "png")
+            if os.path.getsize(png_path) < os.path.getsize(image_path):
+                record["png"] = png_name
+            else:
+                os.remove(png_path)
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+
+        widths = [width for width in VARIANT_WIDTHS if width < image.width] + [image.width]
+        for width in widths:
+            if width == image.width:
+                resized = image
+            else:
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.Resampling.LANCZOS)
+
+            for format in _variant_formats():
+                file_name = f"{digest}-{width}w.{format}"
+                _save_variant(resized, os.path.join(output_dir, file_name), format)
+                record["variants"].append({"file": file_name, "format": format, "width": width})
+
+    return record
+
+
+def _is_record_valid(record: dict | None, digest: str | None, output_dir: str) -> bool:
+    """记录与源图片一致并且输出文件都存在"""
+    if record is None or record.get("version") != _OPTIMIZER_VERSION or record.get("digest") != digest:
+        return False
+
+    file_names = [variant["file"] for variant in record["variants"]]
+    if record["png"] is not None:
+        file_names.append(record["png"])
+    return all(os.path.isfile(os.path.join(output_dir, file_name)) for file_name in file_names)
+
+
+def load_records(output_dir: str) -> Dict[str, dict]:
+    """读取处理记录, 文件不存在或损坏时返回空字典"""
+    try:
+        with open(os.path.join(output_dir, VARIANTS_FILE_NAME), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_records(output_dir: str, records: Dict[str, dict]) -> None:
+    records_path = os.path.join(output_dir, VARIANTS_FILE_NAME)
+    temp_path = records_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(records, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(temp_path, records_path)
+
+
+def optimize_images(
+    image_dir: str,
+    output_dir: str,
+    manifest: FileHashManifest | None = None,
+    algorithm: str = DEFAULT_HASH_ALGORITHM,
+) -> int | None:
+    """
+    优化目录中的所有图片, 已处理过的图片 (哈希与记录一致并且输出文件都存在) 直接跳过
+
+    Args:
+        image_dir: 图片目录
+        output_dir: 输出目录
+        manifest: 文件哈希清单, 用于快速判断图片是否变化, 为 None 时计算全部图片的哈希
+        algorithm: 哈希算法
+
+    Returns:
+        本次新处理的图片数量, 未安装 Pillow 时返回 None
+    """
+    if is_available() is False:
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    records = load_records(output_dir)
+
+    with os.scandir(image_dir) as entries:
+        image_entries = [
+            entry
+            for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+    pending = []
+    for entry in image_entries:
+        digest = manifest.lookup(entry.path, entry.stat(), algorithm) if manifest is not None else None
+        if digest is None:
+            digest = calculate_file_hash_code(entry.path, algorithm)
+        if _is_record_valid(records.get(entry.name), digest, output_dir) is False:
+            pending.append(entry)
+
+    optimized_cnt = 0
+    worker = partial(optimize_image, output_dir=output_dir, algorithm=algorithm)
+    for entry, record in zip(pending, execute_in_parallel(worker, [entry.path for entry in pending])):
+        if isinstance(record, TaskError):
+            print(f"警告! 图片 {entry.name} 优化失败: {record.error}")
+            continue
+        records[entry.name] = record
+        optimized_cnt += 1
+
+    # 删除已不存在的图片的记录
+    image_names = {entry.name for entry in image_entries}
+    stale_names = [name for name in records if name not in image_names]
+    for name in stale_names:
+        del records[name]
+
+    if optimized_cnt or stale_names:
+        _save_records(output_dir, records)
+
+    return optimized_cnt
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: parallel_build.py
+文件作者: gaosiyan
+创建时间: 20260120
+功能说明: Sphinx 并行编译, 检查扩展是否声明了并行安全, 统计读取/写入阶段的并行度
+
+Sphinx(parallel=N) 时读取和写入都分给 N 个子进程, 条件是所有已加载的扩展 (包括主题) 都声明了
+parallel_read_safe / parallel_write_safe. Sphinx 自己检查时对没有声明的扩展输出告警, 严格模式下会导致编译失败,
+所以编译前由 ParallelBuild 逐个检查, 不安全的阶段改为串行并列出原因, 不输出告警.
+
+并行度按 "各文档的 CPU 时间之和 / 阶段墙钟时间" 计算: CPU 时间在处理文档的进程中测量, 通过共享内存累加,
+串行时约为 1, 并行时为平均同时工作的进程数, 不会超过 CPU 核数 (用墙钟时间累加时, 多个进程分时共用一个核也会算进去).
+并行度不是加速比: 它不包括分发文档, 合并环境和启动进程的开销, 要知道实际加速多少, 需用 -j 1 串行编译一次比较墙钟时间.
+只有 fork 启动的子进程能共享计数, 与 Sphinx 只在 POSIX 上并行一致.
+
+用法:
+    jobs = resolve_jobs("auto")
+    app = Sphinx(..., parallel=jobs)
+    parallel_build = ParallelBuild(app)
+    parallel_build.print_check()
+    app.build()
+    parallel_build.print_report()
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from typing import Dict, List
+from sphinx.application import Sphinx
+from sphinx.util.parallel import parallel_available
+
+PHASES = ("read", "write")
+
+_PHASE_NAMES = {"read": "读取", "write": "写入"}
+
+_SAFE_ATTRIBUTES = {"read": "parallel_read_safe", "write": "parallel_write_safe"}
+
+
+def resolve_jobs(jobs: int | str = "auto") -> int:
+    """
+    进程数
+
+    Args:
+        jobs: 正整数或 "auto" (CPU 核数)
+
+    Returns:
+        进程数, 当前平台不支持 Sphinx 并行编译时为 1
+    """
+    if jobs == "auto":
+        count = os.cpu_count() or 1
+    else:
+        count = int(jobs)
+        if count < 1:
+            raise ValueError(f"进程数应为正整数或 auto: {jobs!r}")
+    return count if parallel_available else 1
+
+
+def jobs_argument(value: str) -> int | str:
+    """argparse 的 type, 接受正整数和 auto"""
+    if value == "auto":
+        return value
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"进程数应为正整数或 auto: {value!r}")
+    return count
+
+
+class ParallelBuild:
+    """
+    检查扩展的并行声明, 替换 app.is_parallel_allowed, 记录每次编译各阶段的耗时
+
+    builder.read_doc / write_doc_serialized / write_doc 包装为计时版本, 挂在 builder 实例上,
+    fork 出的子进程继承同一个包装, 各文档的 CPU 时间累加到共享内存中.
+    """
+
+    def __init__(self, app: Sphinx) -> None:
+        self.app = app
+        self.jobs = app.parallel
+        self.unsafe: Dict[str, List[str]] = {phase: [] for phase in PHASES}
+        for phase in PHASES:
+            for extension in app.extensions.values():
+                if getattr(extension, _SAFE_ATTRIBUTES[phase], None) is not True:
+                    self.unsafe[phase].append(extension.name)
+
+        # 各阶段文档 CPU 时间之和 (秒), 文档数和子进程中处理的文档数, 子进程通过 fork 继承
+        self._work = {phase: multiprocessing.Value("d", 0.0) for phase in PHASES}
+        self._docs = {phase: multiprocessing.Value("i", 0) for phase in PHASES}
+        self._worker_docs = {phase: multiprocessing.Value("i", 0) for phase in PHASES}
+        self._main_pid = os.getpid()
+        self._phase_start: float | None = None
+        self._current: Dict[str, dict] = {}
+        self.builds: List[Dict[str, dict]] = []  # 每次编译 {阶段: 统计}
+
+        app.is_parallel_allowed = self.is_parallel_allowed
+        builder = app.builder
+        builder.read_doc = self._timed(builder.read_doc, "read")
+        # write_doc_serialized 总是在主进程中执行, 计入耗时, 不计入文档数
+        builder.write_doc_serialized = self._timed(builder.write_doc_serialized, "write", count=False)
+        builder.write_doc = self._timed(builder.write_doc, "write")
+
+        app.connect("env-before-read-docs", self._on_env_before_read_docs)
+        app.connect("env-updated", self._on_env_updated)
+        app.connect("build-finished", self._on_build_finished)
+
+    def is_parallel_allowed(self, typ: str) -> bool:
+        """代替 Sphinx.is_parallel_allowed, 结果在编译前已经确定, 不输出告警"""
+        return not self.unsafe[typ]
+
+    def _timed(self, method, phase: str, count: bool = True):
+        work = self._work[phase]
+        docs = self._docs[phase]
+        worker_docs = self._worker_docs[phase]
+        main_pid = self._main_pid
+
+        def timed(docname, *args, **kwargs):
+            start = time.process_time()
+            try:
+                return method(docname, *args, **kwargs)
+            finally:
+                elapsed = time.process_time() - start
+                with work.get_lock():
+                    work.value += elapsed
+                if count:
+                    with docs.get_lock():
+                        docs.value += 1
+                if count and os.getpid() != main_pid:
+                    with worker_docs.get_lock():
+                        worker_docs.value += 1
+
+        return timed
+
+    def _start_phase(self, phase: str) -> None:
+        self._work[phase].value = 0.0
+        self._docs[phase].value = 0
+        self._worker_docs[phase].value = 0
+        self._phase_start = time.perf_counter()
+
+    def _end_phase(self, phase: str) -> None:
+        if self._phase_start is None:
+            return
+        self._current[phase] = {
+            "docs": self._docs[phase].value,
+            "wall": time.perf_counter() - self._phase_start,
+            "work": self._work[phase].value,
+            "parallel": self._worker_docs[phase].value > 0,
+        }
+        self._phase_start = None
+
+    def _on_env_before_read_docs(self, app: Sphinx, env, docnames: List[str]) -> None:
+        self._current = {}
+        self._start_phase("read")
+
+    def _on_env_updated(self, app: Sphinx, env) -> None:
+        self._end_phase("read")
+        self._start_phase("write")
+
+    def _on_build_finished(self, app: Sphinx, exception: Exception | None) -> None:
+        self._end_phase("write")
+        if self._current:
+            self.builds.append(self._current)
+        self._current = {}
+
+    def check_report(self) -> List[str]:
+        """并行检查结果"""
+        if self.jobs <= 1:
+            reason = "" if parallel_available else ", 当前平台不支持 Sphinx 并行编译"
+            return [f"串行编译 (进程数 1{reason})."]
+        lines = [f"并行编译, 进程数 {self.jobs}."]
+        for phase in PHASES:
+            if self.unsafe[phase]:
+                names = ", ".join(self.unsafe[phase])
+                lines.append(
+                    f"    扩展 {names} 没有声明 {_SAFE_ATTRIBUTES[phase]}, {_PHASE_NAMES[phase]}阶段改为串行."
+                )
+        return lines
+
+    def report(self) -> List[str]:
+        """各次编译每个阶段的墙钟时间, 文档 CPU 时间之和和并行度"""
+        lines = []
+        for index, build in enumerate(self.builds):
+            for phase in PHASES:
+                stats = build.get(phase)
+                if stats is None or stats["wall"] <= 0:
+                    continue
+                mode = "并行" if stats["parallel"] else "串行"
+                docs = f" {stats['docs']} 篇" if stats["docs"] else ""
+                lines.append(
+                    f"    第 {index + 1} 次编译{_PHASE_NAMES[phase]}{docs} ({mode}): 墙钟 {stats['wall']:.2f} 秒, "
+                    f"文档 CPU 时间 {stats['work']:.2f} 秒, 并行度 {stats['work'] / stats['wall']:.2f}"
+                )
+        return lines
+
+    def print_check(self) -> None:
+        for line in self.check_report():
+            print(line)
+
+    def print_report(self) -> None:
+        lines = self.report()
+        if lines:
+            print("并行编译统计:")
+            for line in lines:
+                print(line)
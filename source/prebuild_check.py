@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: prebuild_check.py
+文件作者: gaosiyan
+创建时间: 20260124
+功能说明: 编译前检查, 不启动 Sphinx, 用 docutils 解析全部 rst 文档, 检查图片和 toctree
+
+sphinx_format() 的第一次编译主要是为了得到 env.images 和 env.all_docs. 本模块在进程池中逐篇用 docutils
+解析文档, 只提取图片路径, toctree 条目和 :orphan: 标记, 结果按文件 mtime 和大小缓存在一个索引文件中,
+没有变化的文档不再解析. 检查内容与严格模式下会导致编译失败的告警一致:
+    图片不存在, toctree 引用不存在的文档 (glob 没有匹配的文档), 文档没有被任何 toctree 引用;
+另外列出没有被引用的图片, 仅供参考; sphinx_format() 以编译后 env.images 的结果为准移到 TEMP 目录.
+
+docutils 不认识 Sphinx 和扩展的指令和角色, 解析时临时换上一套最小的注册表: toctree 只记录条目,
+其余 docutils 没有的指令 (only, glossary, versionadded 等) 都按普通容器解析其中的内容, 不漏掉其中的图片和 toctree;
+未知角色只产生错误节点, 不影响检查.
+
+用法:
+    python source/prebuild_check.py
+    python source/prebuild_check.py --rebuild
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import time
+import fnmatch
+import argparse
+import posixpath
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+from docutils import nodes
+from docutils.frontend import get_default_settings
+from docutils.parsers.rst import Directive, Parser, directives, roles
+from docutils.parsers.rst.languages import en as english
+from docutils.parsers.rst.directives.misc import Include
+from docutils.utils import DependencyList, Reporter, new_document
+
+from utils import check_files_exist_parallel, execute_in_parallel, TaskError
+from extensions.image_index import ImageIndex
+
+_INDEX_VERSION = 1
+
+# 不是文档目录的子目录
+_SKIP_DIRS = {"_templates", "__pycache__"}
+
+# toctree 条目中的显式标题 "标题 <文档>"
+_EXPLICIT_TITLE_RE = re.compile(r"^(.+?)\s*<(.+)>$", re.DOTALL)
+
+# 解析时替换全局指令和角色注册表, 同一进程内的解析串行执行
+_REGISTRY_LOCK = threading.Lock()
+
+
+class PrebuildCheckError(Exception):
+    """文档目录不存在"""
+
+    pass
+
+
+class _AnyOptions(dict):
+    """接受任意选项, docutils 只在 option_spec 非空时解析选项"""
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __missing__(self, key: str):
+        return directives.unchanged
+
+
+class _toctree(nodes.General, nodes.Element):
+    """toctree 占位节点, 只保存条目"""
+
+    pass
+
+
+class _TocTree(Directive):
+    """只记录条目的 toctree"""
+
+    has_content = True
+    option_spec = _AnyOptions()
+
+    def run(self) -> List[nodes.Node]:
+        node = _toctree()
+        node["entries"] = [line.strip() for line in self.content if line.strip()]
+        node["glob"] = "glob" in self.options
+        return [node]
+
+
+class _Container(Directive):
+    """把内容当作普通正文解析的指令"""
+
+    has_content = True
+    optional_arguments = 1
+    final_argument_whitespace = True
+    option_spec = _AnyOptions()
+
+    def run(self) -> List[nodes.Node]:
+        node = nodes.container()
+        self.state.nested_parse(self.content, self.content_offset, node)
+        return [node]
+
+
+class _Include(Include):
+    """与 Sphinx 一致, 以 "/" 开头的路径相对于 source 目录"""
+
+    def run(self) -> List[nodes.Node]:
+        if self.arguments[0].startswith("/"):
+            src_dir = self.state.document.settings.prebuild_src_dir
+            self.arguments[0] = os.path.join(src_dir, self.arguments[0].lstrip("/"))
+        return super().run()
+
+
+class _Directives(dict):
+    """
+    解析时代替 docutils 的指令注册表, docutils 自带的指令照常查找, 其他指令都按 _Container 解析
+
+    docutils 先用 "in" 检查注册表, 命中时直接取值, 否则再查自带指令, 都没有时才把指令当作错误.
+    """
+
+    def __contains__(self, name: object) -> bool:
+        if dict.__contains__(self, name):
+            return True
+        return name not in english.directives and name not in directives._directive_registry
+
+    def __missing__(self, name: str):
+        return _Container
+
+
+_DIRECTIVES = {"toctree": _TocTree, "include": _Include}
+
+
+def docname_join(base_docname: str, target: str) -> str:
+    """toctree 条目转换为文档名, 以 "/" 开头的相对于 source 目录, 否则相对于当前文档所在目录"""
+    return posixpath.normpath(posixpath.join("/" + base_docname, "..", target))[1:]
+
+
+def _resolve_image(docname: str, uri: str) -> str | None:
+    """图片路径转换为相对 source 目录的路径, 与 env.images 的键一致; 外部图片返回 None"""
+    if "://" in uri or uri.startswith("data:"):
+        return None
+    if uri.startswith("/"):
+        return posixpath.normpath(uri.lstrip("/"))
+    return posixpath.normpath(posixpath.join(posixpath.dirname(docname), uri))
+
+
+def _is_orphan(document: nodes.document) -> bool:
+    """文档开头的字段列表中是否有 :orphan:"""
+    for node in document.children:
+        if isinstance(node, (nodes.comment, nodes.target, nodes.substitution_definition, nodes.system_message)):
+            continue
+        if isinstance(node, nodes.field_list):
+            if any(field[0].astext() == "orphan" for field in node.findall(nodes.field)):
+                return True
+            continue
+        break
+    return False
+
+
+def _parse(src_dir: str, file_path: str) -> Tuple[nodes.document, List[str]]:
+    """解析文档, 返回 doctree 和 include 进来的文件"""
+    with open(file_path, "r", encoding="utf-8") as file:
+        content = file.read()
+
+    settings = get_default_settings(Parser)
+    settings.warning_stream = None  # 关闭警告流
+    settings.report_level = Reporter.SEVERE_LEVEL  # 只报告严重错误及以上
+    settings.halt_level = Reporter.SEVERE_LEVEL + 1  # include 失败等严重错误也不中断解析
+    settings.record_dependencies = DependencyList()
+    settings.prebuild_src_dir = src_dir
+    document = new_document(file_path, settings=settings)
+
+    with _REGISTRY_LOCK:
+        saved_directives, saved_roles = directives._directives, roles._roles
+        directives._directives, roles._roles = _Directives(_DIRECTIVES), {}
+        try:
+            Parser().parse(content, document)
+        finally:
+            directives._directives, roles._roles = saved_directives, saved_roles
+
+    return document, list(settings.record_dependencies.list)
+
+
+def scan_document(argument: Tuple[str, str]) -> dict:
+    """
+    解析一篇文档, 提取检查需要的信息
+
+    作为模块级函数, 可以派发到进程池中执行
+
+    Args:
+        argument: (source 目录, 文档名)
+
+    Returns:
+        {"images": [相对 source 目录的图片路径], "toctree": [文档名], "globs": [文档名模式],
+         "orphan": False, "dependencies": {include 的文件: mtime_ns}}
+    """
+    src_dir, docname = argument
+    document, dependencies = _parse(src_dir, os.path.join(src_dir, docname + ".rst"))
+
+    images = []
+    for node in document.findall(nodes.image):
+        image_path = _resolve_image(docname, node.get("uri", ""))
+        if image_path is not None and image_path not in images:
+            images.append(image_path)
+
+    toctree = []
+    globs = []
+    for node in document.findall(_toctree):
+        for entry in node["entries"]:
+            match = _EXPLICIT_TITLE_RE.match(entry)
+            target = match.group(2).strip() if match else entry
+            if target == "self" or "://" in target or target.startswith("mailto:"):
+                continue
+            if target.endswith(".rst"):
+                target = target[: -len(".rst")]
+            if node["glob"] and any(char in target for char in "*?["):
+                globs.append(docname_join(docname, target))
+            else:
+                toctree.append(docname_join(docname, target))
+
+    return {
+        "images": images,
+        "toctree": toctree,
+        "globs": globs,
+        "orphan": _is_orphan(document),
+        "dependencies": {path: os.stat(path).st_mtime_ns for path in dependencies if os.path.isfile(path)},
+    }
+
+
+class PrebuildCheck:
+    """
+    编译前检查
+
+    索引文件 (JSON):
+        {"version": ..., "documents": {文档名: {"mtime_ns": ..., "size": ..., "entry": scan_document() 的结果}}}
+    """
+
+    def __init__(self, src_dir: str, index_path: str | None = None, root_doc: str = "index") -> None:
+        """
+        src_dir: source 目录 (conf.py 所在目录)
+        index_path: 索引文件路径, 为 None 时不缓存
+        root_doc: 根文档, 不需要被 toctree 引用
+        """
+        if os.path.isdir(src_dir) is False:
+            raise PrebuildCheckError(f"错误! 文档目录 {src_dir} 不存在.")
+
+        self.src_dir = src_dir
+        self.index_path = index_path
+        self.root_doc = root_doc
+        self.entries: Dict[str, dict] = {}  # {文档名: scan_document() 的结果}
+        self.reparsed = 0  # 本次重新解析的文档数
+        self.image_index = ImageIndex()
+        self.errors: Dict[str, str] = {}  # {文档名: 解析错误}
+        self.missing_images: Dict[str, List[str]] = {}  # {文档名: [不存在的图片]}
+        self.broken_toctree: Dict[str, List[str]] = {}  # {文档名: [不存在的文档]}
+        self.unreferenced: List[str] = []  # 没有被 toctree 引用的文档
+        self.unused_images: List[str] = []  # 图片目录中没有被引用的图片
+
+    @property
+    def docs(self) -> List[str]:
+        """全部文档名, 与 env.all_docs 的键一致"""
+        return list(self.entries)
+
+    @property
+    def ok(self) -> bool:
+        """是否可以编译, 没有被引用的图片不影响编译"""
+        return not (self.errors or self.missing_images or self.broken_toctree or self.unreferenced)
+
+    def _read_index(self) -> Dict[str, dict]:
+        if self.index_path is None or os.path.isfile(self.index_path) is False:
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return {}  # 索引损坏时重新解析全部文档
+        if not isinstance(data, dict) or data.get("version") != _INDEX_VERSION:
+            return {}
+        return data.get("documents", {})
+
+    def _write_index(self, documents: Dict[str, dict]) -> None:
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"version": _INDEX_VERSION, "documents": documents}, file, ensure_ascii=False)
+        os.replace(temp_path, self.index_path)
+
+    def _iter_documents(self):
+        """遍历 source 目录, 产出 (文档名, stat), 跳过隐藏目录和模板目录"""
+        for root, dirs, files in os.walk(self.src_dir):
+            dirs[:] = sorted(name for name in dirs if not name.startswith(".") and name not in _SKIP_DIRS)
+            for file_name in sorted(files):
+                if file_name.endswith(".rst"):
+                    path = os.path.join(root, file_name)
+                    docname = os.path.relpath(path, self.src_dir)[: -len(".rst")].replace(os.sep, "/")
+                    yield docname, os.stat(path)
+
+    @staticmethod
+    def _is_fresh(cached: dict | None, stat: os.stat_result) -> bool:
+        """缓存项对应的文档和 include 的文件都没有变化"""
+        if cached is None or cached["mtime_ns"] != stat.st_mtime_ns or cached["size"] != stat.st_size:
+            return False
+        for path, mtime_ns in cached["entry"]["dependencies"].items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def scan(self, rebuild: bool = False) -> "PrebuildCheck":
+        """
+        解析全部文档, mtime 和大小没有变化的文档使用索引中的结果
+
+        Args:
+            rebuild: 为 True 时忽略索引, 重新解析全部文档
+        """
+        cached = {} if rebuild else self._read_index()
+        documents: Dict[str, dict] = {}
+        stale: List[Tuple[str, os.stat_result]] = []
+        for docname, stat in self._iter_documents():
+            if self._is_fresh(cached.get(docname), stat):
+                documents[docname] = cached[docname]
+            else:
+                stale.append((docname, stat))
+
+        self.errors = {}
+        results = execute_in_parallel(scan_document, [(self.src_dir, docname) for docname, _ in stale])
+        for (docname, stat), result in zip(stale, results):
+            if isinstance(result, TaskError):
+                self.errors[docname] = result.error
+                continue
+            documents[docname] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "entry": result}
+        self.reparsed = len(stale)
+
+        if self.index_path is not None and (stale or documents.keys() != cached.keys()):
+            self._write_index(documents)
+
+        self.entries = {docname: documents[docname]["entry"] for docname in sorted(documents)}
+        return self
+
+    def check(self, image_relative_dir: str | None = None) -> "PrebuildCheck":
+        """
+        根据解析结果检查图片和 toctree, 需要先调用 scan()
+
+        Args:
+            image_relative_dir: 图片目录相对 source 目录的路径, 例如 _static/images, 不为 None 时列出没有被引用的图片
+        """
+        all_docs = set(self.entries) | set(self.errors)  # 解析失败的文档已单独报错, 不再算作 toctree 错误
+        self.missing_images = {}
+        self.broken_toctree = {}
+
+        # 图片, 以 ".*" 结尾的路径与 Sphinx 一样匹配所有同名的图片
+        self.image_index = ImageIndex()
+        for docname, entry in self.entries.items():
+            image_paths = []
+            for image_path in entry["images"]:
+                if image_path.endswith(".*"):
+                    candidates = glob.glob(glob.escape(os.path.join(self.src_dir, image_path[:-2])) + ".*")
+                    image_paths.extend(
+                        os.path.relpath(path, self.src_dir).replace(os.sep, "/") for path in sorted(candidates)
+                    )
+                    if not candidates:
+                        self.missing_images.setdefault(docname, []).append(image_path)
+                else:
+                    image_paths.append(image_path)
+            self.image_index.add_document(docname, image_paths)
+
+        image_paths = sorted(self.image_index.image_to_docs)
+        exists = check_files_exist_parallel([os.path.join(self.src_dir, image_path) for image_path in image_paths])
+        for image_path, exist in zip(image_paths, exists):
+            if exist is False:
+                for docname in sorted(self.image_index.get_documents(image_path)):
+                    self.missing_images.setdefault(docname, []).append(image_path)
+
+        # toctree
+        included = set()
+        for docname, entry in self.entries.items():
+            for target in entry["toctree"]:
+                if target in all_docs:
+                    included.add(target)
+                else:
+                    self.broken_toctree.setdefault(docname, []).append(target)
+            for pattern in entry["globs"]:
+                matched = fnmatch.filter(all_docs, pattern)
+                if not matched:
+                    self.broken_toctree.setdefault(docname, []).append(pattern)
+                included.update(matched)
+
+        self.unreferenced = sorted(
+            docname
+            for docname, entry in self.entries.items()
+            if docname not in included and docname != self.root_doc and not entry["orphan"]
+        )
+
+        if image_relative_dir is not None:
+            image_dir = os.path.join(self.src_dir, image_relative_dir)
+            image_files = sorted(os.listdir(image_dir)) if os.path.isdir(image_dir) else []
+            self.unused_images = self.image_index.find_orphans(
+                image_relative_dir + "/" + file_name for file_name in image_files
+            )
+        return self
+
+    def run(self, image_relative_dir: str | None = None, rebuild: bool = False) -> "PrebuildCheck":
+        """scan() 后 check()"""
+        return self.scan(rebuild).check(image_relative_dir)
+
+    def report(self) -> List[str]:
+        """检查结果"""
+        lines = [f"检查 {len(self.entries)} 篇文档 (重新解析 {self.reparsed} 篇)."]
+        for docname, error in self.errors.items():
+            lines.append(f"错误! 文档 {docname} 解析失败: {error}")
+        for docname, image_paths in self.missing_images.items():
+            for image_path in image_paths:
+                lines.append(f"错误! 文档 {docname} 中的图片 {image_path} 不存在.")
+        for docname, targets in self.broken_toctree.items():
+            for target in targets:
+                lines.append(f"错误! 文档 {docname} 的 toctree 引用了不存在的文档 {target}.")
+        for docname in self.unreferenced:
+            lines.append(f"错误! 文档 {docname} 没有被任何 toctree 引用.")
+        if self.unused_images:
+            lines.append(f"{len(self.unused_images)} 张图片没有被引用: {', '.join(self.unused_images)}")
+        return lines
+
+    def print_report(self) -> None:
+        for line in self.report():
+            print(line)
+
+
+if __name__ == "__main__":
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="编译前检查图片和 toctree")
+    arg_parser.add_argument("--rebuild", action="store_true", help="忽略索引, 重新解析全部文档")
+    arg_parser.add_argument("--src", default=os.path.join(root_dir, "source"), help="source 目录")
+    arg_parser.add_argument(
+        "--index", default=os.path.join(root_dir, ".cache", "prebuild_index.json"), help="索引文件"
+    )
+    arg_parser.add_argument("--images", default="_static/images", help="图片目录, 相对 source 目录")
+    args = arg_parser.parse_args()
+
+    try:
+        start_time = time.perf_counter()
+        prebuild_check = PrebuildCheck(args.src, args.index).run(args.images, args.rebuild)
+        elapsed = time.perf_counter() - start_time
+    except PrebuildCheckError as e:
+        print(e)
+        sys.exit(1)
+
+    prebuild_check.print_report()
+    print(f"{'检查通过' if prebuild_check.ok else '检查未通过'}, 耗时 {elapsed * 1000:.1f} ms")
+    sys.exit(0 if prebuild_check.ok else 1)
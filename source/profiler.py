@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: profiler.py
+文件作者: gaosiyan
+创建时间: 20260115
+功能说明: 格式化流程的性能分析, 记录各阶段, 每篇文档, 并行任务和格式化规则的耗时
+
+记录的内容:
+    phase    sphinx_format 的各个步骤, 由 phase() 记录
+    sphinx   Sphinx 的读取/写入阶段和每篇文档的读取/写入, 由 Sphinx 事件记录
+    task     execute_in_parallel 中的每个任务, 包括在工作进程中执行的任务
+    pass     rst_formatter.format_text 中每条规则的调用次数和累计耗时
+可选 cProfile (函数级热点) 和 tracemalloc (内存峰值和分配最多的代码行).
+
+输出:
+    profile.json  汇总数据, 可保存下来与之后的结果对比
+    trace.json    Chrome trace 格式, 在 chrome://tracing 或 https://ui.perfetto.dev 中打开
+    cprofile.prof cProfile 原始数据, 用 python -m pstats 或 snakeviz 查看
+
+用法:
+    with Profiler(cprofile=True) as profiler:
+        with phase("第一次编译"):
+            app.build()
+    profiler.save("build/profile")
+"""
+
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterator, List
+
+import rst_formatter
+
+# 当前生效的分析器, 未开启分析时为 None, 各处据此决定是否记录
+_active: "Profiler | None" = None
+
+# cProfile 和 tracemalloc 汇总中列出的条目数
+TOP_COUNT = 30
+
+
+def get_active_profiler() -> "Profiler | None":
+    """返回当前生效的分析器"""
+    return _active
+
+
+def phase(name: str, **args) -> Any:
+    """记录一个阶段, 未开启分析时什么也不做"""
+    if _active is None:
+        return nullcontext()
+    return _active.phase(name, **args)
+
+
+def _task_name(func: Callable) -> str:
+    """任务函数名, 支持 functools.partial 包装"""
+    while hasattr(func, "func"):
+        func = func.func
+    return getattr(func, "__qualname__", repr(func))
+
+
+class TimedResult:
+    """带计时信息的任务结果, 从工作进程传回当前进程"""
+
+    __slots__ = ("value", "start_ns", "end_ns", "pid", "tid", "pass_stats")
+
+    def __init__(self, value: Any, start_ns: int, end_ns: int, pass_stats: Dict[str, List[int]]) -> None:
+        self.value = value
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.pass_stats = pass_stats
+
+
+class TimedTask:
+    """
+    包装任务函数, 记录执行时间和格式化规则耗时
+
+    模块级类, 可以随任务派发到进程池
+    """
+
+    def __init__(self, func: Callable[[Any], Any]) -> None:
+        self.func = func
+
+    def __call__(self, argument: Any) -> TimedResult:
+        rst_formatter.start_pass_timing()
+        start_ns = time.perf_counter_ns()
+        try:
+            value = self.func(argument)
+        finally:
+            end_ns = time.perf_counter_ns()
+            pass_stats = rst_formatter.stop_pass_timing()
+        return TimedResult(value, start_ns, end_ns, pass_stats)
+
+
+class Profiler:
+    """
+    性能分析器, 作为上下文管理器使用, 进入时开始记录, 退出时停止
+
+    时间统一使用 time.perf_counter_ns(), Linux 和 Windows 下都是系统级单调时钟, 工作进程中的记录可以直接合并
+    """
+
+    def __init__(self, cprofile: bool = False, memory: bool = False) -> None:
+        """
+        cprofile: 是否开启 cProfile, 只分析当前进程
+        memory: 是否开启 tracemalloc, 开启后程序明显变慢, 只用于定位内存问题
+        """
+        self.cprofile = cprofile
+        self.memory = memory
+        self.events: List[dict] = []
+        self.pass_stats: Dict[str, List[int]] = {}
+        self.origin_ns = time.perf_counter_ns()
+        self.end_ns: int | None = None
+        self.memory_summary: dict | None = None
+        self._profile: cProfile.Profile | None = None
+        self._lock = threading.Lock()
+        self._doc_start_ns: Dict[str, int] = {}
+        self._sphinx_phase_start_ns: int | None = None
+        self._doc_count = 0
+
+    def __enter__(self) -> "Profiler":
+        global _active
+        _active = self
+        self.origin_ns = time.perf_counter_ns()
+        if self.memory:
+            tracemalloc.start()
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active
+        if self._profile is not None:
+            self._profile.disable()
+        if self.memory:
+            self.memory_summary = self._summarize_memory()
+            tracemalloc.stop()
+        self.end_ns = time.perf_counter_ns()
+        _active = None
+
+    def add_event(
+        self,
+        name: str,
+        category: str,
+        start_ns: int,
+        end_ns: int,
+        pid: int | None = None,
+        tid: int | None = None,
+        args: dict | None = None,
+    ) -> None:
+        """记录一个事件"""
+        event = {
+            "name": name,
+            "cat": category,
+            "start_ns": start_ns - self.origin_ns,
+            "duration_ns": end_ns - start_ns,
+            "pid": pid if pid is not None else os.getpid(),
+            "tid": tid if tid is not None else threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def phase(self, name: str, **args) -> Iterator[None]:
+        """记录一个阶段"""
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add_event(name, "phase", start_ns, time.perf_counter_ns(), args=args)
+
+    def add_task(self, func: Callable, argument: Any, result: Any) -> Any:
+        """记录 TimedTask 的结果, 返回原始结果"""
+        if isinstance(result, TimedResult) is False:
+            return result  # TaskError, 执行失败没有计时信息
+
+        self.add_event(
+            _task_name(func),
+            "task",
+            result.start_ns,
+            result.end_ns,
+            result.pid,
+            result.tid,
+            {"argument": str(argument)},
+        )
+        self.merge_pass_stats(result.pass_stats)
+        return result.value
+
+    def merge_pass_stats(self, pass_stats: Dict[str, List[int]]) -> None:
+        """合并格式化规则耗时 {规则: [调用次数, 累计纳秒]}"""
+        with self._lock:
+            for name, (calls, duration_ns) in pass_stats.items():
+                total = self.pass_stats.setdefault(name, [0, 0])
+                total[0] += calls
+                total[1] += duration_ns
+
+    def connect_sphinx(self, app) -> None:
+        """
+        通过 Sphinx 事件记录读取/写入阶段和每篇文档的耗时
+
+        并行读取/写入时工作进程中的文档事件不会传回, 只有阶段耗时
+        """
+        app.connect("env-before-read-docs", self._on_env_before_read_docs)
+        app.connect("source-read", self._on_source_read)
+        app.connect("doctree-read", self._on_doctree_read)
+        app.connect("env-updated", self._on_env_updated)
+        app.connect("doctree-resolved", self._on_doctree_resolved)
+        app.connect("html-page-context", self._on_html_page_context)
+        app.connect("build-finished", self._on_build_finished)
+
+    def _on_env_before_read_docs(self, app, env, docnames: List[str]) -> None:
+        self._sphinx_phase_start_ns = time.perf_counter_ns()
+        self._doc_count = len(docnames)
+
+    def _on_source_read(self, app, docname: str, source: List[str]) -> None:
+        self._doc_start_ns[docname] = time.perf_counter_ns()
+
+    def _on_doctree_read(self, app, doctree) -> None:
+        docname = app.env.docname
+        start_ns = self._doc_start_ns.pop(docname, None)
+        if start_ns is not None:
+            self.add_event(f"read {docname}", "sphinx", start_ns, time.perf_counter_ns(), args={"docname": docname})
+
+    def _on_env_updated(self, app, env) -> None:
+        now = time.perf_counter_ns()
+        if self._sphinx_phase_start_ns is not None:
+            self.add_event(
+                "sphinx read", "sphinx", self._sphinx_phase_start_ns, now, args={"documents": self._doc_count}
+            )
+        self._sphinx_phase_start_ns = now
+
+    def _on_doctree_resolved(self, app, doctree, docname: str) -> None:
+        self._doc_start_ns[docname] = time.perf_counter_ns()
+
+    def _on_html_page_context(self, app, pagename: str, templatename: str, context: dict, doctree) -> None:
+        start_ns = self._doc_start_ns.pop(pagename, None)
+        if start_ns is not None:
+            self.add_event(f"write {pagename}", "sphinx", start_ns, time.perf_counter_ns(), args={"docname": pagename})
+
+    def _on_build_finished(self, app, exception: Exception | None) -> None:
+        if self._sphinx_phase_start_ns is not None:
+            self.add_event("sphinx write", "sphinx", self._sphinx_phase_start_ns, time.perf_counter_ns())
+        self._sphinx_phase_start_ns = None
+        self._doc_start_ns.clear()
+
+    def _summarize_memory(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics("lineno")
+        return {
+            "current_kb": current // 1024,
+            "peak_kb": peak // 1024,
+            "top": [
+                {"location": str(statistic.traceback), "size_kb": statistic.size // 1024, "count": statistic.count}
+                for statistic in statistics[:TOP_COUNT]
+            ],
+        }
+
+    def _summarize_cprofile(self) -> List[dict]:
+        stats = pstats.Stats(self._profile, stream=io.StringIO())
+        rows = []
+        for (file_name, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            rows.append(
+                {
+                    "function": f"{os.path.basename(file_name)}:{line}({function})",
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                }
+            )
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:TOP_COUNT]
+
+    def summary(self) -> dict:
+        """汇总数据"""
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        summary = {"total_ms": round((end_ns - self.origin_ns) / 1e6, 3), "phases": [], "sphinx": [], "tasks": {}}
+
+        for event in sorted(self.events, key=lambda event: event["start_ns"]):
+            duration_ms = round(event["duration_ns"] / 1e6, 3)
+            if event["cat"] in ("phase", "sphinx"):
+                summary["phases" if event["cat"] == "phase" else "sphinx"].append(
+                    {"name": event["name"], "ms": duration_ms}
+                )
+            else:
+                task = summary["tasks"].setdefault(event["name"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                task["count"] += 1
+                task["total_ms"] = round(task["total_ms"] + duration_ms, 3)
+                if duration_ms >= task["max_ms"]:
+                    task["max_ms"] = duration_ms
+                    task["slowest"] = event["args"]["argument"]
+
+        summary["passes"] = {
+            name: {"calls": calls, "ms": round(duration_ns / 1e6, 3)}
+            for name, (calls, duration_ns) in sorted(self.pass_stats.items())
+        }
+        if self.memory_summary is not None:
+            summary["memory"] = self.memory_summary
+        if self._profile is not None:
+            summary["cprofile"] = self._summarize_cprofile()
+        return summary
+
+    def chrome_trace(self) -> dict:
+        """Chrome trace 格式, 时间单位是微秒"""
+        trace_events = []
+        for event in self.events:
+            trace_event = {
+                "name": event["name"],
+                "cat": event["cat"],
+                "ph": "X",
+                "ts": event["start_ns"] / 1000,
+                "dur": event["duration_ns"] / 1000,
+                "pid": event["pid"],
+                "tid": event["tid"],
+            }
+            if "args" in event:
+                trace_event["args"] = event["args"]
+            trace_events.append(trace_event)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save(self, output_dir: str) -> None:
+        """保存 profile.json, trace.json 和 cprofile.prof"""
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, "profile.json"), "w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, ensure_ascii=False, indent=1)
+        with open(os.path.join(output_dir, "trace.json"), "w", encoding="utf-8") as file:
+            json.dump(self.chrome_trace(), file, ensure_ascii=False)
+        if self._profile is not None:
+            self._profile.dump_stats(os.path.join(output_dir, "cprofile.prof"))
+
+    def print_summary(self) -> None:
+        """打印各阶段耗时, 最慢的任务和格式化规则耗时"""
+        summary = self.summary()
+        print(f"性能分析: 总耗时 {summary['total_ms']:.1f} ms")
+        for item in summary["phases"]:
+            print(f"    {item['name']}: {item['ms']:.1f} ms")
+        for item in summary["sphinx"]:
+            if item["name"] in ("sphinx read", "sphinx write"):
+                print(f"    {item['name']}: {item['ms']:.1f} ms")
+        for name, task in summary["tasks"].items():
+            print(
+                f"    任务 {name}: {task['count']} 个, 累计 {task['total_ms']:.1f} ms, "
+                f"最慢 {task['max_ms']:.1f} ms ({task['slowest']})"
+            )
+        for name, item in summary["passes"].items():
+            print(f"    规则 {name}: {item['calls']} 次, 累计 {item['ms']:.1f} ms")
+        if "memory" in summary:
+            print(f"    内存峰值: {summary['memory']['peak_kb']} KB")
@@ -8,17 +8,76 @@
 """
 
 import os
+from functools import partial
+from typing import Dict, Iterator, List
 from rst_doc_parser import RstDocParser
-from utils import rename_files_by_sha1
+from utils import rename_images_by_hash, find_missing_files, iter_in_parallel, TaskError
+from file_hash_manifest import FileHashManifest
+from extensions.image_index import ImageIndex
+
+
+def iter_rst_file_paths(root_dir: str) -> Iterator[str]:
+    """
+    遍历目录, 逐个产出 rst 文档路径
+    """
+    for root, _, files in os.walk(root_dir):
+        for file in files:
+            if file.endswith(".rst"):
+                yield os.path.join(root, file)
+
+
+def process_document(rst_file_path: str, root_dir: str, rename_dict: Dict[str, str]) -> dict:
+    """
+    处理单个文档: 解析 -> 更新图片路径 -> 格式化 -> 回写, 文件只读取一次, 最多写入一次
+
+    作为模块级函数, 可以派发到进程池中执行
+
+    Args:
+        rst_file_path: 文档路径
+        root_dir: 文档根目录
+        rename_dict: 图片重命名字典 {old_name: new_name}
+
+    Returns:
+        处理结果, 结构如下:
+        {"file_path": "sphinx/项目部署.rst", "changed": True, "replaced": 2, "cache": {内容哈希: 元数据}}
+    """
+    parser = RstDocParser(rst_file_path, root_dir)
+
+    replace_dict = {}
+    if rst_file_path.endswith("index.rst") is False:
+        # image_file_paths 是当前文档的所有图片,例如[/_static/1.png,/_static/2.png]
+        for image_file in parser.get_image_file_paths():
+            # base_file_name 只是文件名,例如 1.png
+            base_file_name = os.path.basename(image_file)
+            if base_file_name in rename_dict:
+                replace_dict[image_file] = image_file.replace(base_file_name, rename_dict[base_file_name])
+
+    cache = parser.cache_entry()  # 在内容被改写之前取出解析结果
+    changed = parser.rewrite(replace_dict)
+
+    return {"file_path": rst_file_path, "changed": changed, "replaced": len(replace_dict), "cache": cache}
 
 
 class RstDocBatchProcessor:
     """RST 文档批处理类封装"""
 
-    def __init__(self, root_dir: str, image_dir: str) -> None:
+    def __init__(
+        self,
+        root_dir: str,
+        image_dir: str,
+        manifest: FileHashManifest | None = None,
+        cache_path: str | None = None,
+        image_index_path: str | None = None,
+        hash_algorithm: str | None = None,
+    ) -> None:
         """
         root_dir: 文档根目录
         image_dir: 图像根目录
+        manifest: 图片哈希清单, 可与 sphinx_format() 共用同一份清单
+        cache_path: 文档解析缓存文件, 为 None 时只使用进程内缓存
+        image_index_path: extensions.image_index 保存的图片引用索引 (build/doctrees/image_index.json),
+            索引可用时直接查询图片引用, 不再逐篇解析文档
+        hash_algorithm: 图片命名使用的哈希算法, 为 None 时使用 root_dir/conf.py 中的 image_hash_algorithm
         """
         if os.path.isdir(root_dir) is False:
             raise RstDocBatchProcessorError(f"错误! {root_dir} 目录不存在.")
@@ -28,41 +87,78 @@ class RstDocBatchProcessor:
 
         self.root_dir = root_dir
         self.image_dir = image_dir
+        self.manifest = manifest
+        self.cache_path = cache_path
+        self.hash_algorithm = hash_algorithm
+        self.image_index = ImageIndex.load(image_index_path) if image_index_path is not None else None
 
-        self.rst_file_paths = []
+        if cache_path is not None:
+            RstDocParser.load_cache(cache_path)
 
-        for root, _, files in os.walk(root_dir):
-            for file in files:
-                if file.endswith(".rst"):
-                    self.rst_file_paths.append(os.path.join(root, file))
+        self.rst_file_paths = list(iter_rst_file_paths(root_dir))
 
-    def format(self):
+    def iter_format(self) -> Iterator[dict]:
         """
-        遍历处理所有文档
+        流水线处理所有文档, 文档之间互不依赖, 分发到执行器并行处理, 按文档顺序逐个产出处理结果
+
+        Yields:
+            process_document() 的返回值, 处理失败时为 {"file_path": ..., "error": "错误信息"}
         """
-        rename_dict = rename_files_by_sha1(self.image_dir)
+        rename_dict = rename_images_by_hash(self.image_dir, self.root_dir, self.manifest, self.hash_algorithm)
+        if rename_dict is None:
+            raise RstDocBatchProcessorError(f"错误! {self.image_dir} 中的图片重命名失败.")
 
-        for rst_file_path in self.rst_file_paths:
-            parser = RstDocParser(rst_file_path)
+        worker = partial(process_document, root_dir=self.root_dir, rename_dict=rename_dict)
+        for result in iter_in_parallel(worker, self.rst_file_paths):
+            if isinstance(result, TaskError):
+                yield {"file_path": result.argument, "error": result.error}
+                continue
 
-            if rst_file_path.endswith("index.rst") is False:
-                # image_file_paths 是当前文档的所有图片,例如[/_static/1.png,/_static/2.png]
-                image_file_paths = parser.get_image_file_paths()
+            # 工作进程中的解析结果合并回当前进程, 随缓存一起保存
+            RstDocParser.merge_cache(result.pop("cache"))
+            yield result
 
-                replace_dict = {}
+        if self.cache_path is not None:
+            RstDocParser.save_cache(self.cache_path)
 
-                for image_file in image_file_paths:
-                    # base_file_name 只是文件名,例如 1.png
-                    base_file_name = os.path.basename(image_file)
-                    if base_file_name in rename_dict:
-                        old_str = image_file
-                        new_str = image_file.replace(base_file_name, rename_dict[base_file_name])
-                        replace_dict[old_str] = new_str
+    def format(self) -> List[dict]:
+        """
+        遍历处理所有文档, 逐个打印处理进度
 
-                if replace_dict:
-                    parser.replace_image_path(replace_dict)
+        Returns:
+            所有文档的处理结果
+        """
+        results = []
+        total = len(self.rst_file_paths)
+        for index, result in enumerate(self.iter_format(), start=1):
+            results.append(result)
+            if "error" in result:
+                print(f"[{index}/{total}] 错误! {result['file_path']}: {result['error']}")
+            elif result["changed"]:
+                print(f"[{index}/{total}] 已更新 {result['file_path']}, 替换图片路径 {result['replaced']} 处.")
+
+        return results
+
+    def find_missing_images(self) -> Dict[str, List[str]]:
+        """
+        检查所有文档引用的图片, 返回 {文档路径: [丢失的图片路径]}, 只包含有图片丢失的文档
+        """
+        references = {}
+        if self.image_index is not None:
+            # 索引中是相对 source 目录的文档名和图片路径, 反映最近一次编译时的引用关系
+            for docname, image_paths in self.image_index.doc_to_images.items():
+                references[os.path.join(self.root_dir, docname + ".rst")] = [
+                    os.path.join(self.root_dir, image_path) for image_path in sorted(image_paths)
+                ]
+            return find_missing_files(references)
+
+        for rst_file_path in self.rst_file_paths:
+            parser = RstDocParser(rst_file_path, self.root_dir)
+            references[rst_file_path] = [
+                parser.resolve_image_path(image_file) for image_file in parser.get_image_file_paths()
+            ]
 
-            parser.format()
+        return find_missing_files(references)
 
 
 class RstDocBatchProcessorError(Exception):
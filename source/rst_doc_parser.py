@@ -8,23 +8,65 @@
 """
 
 import os
-import re
-from typing import List
+import pickle
+import threading
+from hashlib import sha1
+from typing import Dict, List
 from pathlib import Path
+from collections import OrderedDict
 from docutils.parsers.rst import Parser
-from docutils.utils import new_document
+from docutils.utils import new_document, Reporter
 from docutils.frontend import get_default_settings
 from docutils import nodes
 
-from utils import check_files_exist_parallel
+from utils import check_files_exist_parallel, replace_all, write_file_atomic
+from rst_formatter import format_content
+
+# 内存中最多缓存的 doctree 个数, doctree 占用内存较大, 元数据不受此限制
+DOCTREE_CACHE_SIZE = 64
+
+# 元数据缓存格式版本, 元数据结构变化时递增, 使磁盘上的旧缓存失效
+_CACHE_VERSION = 1
+
+# 进程内缓存, 键是文档内容的哈希, 内容相同的文档共享解析结果
+_DOCTREE_CACHE: "OrderedDict[str, nodes.document]" = OrderedDict()
+_METADATA_CACHE: Dict[str, dict] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def _content_hash(content: str) -> str:
+    """文档内容的哈希"""
+    return sha1(content.encode("utf-8")).hexdigest()
+
+
+def _extract_metadata(document: nodes.document) -> dict:
+    """从 doctree 中提取元数据"""
+    title_node = document.next_node(nodes.title)
+
+    images = []
+    for node in document.findall(nodes.image):
+        if "uri" in node.attributes:
+            images.append(node["uri"])
+
+    references = []
+    for node in document.findall(nodes.reference):
+        if "refuri" in node.attributes:
+            references.append(node["refuri"])
+
+    return {
+        "title": title_node.astext() if title_node is not None else None,
+        "images": images,
+        "references": references,
+    }
 
 
 class RstDocParser:
     """处理单个 RST 文档的相关功能封装"""
 
-    def __init__(self, file_path: str) -> None:
+    def __init__(self, file_path: str, root_dir: str | None = None) -> None:
         """
-        初始化方法只传入文档路径
+        file_path: 文档路径
+        root_dir: 文档根目录 (conf.py 所在目录), 以 "/" 开头的图片路径相对于该目录, 默认为本文件所在目录
         """
 
         if os.path.isfile(file_path) is False:
@@ -33,49 +75,125 @@ class RstDocParser:
         if file_path.endswith(".rst") is False:
             raise RstDocParserError(f"错误! 文档 {file_path} 非 rst 文档.")
 
-        working_dir = Path(__file__).resolve().parent
-        try:
-            os.chdir(working_dir)
-        except Exception as exc:
-            raise RstDocParserError(f"无法切换到目录 {working_dir}，原始错误: {exc}") from exc
+        if root_dir is None:
+            root_dir = Path(__file__).resolve().parent
+
+        if os.path.isdir(root_dir) is False:
+            raise RstDocParserError(f"错误! 文档根目录 {root_dir} 不存在.")
 
         self.file_path = file_path
+        self.root_dir = str(root_dir)
+        self._content = None  # 文档内容, 同一个实例只读取一次文件
+        self._hash = None  # 文档内容的哈希, 内容变化时重新计算
 
-    def get_image_file_paths(self) -> List[str]:
+    def get_doctree(self) -> nodes.document:
         """
-        返回当前文档的图片列表,实际路径需要转换成 ["." + file_path for file_path in image_file_paths]
+        返回当前文档的 doctree, 内容相同的文档在进程内只解析一次
         """
-        file_path = self.file_path
         file_content = self._read_file()
+        content_hash = self._get_content_hash()
 
+        with _CACHE_LOCK:
+            document = _DOCTREE_CACHE.get(content_hash)
+            if document is not None:
+                _DOCTREE_CACHE.move_to_end(content_hash)
+                return document
+
+        file_path = self.file_path
         try:
             parser = Parser()
             settings = get_default_settings(Parser)
             settings.warning_stream = None  # 关闭警告流
-            settings.report_level = "SEVERE"  # 只报告严重错误及以上
+            settings.report_level = Reporter.SEVERE_LEVEL  # 只报告严重错误及以上
             document = new_document(file_path, settings=settings)
             parser.parse(file_content, document)
 
         except Exception as exc:
             raise RstDocParserError(f"错误! 文档 {file_path} 解析错误,原始错误: {exc}") from exc
 
-        image_file_paths = []
-        for node in document.findall(nodes.image):
-            if "uri" in node.attributes:
-                image_file_paths.append(node["uri"])
+        with _CACHE_LOCK:
+            _DOCTREE_CACHE[content_hash] = document
+            if len(_DOCTREE_CACHE) > DOCTREE_CACHE_SIZE:
+                _DOCTREE_CACHE.popitem(last=False)
 
-        return image_file_paths
+        return document
+
+    def get_metadata(self) -> dict:
+        """
+        返回当前文档的元数据, 按文档内容哈希缓存, 内容不变时不再解析, 结构如下:
+        {"title": "项目部署", "images": ["/_static/images/1.png"], "references": ["https://giscus.app/zh-CN"]}
+        """
+        content_hash = self._get_content_hash()
+
+        metadata = _METADATA_CACHE.get(content_hash)
+        if metadata is None:
+            metadata = _extract_metadata(self.get_doctree())
+            with _CACHE_LOCK:
+                _METADATA_CACHE[content_hash] = metadata
+
+        return metadata
+
+    def get_image_file_paths(self) -> List[str]:
+        """
+        返回当前文档的图片列表, 是文档中书写的路径, 实际路径用 resolve_image_path() 转换
+        """
+        return list(self.get_metadata()["images"])
+
+    def resolve_image_path(self, image_file_path: str) -> str:
+        """
+        把文档中的图片路径转换成实际路径: 以 "/" 开头的相对于文档根目录, 否则相对于文档所在目录
+        """
+        if image_file_path.startswith("/"):
+            return os.path.join(self.root_dir, image_file_path.lstrip("/"))
+
+        return os.path.join(os.path.dirname(os.path.abspath(self.file_path)), image_file_path)
+
+    def get_title(self) -> str | None:
+        """
+        返回当前文档的标题, 没有标题时返回 None
+        """
+        return self.get_metadata()["title"]
+
+    def get_references(self) -> List[str]:
+        """
+        返回当前文档中的外部链接列表
+        """
+        return list(self.get_metadata()["references"])
+
+    @staticmethod
+    def load_cache(cache_path: str) -> None:
+        """
+        从磁盘加载元数据缓存, 文件不存在或版本不一致时忽略
+        """
+        try:
+            with open(cache_path, "rb") as file:
+                cache = pickle.load(file)
+        except (OSError, pickle.PickleError, EOFError, AttributeError):
+            return
+
+        if isinstance(cache, dict) and cache.get("version") == _CACHE_VERSION:
+            with _CACHE_LOCK:
+                _METADATA_CACHE.update(cache["metadata"])
+
+    @staticmethod
+    def save_cache(cache_path: str) -> None:
+        """
+        把元数据缓存保存到磁盘
+        """
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        with _CACHE_LOCK:
+            metadata = dict(_METADATA_CACHE)
+        with open(temp_path, "wb") as file:
+            pickle.dump({"version": _CACHE_VERSION, "metadata": metadata}, file)
+        os.replace(temp_path, cache_path)
 
     def is_images_complete(self) -> bool:
         """
         判断是否有文件丢失,有丢失返回 False,否则返回 True
         """
         image_file_paths = self.get_image_file_paths()
-        exists = check_files_exist_parallel(["." + file_path for file_path in image_file_paths])
-
-        if exists is None:
-            print("警告! check_files_exist_parallel 调用失败.")
-            return False
+        exists = check_files_exist_parallel([self.resolve_image_path(file_path) for file_path in image_file_paths])
 
         for file_path, exist_flag in zip(image_file_paths, exists):
             if exist_flag is False:
@@ -90,49 +208,66 @@ class RstDocParser:
         """
 
         if replace_dict:
-            file_content = self._read_file()
-            for old_str in replace_dict:
-                file_content = file_content.replace(old_str, replace_dict[old_str])
-            self._write_file(file_content.strip() + os.linesep)
+            self._write_file(replace_all(self._read_file(), replace_dict))
 
-    def format(self) -> None:
+    def format(self) -> bool:
         """
         格式化
+
+        Returns:
+            文档内容是否发生变化, 未变化时不回写文件
         """
-        file_content = self._read_file()
+        content, changed = format_content(self._read_file())
+        if changed:
+            self._write_file(content)
+
+        return changed
 
-        # 替换中文标点
-        file_content = (
-            file_content.replace("。", ".")
-            .replace("，", ",")
-            .replace("（", "(")
-            .replace("）", ")")
-            .replace("、", ",")
-            .replace("！", "!")
-            .replace("：", ":")
-            .replace("“", '"')
-            .replace("”", '"')
-            .replace("；", ";")
-            .replace("？", "?")
-        )
-
-        # 去除中文之间的多余空格
-        file_content = re.sub(r"([\u4e00-\u9fa5]) +([\u4e00-\u9fa5])", r"\1\2", file_content)
-        # 去除英文之间的多余空格
-        file_content = re.sub(r"\b([a-zA-Z]) +([a-zA-Z])\b", r"\1 \2", file_content)
-        # 中英文之间添加一个空格
-        file_content = re.sub(r"([\u4e00-\u9fa5]) *([a-zA-Z])", r"\1 \2", file_content)
-        file_content = re.sub(r"([a-zA-Z]) *([\u4e00-\u9fa5])", r"\1 \2", file_content)
-        # 中文数字之间添加一个空格
-        file_content = re.sub(r"([\u4e00-\u9fa5]) *(\d+)", r"\1 \2", file_content)
-        file_content = re.sub(r"(\d+) *([\u4e00-\u9fa5])", r"\1 \2", file_content)
-        # 删除多余的换行
-        file_content = re.sub(r"\n\n+", r"\n\n", file_content)
-
-        self._write_file(file_content.strip() + os.linesep)
+    def rewrite(self, replace_dict: Dict[str, str] | None = None) -> bool:
+        """
+        更新图片路径并格式化, 文件只读取一次, 最多写入一次
+
+        Args:
+            replace_dict: 图片路径替换字典 {old_path: new_path}
+
+        Returns:
+            文档内容是否发生变化, 未变化时不回写文件
+        """
+        original = self._read_file()
+        content, _ = format_content(replace_all(original, replace_dict or {}))
+        if content == original:
+            return False
+
+        self._write_file(content)
+        return True
+
+    def cache_entry(self) -> Dict[str, dict]:
+        """
+        返回当前文档内容对应的元数据缓存项 {内容哈希: 元数据}, 用于把工作进程中的解析结果合并回主进程
+        """
+        content_hash = self._get_content_hash()
+        metadata = _METADATA_CACHE.get(content_hash)
+        return {content_hash: metadata} if metadata is not None else {}
+
+    @staticmethod
+    def merge_cache(entries: Dict[str, dict]) -> None:
+        """
+        合并其他进程产生的元数据缓存项
+        """
+        with _CACHE_LOCK:
+            _METADATA_CACHE.update(entries)
+
+    def _get_content_hash(self) -> str:
+        """当前文档内容的哈希"""
+        if self._hash is None:
+            self._hash = _content_hash(self._read_file())
+        return self._hash
 
     def _read_file(self) -> str:
-        """读取文件"""
+        """读取文件, 同一个实例只读取一次"""
+        if self._content is not None:
+            return self._content
+
         file_path = self.file_path
         content = ""
         with open(file_path, "r", encoding="utf-8") as file:
@@ -140,20 +275,22 @@ class RstDocParser:
         if content == "":
             raise RstDocParserError(f"错误! 文档 {file_path} 读取错误,请检查文件是否非 UTF-8 编码.")
 
+        self._content = content
         return content
 
     def _write_file(self, content: str) -> None:
         """写入文件"""
         file_path = self.file_path
-        write_flag = False
+        content = content.strip() + "\n"
 
-        # 回写文件
-        with open(file_path, "w", encoding="utf-8") as file:
-            file.write(content.strip() + os.linesep)
-            write_flag = True
+        # 原子回写文件
+        try:
+            write_file_atomic(file_path, content)
+        except OSError as error:
+            raise RstDocParserError(f"错误! 文档 {file_path} 写入错误,请检查写入权限.") from error
 
-        if write_flag is False:
-            raise RstDocParserError(f"错误! 文档 {file_path} 写入错误,请检查写入权限.")
+        self._content = content
+        self._hash = None
 
 
 class RstDocParserError(Exception):
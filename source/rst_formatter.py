@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: rst_formatter.py
+文件作者: gaosiyan
+创建时间: 20260108
+功能说明: RST 文档格式化引擎, utils.format() 和 RstDocParser.format() 共用
+"""
+
+import re
+import time
+import threading
+from typing import Callable, Dict, Iterator, List, Tuple
+from functools import partial
+
+# 中文字符范围
+_CJK = "\u4e00-\u9fa5"
+# 英文和数字
+_LATIN = "a-zA-Z\\d"
+
+_CJK_CHAR = re.compile(rf"[{_CJK}]")
+
+# 中文标点替换成英文标点
+# 注: CPython 中 str.translate 处理非 ASCII 文本走通用慢路径, 实测比逐个 str.replace 慢一个数量级,
+# 因此标点映射虽然集中在一张表中, 仍然用 str.replace 执行
+_PUNCTUATION_TABLE = {
+    "。": ".",
+    "，": ",",
+    "（": "(",
+    "）": ")",
+    "、": ",",
+    "！": "!",
+    "：": ":",
+    "“": '"',
+    "”": '"',
+    "；": ";",
+    "？": "?",
+}
+
+# 下面的正则只匹配需要修改的位置, 已经格式化过的文档几乎没有匹配, 不产生替换开销.
+# 每个正则都以字符集或字面量开头, 可以利用 re 模块的前缀快速查找.
+
+# 以中文开头: 中文后面紧跟英文/数字 (插入空格), 中文与英文/数字之间有多个空格 (保留一个), 中文之间有空格 (删除)
+_CJK_PATTERN = re.compile(rf"[{_CJK}](?:(?=[{_LATIN}])|(  +)(?=[{_LATIN}])|( +)(?=[{_CJK}]))")
+
+# 英文/数字后面紧跟中文, 在中文前插入空格
+_LATIN_CJK_PATTERN = re.compile(rf"[{_CJK}](?<=[{_LATIN}][{_CJK}])")
+
+# 多个空格: 英文/数字与中文之间, 单个英文字母之间, 保留一个空格
+_SPACES_PATTERN = re.compile(rf"  +(?=[a-zA-Z{_CJK}])")
+
+# 连续空行只保留一个
+_NEWLINES_PATTERN = re.compile(r"\n\n\n+")
+
+_LATIN_CHAR = re.compile(rf"[{_LATIN}]")
+_WORD_CHAR = re.compile(r"\w")
+
+
+def _replace_cjk(match: re.Match) -> str:
+    """中文之间的空格删除, 中文与英文/数字之间保留一个空格"""
+    char = match.group()[0]
+    return char if match.lastindex == 2 else char + " "
+
+
+def _prepend_space(match: re.Match) -> str:
+    """在中文前插入空格, 回调比模板替换少一次模板展开"""
+    return " " + match.group()
+
+
+def _replace_spaces(match: re.Match) -> str:
+    """根据多个空格前后的字符决定是否合并成一个空格"""
+    text = match.string
+    start, end = match.span()
+    if start == 0:
+        return match.group()
+
+    prev_char = text[start - 1]
+    next_char = text[end]
+    if _CJK_CHAR.match(next_char):
+        # 英文/数字与中文之间
+        return " " if _LATIN_CHAR.match(prev_char) else match.group()
+
+    # 单个英文字母之间, 例如 "a  b"
+    if (
+        prev_char.isascii()
+        and prev_char.isalpha()
+        and (start < 2 or _WORD_CHAR.match(text[start - 2]) is None)
+        and (end + 1 >= len(text) or _WORD_CHAR.match(text[end + 1]) is None)
+    ):
+        return " "
+
+    return match.group()
+
+
+# 逐条规则计时, 由 profiler 开启, 每个线程独立统计 {规则: [调用次数, 累计纳秒]}
+_timing = threading.local()
+
+
+def start_pass_timing() -> None:
+    """开始统计当前线程中每条规则的耗时"""
+    _timing.stats = {}
+
+
+def stop_pass_timing() -> Dict[str, List[int]]:
+    """停止统计, 返回统计结果"""
+    stats = getattr(_timing, "stats", None) or {}
+    _timing.stats = None
+    return stats
+
+
+def _replace_punctuation(text: str) -> str:
+    """中文标点替换成英文标点"""
+    for old, new in _PUNCTUATION_TABLE.items():
+        text = text.replace(old, new)
+    return text
+
+
+# format_text 按顺序执行的规则 (名称, 处理函数), 名称用于逐条规则计时
+_PASSES: Tuple[Tuple[str, Callable[[str], str]], ...] = (
+    ("punctuation", _replace_punctuation),
+    ("cjk", partial(_CJK_PATTERN.sub, _replace_cjk)),
+    ("latin_cjk", partial(_LATIN_CJK_PATTERN.sub, _prepend_space)),
+    ("spaces", partial(_SPACES_PATTERN.sub, _replace_spaces)),
+    ("newlines", partial(_NEWLINES_PATTERN.sub, "\n\n")),
+)
+
+
+def _format_text_timed(text: str, stats: Dict[str, List[int]]) -> str:
+    """按 _PASSES 处理, 记录每条规则的耗时"""
+    clock = time.perf_counter_ns
+    for name, apply in _PASSES:
+        start_ns = clock()
+        text = apply(text)
+        total = stats.setdefault(name, [0, 0])
+        total[0] += 1
+        total[1] += clock() - start_ns
+    return text
+
+
+def format_text(text: str) -> str:
+    """
+    格式化一段文本: 替换中文标点, 规范中英文和数字之间的空格, 删除多余的换行
+
+    Args:
+        text: 待格式化的文本
+
+    Returns:
+        格式化后的文本
+    """
+    # 纯 ASCII 文本只可能命中单个字母之间的多个空格和多余换行两条规则
+    if text.isascii() and "  " not in text and "\n\n\n" not in text:
+        return text
+
+    stats = getattr(_timing, "stats", None)
+    if stats is not None:
+        return _format_text_timed(text, stats)
+
+    for _, apply in _PASSES:
+        text = apply(text)
+    return text
+
+
+# 指令体需要原样保留的指令: 代码, 公式, 原始内容, 目录 (目录项是文档路径)
+LITERAL_DIRECTIVES = frozenset(
+    {
+        "code-block",
+        "code",
+        "sourcecode",
+        "literalinclude",
+        "parsed-literal",
+        "math",
+        "raw",
+        "csv-table",
+        "toctree",
+        "graphviz",
+    }
+)
+
+# 参数是标题文字的指令, 参数按正文格式化, 其他指令的参数 (路径, 语言等) 原样保留
+TITLE_DIRECTIVES = frozenset({"topic", "sidebar", "rubric", "admonition", "table", "list-table", "csv-table"})
+
+# 指令行, 例如 ".. code-block:: python", ".. |name| image:: path"
+_DIRECTIVE_PATTERN = re.compile(r"( *)\.\.[ \t]+(?:\|[^|]+\|[ \t]+)?([A-Za-z][\w:.+-]*)::(?=\s|$)")
+
+# 其他显式标记: 注释, 超链接目标 ".. _label:", 脚注 ".. [1]"
+_EXPLICIT_PATTERN = re.compile(r" *\.\.(?:[ \t]|$)")
+
+# 表格边框, 表格中插入空格会破坏列对齐
+_GRID_TABLE_BORDER = re.compile(r" *\+[-=][-=+]*\+\s*$")
+_SIMPLE_TABLE_BORDER = re.compile(r" *=+(?: +=+)+\s*$")
+
+# 行内需要原样保留的内容: 行内代码, 角色 (:math:, :ref: 等), 解释文本和超链接
+_INLINE_MARKUP = r"``[\s\S]+?``(?!`)|:[\w.+-]+(?::[\w.+-]+)*:`[^`]*`|`[^`]+`_{0,2}"
+_INLINE_PROTECTED_PATTERN = re.compile(_INLINE_MARKUP)
+# 含有 URL 的正文才使用带 URL 分支的正则, URL 分支无法利用前缀快速查找, 会明显拖慢扫描
+_INLINE_PROTECTED_URL_PATTERN = re.compile(_INLINE_MARKUP + r"|\b(?:https?|ftp)://[^\s<>`]+")
+
+
+def _indent_of(line: str) -> int:
+    """行首空格数"""
+    return len(line) - len(line.lstrip(" "))
+
+
+def _is_blank(line: str) -> bool:
+    return line.strip() == ""
+
+
+def _block_end(lines: List[str], start: int, indent: int) -> int:
+    """
+    从 start 开始查找缩进大于 indent 的块的结束位置, 块末尾的空行不属于块
+    """
+    end = start
+    index = start
+    while index < len(lines):
+        line = lines[index]
+        if _is_blank(line) is False:
+            if _indent_of(line) <= indent:
+                break
+            end = index + 1
+        index += 1
+    return end
+
+
+def _table_end(lines: List[str], start: int) -> int:
+    """查找表格的结束位置, start 是表格的第一条边框"""
+    index = start + 1
+    if _GRID_TABLE_BORDER.match(lines[start]):
+        while index < len(lines) and lines[index].lstrip(" ")[:1] in ("+", "|"):
+            index += 1
+        return index
+
+    # 简单表格: 无表头时有 2 条边框, 有表头时有 3 条边框, 最后一条边框后面是空行或文件结尾
+    borders = 1
+    while index < len(lines):
+        line = lines[index]
+        if _SIMPLE_TABLE_BORDER.match(line):
+            borders += 1
+            if borders >= 2 and (index + 1 == len(lines) or _is_blank(lines[index + 1])):
+                return index + 1
+        index += 1
+    return index
+
+
+def _iter_blocks(content: str) -> Iterator[Tuple[bool, str]]:
+    """
+    逐行扫描文档, 把文档切分成 (是否正文, 文本) 块
+
+    原样保留的块: 代码/公式等指令的指令行, 选项和指令体, "::" 之后的字面量块, 注释和超链接目标, 表格.
+    其他指令 (note, figure 等) 的指令体仍然是正文.
+    """
+    lines = content.splitlines(keepends=True)
+    count = len(lines)
+    prose_start = 0  # 当前正文块的起始行
+    literal_indent = None  # 上一段以 "::" 结尾时段落的缩进, 后面缩进更深的块是字面量块
+    index = 0
+
+    def flush(end: int, protected_end: int, prefix: str = "", suffix: str = ""):
+        """输出 [prose_start, end) 的正文和 [end, protected_end) 的保留内容"""
+        if end > prose_start:
+            yield True, "".join(lines[prose_start:end])
+        protected = prefix + "".join(lines[end:protected_end])
+        if protected:
+            yield False, protected
+        if suffix:
+            yield True, suffix
+
+    while index < count:
+        line = lines[index]
+        if _is_blank(line):
+            index += 1
+            continue
+
+        stripped = line.lstrip(" ")
+        indent = len(line) - len(stripped)
+
+        if literal_indent is not None:
+            pending_indent, literal_indent = literal_indent, None
+            if indent > pending_indent:
+                end = _block_end(lines, index, pending_indent)
+                yield from flush(index, end)
+                prose_start = index = end
+                continue
+
+        first_char = stripped[0]
+        if first_char == ".":
+            match = _DIRECTIVE_PATTERN.match(line)
+            if match is not None:
+                name = match.group(2).lower()
+                # 选项紧跟在指令行之后, 缩进更深且以 ":" 开头
+                end = index + 1
+                while end < count and _is_blank(lines[end]) is False and _indent_of(lines[end]) > indent:
+                    if lines[end].lstrip(" ").startswith(":") is False:
+                        break
+                    end += 1
+                if name in LITERAL_DIRECTIVES:
+                    end = max(end, _block_end(lines, end, indent))
+
+                if name in TITLE_DIRECTIVES:
+                    # 指令名原样保留, 标题按正文处理
+                    yield from flush(index, index, line[: match.end()], line[match.end() :])
+                    if end > index + 1:
+                        yield False, "".join(lines[index + 1 : end])
+                else:
+                    yield from flush(index, end)
+                prose_start = index = end
+                continue
+
+            if _EXPLICIT_PATTERN.match(line) is not None and stripped.startswith(".. [") is False:
+                # 注释和超链接目标, 连同缩进更深的后续行
+                end = _block_end(lines, index + 1, indent)
+                yield from flush(index, end)
+                prose_start = index = end
+                continue
+
+        elif first_char in "+=" and (_GRID_TABLE_BORDER.match(line) or _SIMPLE_TABLE_BORDER.match(line)):
+            end = _table_end(lines, index)
+            yield from flush(index, end)
+            prose_start = index = end
+            continue
+
+        if line.rstrip().endswith("::"):
+            literal_indent = indent
+        index += 1
+
+    if count > prose_start:
+        yield True, "".join(lines[prose_start:])
+
+
+def iter_spans(content: str) -> Iterator[Tuple[bool, str]]:
+    """
+    一次线性扫描, 把文档切分成 (是否正文, 文本) 片段, 依次拼接片段即得到原文档
+
+    正文片段中的行内代码, 角色, 超链接和 URL 也会切分成原样保留的片段.
+
+    Args:
+        content: 文档内容
+
+    Yields:
+        (是否正文, 文本)
+    """
+    for is_prose, block in _iter_blocks(content):
+        if is_prose is False:
+            yield False, block
+            continue
+
+        pattern = _INLINE_PROTECTED_URL_PATTERN if "://" in block else _INLINE_PROTECTED_PATTERN
+        position = 0
+        for match in pattern.finditer(block):
+            if match.start() > position:
+                yield True, block[position : match.start()]
+            yield False, match.group()
+            position = match.end()
+        if position < len(block):
+            yield True, block[position:]
+
+
+def format_content(content: str) -> Tuple[str, bool]:
+    """
+    格式化整篇文档, 只处理正文, 代码, 公式, 行内代码, URL 等原样保留
+
+    Args:
+        content: 文档内容
+
+    Returns:
+        (格式化后的内容, 内容是否发生变化), 调用方据此跳过回写
+    """
+    # 只格式化正文, 代码, 公式, 行内代码, URL 等原样保留
+    formatted = "".join(format_text(text) if is_prose else text for is_prose, text in iter_spans(content))
+    # 文本模式写入时 "\n" 会按平台转换为换行符, 与读取结果比较才能判断是否变化
+    formatted = formatted.strip() + "\n"
+    return formatted, formatted != content
@@ -11,22 +11,111 @@ import os
 import sys
 import time
 import shutil
+import argparse
 from pathlib import Path
+from typing import Dict, Set
 from sphinx.application import Sphinx
 
-from utils import rename_files_by_sha1, replace_file, format, execute_in_parallel
+from utils import rename_images_by_hash, read_hash_algorithm, replace_file_batch, format, execute_in_parallel
+from utils import HASH_ALGORITHMS, TaskError
+from file_hash_manifest import FileHashManifest
+from image_optimizer import optimize_images
+from profiler import Profiler, phase, get_active_profiler
+from parallel_build import ParallelBuild, resolve_jobs, jobs_argument
+from build_manifest import build_manifest, print_diff, ManifestError
+from prebuild_check import PrebuildCheck
+from extensions.image_index import ImageIndex, get_image_index
 
 
-def sphinx_format():
+def update_image_references(
+    image_index: ImageIndex, src_dir: str, image_relative_dir: str, rename_dict: Dict[str, str]
+) -> Set[str]:
+    """
+    按图片重命名字典更新文档中的图片路径, 同步更新图片索引
+
+    Args:
+        image_index: 图片引用双向索引
+        src_dir: source 目录
+        image_relative_dir: 图片目录相对 source 目录的路径, 例如 _static/images
+        rename_dict: 图片重命名字典 {old_name: new_name}
+
+    Returns:
+        被改写过的文档
+    """
+    # 按文档汇总需要替换的图片路径, 每篇文档只读写一次
+    doc_replace_dict = {}  # {doc: {old_path: new_path}}
+    for old_name in rename_dict:
+        new_name = rename_dict[old_name]
+        if old_name != new_name:
+            old_path = image_relative_dir + "/" + old_name  # 将 1.png 换成 _static/1.png,因为图片索引是按照路径存放的
+            new_path = old_path.replace(old_name, new_name)
+            for doc in image_index.get_documents(old_path):
+                doc_replace_dict.setdefault(doc, {})[old_path] = new_path
+            image_index.rename(old_path, new_path)
+
+    changed_docs = set()
+    for doc, replace_dict in doc_replace_dict.items():
+        if replace_file_batch(os.path.join(src_dir, doc + ".rst"), replace_dict):
+            changed_docs.add(doc)
+
+    return changed_docs
+
+
+def remove_unused_images(image_index: ImageIndex, image_dir: str, image_relative_dir: str, temp_dir: str) -> int:
+    """
+    把没有被任何文档引用的图片移到 temp_dir
+
+    Args:
+        image_index: 图片引用双向索引
+        image_dir: 图片目录
+        image_relative_dir: 图片目录相对 source 目录的路径, 例如 _static/images
+        temp_dir: 移出的图片存放目录
+
+    Returns:
+        移出的图片数
+    """
+    remove_image_cnt = 0
+    for image_file in os.listdir(image_dir):
+        if image_index.is_used(image_relative_dir + "/" + image_file) is False:
+            shutil.move(os.path.join(image_dir, image_file), os.path.join(temp_dir, image_file))
+            remove_image_cnt += 1
+    return remove_image_cnt
+
+
+def sphinx_format(
+    full: bool = False,
+    manifest: FileHashManifest | None = None,
+    hash_algorithm: str | None = None,
+    root_dir: str | None = None,
+    quiet: bool = False,
+    jobs: int | str = "auto",
+    fingerprint: bool = True,
+    precheck: bool = False,
+):
     """
     格式化 sphinx 文档项目
+
+    默认为增量模式: 保留 build/doctrees 中的 doctree 缓存和 environment.pickle,
+    两次编译都只处理有变化的文档, 第二次编译只重新读取格式化和图片重命名步骤实际改写过的文档.
+
+    Args:
+        full: 为 True 时删除之前的编译产出, 强制全量编译
+        manifest: 图片哈希清单, 为 None 时使用 .cache/image_manifest.json
+        hash_algorithm: 图片命名使用的哈希算法, 为 None 时使用 conf.py 中的 image_hash_algorithm;
+            与其不同时重命名全部图片并更新引用, 再把新算法写入 conf.py
+        root_dir: Sphinx 根目录 (包含 source 目录), 为 None 时是本文件所在目录的上一级
+        quiet: 为 True 时不输出 Sphinx 的编译进度, 只输出告警
+        jobs: Sphinx 读取和写入文档的进程数, "auto" 为 CPU 核数; 有扩展没有声明并行安全时对应阶段改为串行
+        fingerprint: 为 True 时编译成功后为 CSS, JS 和图片文件名加内容指纹, 生成输出清单 .cache/build_manifest.json
+            和与上次编译的差异 build/deploy_diff.json
+        precheck: 为 True 时用 prebuild_check 代替第一次编译收集图片和文档, 检查通过后只编译一次
     """
 
     start_time = time.time()
 
     image_relative_dir = "_static/images"
     # Step 1. 环境配置和基线编译
-    ROOT_DIR = Path(__file__).resolve().parent.parent  # Sphinx 根目录
+    ROOT_DIR = root_dir or Path(__file__).resolve().parent.parent  # Sphinx 根目录
     SRC_DIR = os.path.join(ROOT_DIR, "source")  # 源码目录
     CONFIG_DIR = SRC_DIR  # conf.py 的目录
     BUILD_DIR = os.path.join(ROOT_DIR, "build")  # 编译输出根目录
@@ -34,9 +123,11 @@ def sphinx_format():
     HTML_DIR = os.path.join(BUILD_DIR, "html")  # HTML 输出根目录
     DOC_TREE_DIR = os.path.join(BUILD_DIR, "doctrees")  # doctrees 目录
     TEMP_DIR = os.path.join(ROOT_DIR, "TEMP")  # 源码目录
+    CACHE_DIR = os.path.join(ROOT_DIR, ".cache")  # 跨编译保留的缓存目录, --full 不会删除
+    hash_algorithm = hash_algorithm or read_hash_algorithm(CONFIG_DIR)
 
-    # 删除之前的编译产出
-    if os.path.isdir(BUILD_DIR):
+    # 全量模式下删除之前的编译产出
+    if full and os.path.isdir(BUILD_DIR):
         try:
             shutil.rmtree(BUILD_DIR)
         except:
@@ -46,71 +137,177 @@ def sphinx_format():
     if os.path.isdir(TEMP_DIR) is False:
         os.mkdir(TEMP_DIR)
 
+    # 预检查模式: 不启动 Sphinx, 解析文档得到图片引用和文档列表, 检查不通过时不编译
+    prebuild_check = None
+    if precheck:
+        with phase("预检查"):
+            prebuild_check = PrebuildCheck(SRC_DIR, os.path.join(CACHE_DIR, "prebuild_index.json"))
+            prebuild_check.run(image_relative_dir)
+        prebuild_check.print_report()
+        if prebuild_check.ok is False:
+            print("错误! 预检查未通过,请检查输出信息.")
+            sys.exit(1)
+
     app = Sphinx(
         srcdir=SRC_DIR,  # source 目录
         confdir=CONFIG_DIR,  # conf.py 的目录
         outdir=HTML_DIR,  # html 输出目录
         doctreedir=DOC_TREE_DIR,  # doctrees 目录
         buildername="html",  # 编译输出格式
-        # status=None,  # 打印输出
+        status=None if quiet else sys.stdout,  # 打印输出
         # warning=None,  # 告警输出
         warningiserror=True,  # 严格模式
+        parallel=resolve_jobs(jobs),  # 并行读取和写入的进程数
     )
+    parallel_build = ParallelBuild(app)
+    parallel_build.print_check()
 
-    app.build()  # 编译
+    profiler = get_active_profiler()
+    if profiler is not None:
+        profiler.connect_sphinx(app)
 
-    if app.statuscode != 0:
-        print("错误! 编译失败,请检查输出信息.")
-        sys.exit(0)
+    if prebuild_check is None:
+        with phase("第一次编译"):
+            app.build()  # 编译
+
+        if app.statuscode != 0:
+            print("错误! 编译失败,请检查输出信息.")
+            sys.exit(0)
 
     """
     app.builder.env.images (app.builder.env.images)是一个字典,描述了项目中的所有图片,结构如下:
     {'_static/34281dec3876fd628d692bc704d541380eb68139.png': ({'sphinx/基础教程', 'sphinx/项目部署'}, '34281dec3876fd628d692bc704d541380eb68139.png'), 
     '_static/cb415eae31351d256f8214b271c8b43266150368.png': ({'sphinx/项目部署'}, 'cb415eae31351d256f8214b271c8b43266150368.png')}
 
+    extensions.image_index 在 env 上维护图片与文档的双向索引, 相当于 env.images 的反向补充:
+    image_index.get_documents('_static/1.png') -> {'sphinx/基础教程', 'sphinx/项目部署'}
+    image_index.get_images('sphinx/项目部署') -> {'_static/1.png', '_static/2.png'}
+
     app.builder.env.all_docs (app.env.all_docs)是一个字典,描述了项目中的所有文档,结构如下:
     {'index': 1766833110783521, 'sphinx/基础教程': 1766833110786802, 'sphinx/最佳实践': 1766833110789712, 'sphinx/项目部署': 1766833110803779, 'sphinx/高阶功能': 1766833110807224}
     """
 
     # Step 2. 重命名图片,并更新 rst 文档
-    rename_dict = rename_files_by_sha1(IMAGE_DIR)  #  重命名文件,并返回字典,{old_name:new_name}
+    if manifest is None:
+        manifest = FileHashManifest(os.path.join(CACHE_DIR, "image_manifest.json"))
+    with phase("图片重命名"):
+        rename_dict = rename_images_by_hash(IMAGE_DIR, CONFIG_DIR, manifest, hash_algorithm)  #  重命名文件,并返回字典,{old_name:new_name}
 
-    # 更新图片
-    for old_name in rename_dict:
-        new_name = rename_dict[old_name]
-        if old_name != new_name:
-            old_path = image_relative_dir + "/" + old_name  # 将 1.png 换成 _static/1.png,因为 app.builder.env.images 是按照路径存放的
-            new_path = old_path.replace(old_name, new_name)
-            if old_path in app.builder.env.images:
-                for rst_file_path in app.builder.env.images[old_path][0]:
-                    replace_file(os.path.join(SRC_DIR, rst_file_path + ".rst"), old_path, new_path)
+    # 图片引用双向索引, 由 extensions.image_index 在编译时增量维护, 重命名和冗余图片检查都是字典查询
+    # 预检查模式下由预检查的解析结果构建
+    image_index = get_image_index(app) if prebuild_check is None else prebuild_check.image_index
 
-    # Step 3. 删除冗余图片
-    remove_image_cnt = 0
-    for image_file in os.listdir(IMAGE_DIR):
-        if image_relative_dir + "/" + image_file not in app.builder.env.images:
-            old_path = os.path.join(IMAGE_DIR, image_file)
-            new_path = os.path.join(TEMP_DIR, image_file)
-            shutil.move(old_path, new_path)
-            remove_image_cnt += 1
-    print(f"删除 {remove_image_cnt} 张图片.")
+    # 更新图片, changed_docs 是被改写过的文档, 决定第二次编译的范围
+    with phase("更新图片引用"):
+        changed_docs = update_image_references(image_index, SRC_DIR, image_relative_dir, rename_dict)
+
+    # Step 3. 删除冗余图片, 预检查模式下预检查可能漏掉扩展指令中的图片, 编译后按 env.images 确认再删除
+    if prebuild_check is None:
+        with phase("删除冗余图片"):
+            remove_image_cnt = remove_unused_images(image_index, IMAGE_DIR, image_relative_dir, TEMP_DIR)
+        print(f"删除 {remove_image_cnt} 张图片.")
+
+    # 图片优化, 按哈希缓存在 .cache/images 中, 每张图片只处理一次
+    with phase("图片优化"):
+        optimized_cnt = optimize_images(IMAGE_DIR, os.path.join(CACHE_DIR, "images"), manifest, hash_algorithm)
+    if optimized_cnt is None:
+        print("未安装 Pillow, 跳过图片优化.")
+    elif optimized_cnt:
+        print(f"优化 {optimized_cnt} 张图片.")
 
     # Step 4. 格式化 rst 文档
+    doc_list = list(app.builder.env.all_docs) if prebuild_check is None else prebuild_check.docs
     rst_file_list = []
-    for doc in list(app.builder.env.all_docs):
+    for doc in doc_list:
         rst_file_list.append(os.path.join(SRC_DIR, f"{doc}.rst"))
-    execute_in_parallel(format, rst_file_list)
+    with phase("格式化文档", documents=len(rst_file_list)):
+        format_results = execute_in_parallel(format, rst_file_list)
+    for doc, result in zip(doc_list, format_results):
+        if isinstance(result, TaskError):
+            print(f"警告! 文档 {doc} 格式化失败: {result.error}")
+        elif result:
+            changed_docs.add(doc)
+
+    # 增量编译, Sphinx 根据 mtime 只重新读取被改写的文档
+    if prebuild_check is not None:
+        with phase("编译", documents=len(doc_list)):
+            app.build()  # 预检查模式下唯一的一次编译
+        if app.statuscode == 0:
+            with phase("删除冗余图片"):
+                remove_image_cnt = remove_unused_images(get_image_index(app), IMAGE_DIR, image_relative_dir, TEMP_DIR)
+            print(f"删除 {remove_image_cnt} 张图片.")
+    elif full or changed_docs or optimized_cnt:
+        print(f"重新编译 {len(changed_docs)} 篇被改写的文档.")
+        # builder.images 会累积第一次编译收集的图片, 其中有重命名前的文件名, 不清空会复制已不存在的图片
+        app.builder.images.clear()
+        with phase("第二次编译", documents=len(changed_docs)):
+            app.build()  # 编译
+    else:
+        print("文档没有变化, 跳过第二次编译.")
 
-    app.build()  # 编译
+    if app.statuscode == 0:
+        try:
+            with phase("输出清单"):
+                diff = build_manifest(
+                    HTML_DIR,
+                    os.path.join(CACHE_DIR, "build_manifest.json"),
+                    os.path.join(BUILD_DIR, "deploy_diff.json"),
+                    fingerprint=fingerprint,
+                    algorithm=hash_algorithm,
+                )
+            print_diff(diff)
+        except ManifestError as e:
+            print(e)
 
     end_time = time.time()
     elapsed = end_time - start_time
 
     if app.statuscode != 0:
-        print("错误! 编译失败,请检查输出信息.程序耗时: {elapsed:.4f} 秒")
+        print(f"错误! 编译失败,请检查输出信息.程序耗时: {elapsed:.4f} 秒")
     else:
         print(f"格式化成功!,程序耗时: {elapsed:.4f} 秒")
+    parallel_build.print_report()
 
 
 if __name__ == "__main__":
-    sphinx_format()
+    arg_parser = argparse.ArgumentParser(description="格式化 sphinx 文档项目")
+    arg_parser.add_argument("--full", action="store_true", help="删除 build 目录, 强制全量编译")
+    arg_parser.add_argument(
+        "--hash",
+        choices=sorted(HASH_ALGORITHMS),
+        help="图片命名使用的哈希算法, 默认使用 conf.py 中的 image_hash_algorithm, 指定其他算法时重命名全部图片并写入 conf.py",
+    )
+    arg_parser.add_argument(
+        "-j", "--jobs", type=jobs_argument, default="auto", help="Sphinx 并行编译的进程数, 默认 auto (CPU 核数)"
+    )
+    arg_parser.add_argument("--no-fingerprint", action="store_true", help="不为 CSS, JS 和图片文件名加内容指纹")
+    arg_parser.add_argument(
+        "--precheck", action="store_true", help="编译前先检查图片和 toctree, 不做第一次编译, 检查通过后只编译一次"
+    )
+    arg_parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=os.path.join(Path(__file__).resolve().parent.parent, "build", "profile"),
+        metavar="DIR",
+        help="记录各阶段, 每篇文档, 并行任务和格式化规则的耗时, 保存到 DIR (默认 build/profile). "
+        "默认的 -j auto 在子进程中读取/写入文档, 不记录每篇文档的耗时, 需要时加 -j 1",
+    )
+    arg_parser.add_argument("--cprofile", action="store_true", help="与 --profile 一起使用, 同时记录 cProfile 数据")
+    arg_parser.add_argument("--tracemalloc", action="store_true", help="与 --profile 一起使用, 同时记录内存分配")
+    args = arg_parser.parse_args()
+
+    options = dict(
+        full=args.full,
+        hash_algorithm=args.hash,
+        jobs=args.jobs,
+        fingerprint=not args.no_fingerprint,
+        precheck=args.precheck,
+    )
+    if args.profile is None:
+        sphinx_format(**options)
+    else:
+        with Profiler(cprofile=args.cprofile, memory=args.tracemalloc) as profiler:
+            sphinx_format(**options)
+        profiler.print_summary()
+        profiler.save(args.profile)
+        print(f"性能分析结果保存在 {args.profile}")
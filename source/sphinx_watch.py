@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: sphinx_watch.py
+文件作者: gaosiyan
+创建时间: 20260114
+功能说明: 常驻监视模式, 代替反复运行 sphinx_format.py
+
+Sphinx 应用和 environment 常驻内存, 轮询 source 目录, 变化稳定后:
+    1. 只格式化变化的 rst 文档;
+    2. 增量编译;
+    3. 图片目录有变化时, 按哈希清单只计算新图片的哈希, 重命名并更新引用, 再增量编译一次;
+conf.py, 扩展或扩展依赖的模块变化时, 重新导入变化的模块后重建 Sphinx 应用;
+内置 HTTP 服务, 编译完成后浏览器自动刷新.
+
+用法:
+    python source/sphinx_watch.py --port 8000 --open
+"""
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import threading
+import traceback
+import webbrowser
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, List, Set, Tuple
+from functools import partial
+from contextlib import ExitStack
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from sphinx.application import Sphinx
+from sphinx.util.docutils import docutils_namespace
+
+from utils import rename_images_by_hash, read_hash_algorithm, format, HASH_ALGORITHMS
+from file_hash_manifest import FileHashManifest
+from sphinx_format import update_image_references
+from parallel_build import ParallelBuild, resolve_jobs, jobs_argument
+from extensions.image_index import get_image_index
+
+IMAGE_RELATIVE_DIR = "_static/images"
+
+# 浏览器轮询编译序号的地址
+BUILD_ID_PATH = "/__build_id__"
+
+# 注入到页面中的自动刷新脚本, 编译序号变化时刷新页面
+_RELOAD_SCRIPT = f"""
+<script>
+(function () {{
+    var buildId = null;
+    setInterval(function () {{
+        fetch("{BUILD_ID_PATH}", {{cache: "no-store"}})
+            .then(function (response) {{ return response.text(); }})
+            .then(function (text) {{
+                if (buildId !== null && text !== buildId) {{ location.reload(); }}
+                buildId = text;
+            }})
+            .catch(function () {{}});
+    }}, 300);
+}})();
+</script>
+""".encode("utf-8")
+
+
+def snapshot(src_dir: str) -> Dict[str, Tuple[int, int]]:
+    """
+    记录目录中所有文件的 (mtime_ns, size), 跳过隐藏目录, __pycache__ 和写入中的临时文件
+    """
+    result = {}
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = [name for name in dirs if name.startswith(".") is False and name != "__pycache__"]
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue  # 遍历过程中被删除
+            result[file_path] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+def _module_dependencies(module: ModuleType, candidates: Dict[str, ModuleType]) -> Set[str]:
+    """模块通过 import 或 from ... import 引用的 candidates 中的模块"""
+    names = set()
+    for value in vars(module).values():
+        name = value.__name__ if isinstance(value, ModuleType) else getattr(value, "__module__", None)
+        if name in candidates and name != module.__name__:
+            names.add(name)
+    return names
+
+
+def reload_extensions(src_dir: str, changed_paths: Set[str]) -> List[str]:
+    """
+    重新导入有变化的扩展, 以及扩展直接或间接依赖的 source 目录下有变化的模块
+
+    Sphinx 用 import_module 加载扩展, 不重新导入时新建的应用仍然使用 sys.modules 中的旧代码.
+    依赖有变化的模块也要重新导入, 否则其中 from ... import 得到的名字仍指向旧代码; 按依赖顺序先导入被依赖的模块.
+
+    Args:
+        src_dir: source 目录
+        changed_paths: 有变化的文件
+
+    Returns:
+        重新导入的模块名
+    """
+    src_prefix = os.path.normcase(os.path.abspath(src_dir)) + os.sep
+    loaded = {}  # {模块名: 模块}, source 目录下已导入的模块
+    for name, module in list(sys.modules.items()):
+        file_path = getattr(module, "__file__", None)
+        if name != "__main__" and file_path and os.path.normcase(os.path.abspath(file_path)).startswith(src_prefix):
+            loaded[name] = module
+    dependencies = {name: _module_dependencies(module, loaded) for name, module in loaded.items()}
+
+    # 扩展和扩展依赖的模块
+    scope = set()
+    pending = [name for name in loaded if name.startswith("extensions.")]
+    while pending:
+        name = pending.pop()
+        if name not in scope:
+            scope.add(name)
+            pending.extend(dependencies[name])
+
+    changed = {os.path.normcase(os.path.abspath(file_path)) for file_path in changed_paths}
+    stale = {name for name in scope if os.path.normcase(os.path.abspath(loaded[name].__file__)) in changed}
+    while True:
+        dependents = {name for name in scope - stale if dependencies[name] & stale}
+        if not dependents:
+            break
+        stale |= dependents
+
+    reloaded = []
+
+    def reload(name: str) -> None:
+        if name in reloaded:
+            return
+        reloaded.append(name)  # 先记录, 循环依赖时不会无限递归
+        for dependency in sorted(dependencies[name] & stale):
+            reload(dependency)
+        importlib.reload(loaded[name])
+
+    for name in sorted(stale):
+        reload(name)
+    return reloaded
+
+
+class SphinxWatcher:
+    """常驻内存的 Sphinx 应用, 按文件变化增量格式化和编译"""
+
+    def __init__(
+        self,
+        root_dir: str | None = None,
+        interval: float = 0.1,
+        debounce: float = 0.2,
+        hash_algorithm: str | None = None,
+        jobs: int | str = "auto",
+    ) -> None:
+        """
+        root_dir: Sphinx 根目录, 为 None 时是本文件所在目录的上一级
+        interval: 轮询间隔 (秒)
+        debounce: 检测到变化后, 文件保持不变的时间 (秒), 编辑器保存时会连续写入多次
+        hash_algorithm: 图片命名使用的哈希算法, 为 None 时使用 conf.py 中的 image_hash_algorithm
+        jobs: Sphinx 并行编译的进程数, "auto" 为 CPU 核数, 修改的文档较少时 Sphinx 仍然串行读取
+        """
+        root_dir = root_dir or Path(__file__).resolve().parent.parent
+        self.src_dir = os.path.join(root_dir, "source")
+        self.image_dir = os.path.join(self.src_dir, IMAGE_RELATIVE_DIR)
+        self.html_dir = os.path.join(root_dir, "build", "html")
+        self.doctree_dir = os.path.join(root_dir, "build", "doctrees")
+        self.interval = interval
+        self.debounce = debounce
+        self.hash_algorithm = hash_algorithm or read_hash_algorithm(self.src_dir)
+        self.manifest = FileHashManifest(os.path.join(root_dir, ".cache", "image_manifest.json"))
+        self.build_id = 0
+        self.jobs = jobs
+        self._namespace: ExitStack | None = None
+        self.app = self._create_app()
+
+    def _create_app(self) -> Sphinx:
+        # 与 sphinx-build 一样在 docutils_namespace 中创建应用, 重建时先撤销上一个应用注册的指令, 角色和节点,
+        # 否则每次重建都会对已注册的节点类输出告警
+        if self._namespace is not None:
+            self._namespace.close()
+        self._namespace = ExitStack()
+        self._namespace.enter_context(docutils_namespace())
+        app = Sphinx(
+            srcdir=self.src_dir,
+            confdir=self.src_dir,
+            outdir=self.html_dir,
+            doctreedir=self.doctree_dir,
+            buildername="html",
+            warningiserror=False,  # 监视模式下告警不中断, 修改后重新编译即可
+            parallel=resolve_jobs(self.jobs),
+        )
+        # 重新加载后扩展可能变化, 每次创建应用都重新检查并行声明
+        self.parallel_build = ParallelBuild(app)
+        self.parallel_build.print_check()
+        return app
+
+    def build(self) -> None:
+        """增量编译, Sphinx 根据 mtime 只重新读取有变化的文档"""
+        # builder.images 会累积之前编译收集的图片, 其中可能有已重命名的文件
+        self.app.builder.images.clear()
+        self.app.build()
+        self.build_id += 1
+
+    def process(self, changed_paths: Set[str]) -> Set[str]:
+        """
+        处理一批变化的文件
+
+        Args:
+            changed_paths: 新增, 修改或删除的文件
+
+        Returns:
+            本次处理中改写, 重命名的文件, 调用方据此忽略自身写入引起的变化
+        """
+        touched = set()
+
+        # conf.py, 扩展或扩展依赖的模块变化时重建 Sphinx 应用, Sphinx 会根据配置判断哪些文档需要重新读取
+        reloaded = reload_extensions(self.src_dir, {path for path in changed_paths if path.endswith(".py")})
+        if reloaded or os.path.join(self.src_dir, "conf.py") in changed_paths:
+            if reloaded:
+                print(f"重新导入 {', '.join(reloaded)}.")
+            print("配置或扩展有变化, 重新加载 Sphinx.")
+            self.app = self._create_app()
+
+        for file_path in sorted(changed_paths):
+            if file_path.endswith(".rst") and os.path.isfile(file_path):
+                if format(file_path):
+                    touched.add(file_path)
+
+        self.build()
+
+        image_prefix = self.image_dir + os.sep
+        if any(file_path.startswith(image_prefix) for file_path in changed_paths):
+            # 哈希清单中记录了已有图片, 只计算新增和修改的图片
+            # 切换算法后会改写 conf.py, 属于自身写入, 不触发重新加载
+            conf_path = os.path.join(self.src_dir, "conf.py")
+            if self.hash_algorithm != read_hash_algorithm(self.src_dir):
+                touched.add(conf_path)
+            rename_dict = rename_images_by_hash(self.image_dir, self.src_dir, self.manifest, self.hash_algorithm) or {}
+            for old_name, new_name in rename_dict.items():
+                touched.add(os.path.join(self.image_dir, old_name))
+                touched.add(os.path.join(self.image_dir, new_name))
+
+            changed_docs = update_image_references(
+                get_image_index(self.app), self.src_dir, IMAGE_RELATIVE_DIR, rename_dict
+            )
+            if changed_docs:
+                touched.update(os.path.join(self.src_dir, doc + ".rst") for doc in changed_docs)
+                self.build()
+
+        return touched
+
+    def _wait_stable(self, current: Dict[str, Tuple[int, int]]) -> Dict[str, Tuple[int, int]]:
+        """等待文件在 debounce 时间内不再变化"""
+        while True:
+            time.sleep(self.debounce)
+            latest = snapshot(self.src_dir)
+            if latest == current:
+                return latest
+            current = latest
+
+    def watch(self) -> None:
+        """轮询 source 目录, 直到 Ctrl+C"""
+        self.build()
+        baseline = snapshot(self.src_dir)
+        print(f"正在监视 {self.src_dir}, 按 Ctrl+C 退出.")
+
+        while True:
+            time.sleep(self.interval)
+            current = snapshot(self.src_dir)
+            if current == baseline:
+                continue
+
+            current = self._wait_stable(current)
+            changed_paths = {
+                file_path
+                for file_path in current.keys() | baseline.keys()
+                if current.get(file_path) != baseline.get(file_path)
+            }
+
+            start_time = time.perf_counter()
+            try:
+                touched = self.process(changed_paths)
+            except Exception:
+                # 单次处理失败不退出, 修改后会再次触发
+                traceback.print_exc()
+                touched = set()
+            elapsed = time.perf_counter() - start_time
+            print(f"[{time.strftime('%H:%M:%S')}] 处理 {len(changed_paths)} 个文件变化, 耗时 {elapsed * 1000:.0f} ms")
+
+            # 以处理前的状态为基线, 只更新自身改写的文件, 处理期间的其他修改在下一轮检测到
+            baseline = current
+            for file_path in touched:
+                try:
+                    stat = os.stat(file_path)
+                    baseline[file_path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    baseline.pop(file_path, None)
+
+
+class LiveReloadHandler(SimpleHTTPRequestHandler):
+    """静态文件服务, 在 HTML 页面中注入自动刷新脚本"""
+
+    def __init__(self, *args, watcher: SphinxWatcher, **kwargs) -> None:
+        self.watcher = watcher
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        if self.path == BUILD_ID_PATH:
+            self._send(str(self.watcher.build_id).encode("utf-8"), "text/plain")
+            return
+
+        file_path = self.translate_path(self.path)
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, "index.html")
+        if file_path.endswith(".html") and os.path.isfile(file_path):
+            with open(file_path, "rb") as file:
+                content = file.read()
+            index = content.rfind(b"</body>")
+            if index == -1:
+                index = len(content)
+            self._send(content[:index] + _RELOAD_SCRIPT + content[index:], "text/html; charset=utf-8")
+            return
+
+        super().do_GET()
+
+    def _send(self, content: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # 浏览器每 300 ms 轮询一次, 不打印访问日志
+
+
+def serve(watcher: SphinxWatcher, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """在后台线程中启动 HTTP 服务"""
+    handler = partial(LiveReloadHandler, directory=watcher.html_dir, watcher=watcher)
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="监视 sphinx 文档项目, 自动格式化和增量编译")
+    arg_parser.add_argument("--host", default="127.0.0.1", help="HTTP 服务地址")
+    arg_parser.add_argument("--port", type=int, default=8000, help="HTTP 服务端口, 为 0 时自动选择")
+    arg_parser.add_argument("--interval", type=float, default=0.1, help="轮询间隔 (秒)")
+    arg_parser.add_argument("--debounce", type=float, default=0.2, help="文件保持不变多久后开始处理 (秒)")
+    arg_parser.add_argument(
+        "--hash",
+        choices=sorted(HASH_ALGORITHMS),
+        help="图片命名使用的哈希算法, 默认使用 conf.py 中的 image_hash_algorithm, 指定其他算法时重命名全部图片并写入 conf.py",
+    )
+    arg_parser.add_argument(
+        "-j", "--jobs", type=jobs_argument, default="auto", help="Sphinx 并行编译的进程数, 默认 auto (CPU 核数)"
+    )
+    arg_parser.add_argument("--open", action="store_true", help="启动后打开浏览器")
+    args = arg_parser.parse_args()
+
+    watcher = SphinxWatcher(interval=args.interval, debounce=args.debounce, hash_algorithm=args.hash, jobs=args.jobs)
+    server = serve(watcher, args.host, args.port)
+    url = f"http://{args.host}:{server.server_address[1]}/"
+    print(f"HTTP 服务: {url}")
+    if args.open:
+        webbrowser.open(url)
+
+    try:
+        watcher.watch()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
@@ -8,50 +8,285 @@
 """
 
 import os
-import multiprocessing
 import re
-from typing import List, Callable, Any
-from concurrent.futures import ProcessPoolExecutor
-from hashlib import sha1
+import atexit
+import threading
+import multiprocessing
+from typing import Dict, Iterator, List, Callable, Any
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from functools import partial
+from hashlib import sha1, blake2b, file_digest
+
+from file_hash_manifest import FileHashManifest
+from rst_formatter import format_content
+from profiler import get_active_profiler, TimedTask
+
+
+# 参数个数少于该值时直接在当前进程串行执行, 省去任务派发的开销
+SERIAL_THRESHOLD = 4
+
+# 参数个数少于该值时即使是 CPU 密集任务也使用线程池, 省去进程启动和序列化的开销
+PROCESS_THRESHOLD = 32
+
+# 模块级执行器, 首次使用时创建, 进程退出时关闭
+_executors: Dict[str, Executor] = {}
+_executors_lock = threading.Lock()
+
+
+class TaskError:
+    """
+    并行任务中单个参数执行失败的记录, 出现在 execute_in_parallel 返回值中对应参数的位置
+
+    只保存异常类型和信息, 保证可以在进程间传递
+    """
+
+    def __init__(self, argument: Any, exc: BaseException) -> None:
+        self.argument = argument
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def __repr__(self) -> str:
+        return f"TaskError({self.argument!r}, {self.error!r})"
+
+
+def io_bound(func: Callable) -> Callable:
+    """
+    标记 I/O 密集型函数 (或会释放 GIL 的函数), execute_in_parallel 自动选择线程池执行
+    """
+    func.io_bound = True
+    return func
 
 
-def execute_in_parallel(func: Callable[[str], Any], arguments: List[str]) -> List[Any] | None:
+def _is_io_bound(func: Callable) -> bool:
+    """判断函数是否标记为 I/O 密集型, 支持 functools.partial 包装"""
+    while isinstance(func, partial):
+        func = func.func
+    return getattr(func, "io_bound", False)
+
+
+def _call_safely(func: Callable[[Any], Any], argument: Any) -> Any:
+    """执行函数并捕获异常, 单个参数失败不影响其他参数"""
+    try:
+        return func(argument)
+    except Exception as exc:
+        return TaskError(argument, exc)
+
+
+def _get_executor(mode: str) -> Executor:
+    """获取模块级执行器, 不存在时创建"""
+    with _executors_lock:
+        executor = _executors.get(mode)
+        if executor is None:
+            if mode == "process":
+                executor = ProcessPoolExecutor(max_workers=multiprocessing.cpu_count())
+            else:
+                executor = ThreadPoolExecutor(max_workers=min(32, multiprocessing.cpu_count() + 4))
+            _executors[mode] = executor
+        return executor
+
+
+def shutdown_executors() -> None:
+    """关闭模块级执行器"""
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        _executors.clear()
+
+
+atexit.register(shutdown_executors)
+
+
+def _choose_mode(func: Callable, argument_count: int) -> str:
+    """根据函数类型和参数个数选择执行方式"""
+    if argument_count < SERIAL_THRESHOLD:
+        return "serial"
+    if _is_io_bound(func) or argument_count < PROCESS_THRESHOLD:
+        return "thread"
+    return "process"
+
+
+def _iter_results(
+    call: Callable[[Any], Any],
+    arguments: List[Any],
+    mode: str,
+    chunksize: int | None,
+) -> Iterator[Any]:
+    """按 mode 执行 call, 按参数顺序逐个产出结果"""
+    if mode == "serial":
+        for argument in arguments:
+            yield call(argument)
+        return
+
+    executor = _get_executor(mode)
+
+    if mode == "process":
+        if chunksize is None:
+            # 每个进程大约分到 4 批, 兼顾派发开销和负载均衡
+            chunksize = max(1, len(arguments) // (multiprocessing.cpu_count() * 4))
+        done = 0
+        try:
+            for result in executor.map(call, arguments, chunksize=chunksize):
+                yield result
+                done += 1
+        except BrokenExecutor:
+            # 工作进程异常退出, 丢弃进程池 (下次调用重建), 剩余参数退回串行执行
+            with _executors_lock:
+                _executors.pop(mode, None)
+            for argument in arguments[done:]:
+                yield call(argument)
+        return
+
+    yield from executor.map(call, arguments)
+
+
+def iter_in_parallel(
+    func: Callable[[Any], Any],
+    arguments: List[Any],
+    mode: str = "auto",
+    chunksize: int | None = None,
+) -> Iterator[Any]:
     """
-    使用进程池并行执行函数
+    并行执行函数, 按参数顺序逐个产出结果, 前面的结果完成后即可处理, 不必等待全部完成
+
+    参数含义同 execute_in_parallel
+    """
+    arguments = list(arguments)
+    if mode == "auto":
+        mode = _choose_mode(func, len(arguments))
+
+    profiler = get_active_profiler()
+    if profiler is None:
+        yield from _iter_results(partial(_call_safely, func), arguments, mode, chunksize)
+        return
+
+    # 开启性能分析时记录每个任务的执行时间, 工作进程中的计时随结果一起传回
+    results = _iter_results(partial(_call_safely, TimedTask(func)), arguments, mode, chunksize)
+    for argument, result in zip(arguments, results):
+        yield profiler.add_task(func, argument, result)
+
+
+def execute_in_parallel(
+    func: Callable[[Any], Any],
+    arguments: List[Any],
+    mode: str = "auto",
+    chunksize: int | None = None,
+) -> List[Any]:
+    """
+    并行执行函数, 执行器在多次调用之间复用
 
     Args:
-        func: 要执行的函数, 接受一个参数
+        func: 要执行的函数, 接受一个参数, 使用进程池时必须是模块级函数 (或其 functools.partial)
         arguments: 参数列表, 每次执行 func 函数时传入的参数
+        mode: 执行方式
+            "auto": 参数少于 SERIAL_THRESHOLD 时串行, @io_bound 函数或参数少于 PROCESS_THRESHOLD 时用线程池, 否则用进程池
+            "serial": 在当前线程串行执行
+            "thread": 线程池
+            "process": 进程池
+        chunksize: 进程池每次派发的参数个数, 为 None 时按参数个数和 CPU 核数计算
 
     Returns:
-        函数返回值列表, 或 None 表示没有执行成功
+        函数返回值列表, 与 arguments 一一对应, 执行失败的参数对应位置为 TaskError
     """
-    # 最大进程数为CPU核数
-    with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        results = list(executor.map(func, arguments))
-        return results
+    return list(iter_in_parallel(func, arguments, mode, chunksize))
 
-    return None
 
+# 可选的文件哈希算法, 摘要长度都是 20 字节 (40 位十六进制), 切换算法后文件名长度不变
+HASH_ALGORITHMS = {
+    "sha1": sha1,
+    "blake2b": partial(blake2b, digest_size=20),
+}
 
-def calculate_file_sha1_code(file_path: str):
+# 默认哈希算法, conf.py 中没有 image_hash_algorithm 时使用
+DEFAULT_HASH_ALGORITHM = "sha1"
+
+# conf.py 中记录图片命名算法的变量, 随仓库提交, 各个入口和 CI 都按同一算法命名, 不会来回重命名
+HASH_ALGORITHM_CONFIG = "image_hash_algorithm"
+
+_HASH_ALGORITHM_RE = re.compile(rf"^{HASH_ALGORITHM_CONFIG}\s*=\s*[\"'](?P<algorithm>[\w-]*)[\"'].*$", re.MULTILINE)
+
+
+def read_hash_algorithm(conf_dir: str) -> str:
     """
-    计算文件的 SHA1 码
+    conf.py 中记录的图片命名算法
+
+    Args:
+        conf_dir: conf.py 所在目录
+
+    Returns:
+        HASH_ALGORITHMS 中的键, 没有记录时为 DEFAULT_HASH_ALGORITHM
+    """
+    try:
+        with open(os.path.join(conf_dir, "conf.py"), "r", encoding="utf-8") as file:
+            match = _HASH_ALGORITHM_RE.search(file.read())
+    except OSError:
+        match = None
+    if match is None:
+        return DEFAULT_HASH_ALGORITHM
+    algorithm = match.group("algorithm")
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"conf.py 中的 {HASH_ALGORITHM_CONFIG} 应为 {', '.join(sorted(HASH_ALGORITHMS))}: {algorithm!r}")
+    return algorithm
+
+
+def save_hash_algorithm(conf_dir: str, algorithm: str) -> None:
+    """把图片命名算法写入 conf.py, 已有记录时替换该行, 否则追加到文件末尾"""
+    conf_path = os.path.join(conf_dir, "conf.py")
+    with open(conf_path, "r", encoding="utf-8") as file:
+        content = file.read()
+    line = f'{HASH_ALGORITHM_CONFIG} = "{algorithm}"'
+    if _HASH_ALGORITHM_RE.search(content):
+        content = _HASH_ALGORITHM_RE.sub(lambda _: line, content, count=1)
+    else:
+        content = content.rstrip("\n") + "\n\n# 图片命名使用的哈希算法, 由 sphinx_format.py --hash 修改\n" + line + "\n"
+    write_file_atomic(conf_path, content)
+
+
+@io_bound  # hashlib 计算较大数据时会释放 GIL
+def calculate_file_hash_code(file_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM):
+    """
+    分块流式计算文件的哈希码, 内存占用与文件大小无关
 
     Args:
         file_path: 文件路径
+        algorithm: 哈希算法, HASH_ALGORITHMS 中的键
 
     Returns:
-        文件的 SHA1 码, 如果读取错误则返回 None
+        文件的哈希码, 如果读取错误则返回 None
     """
     try:
         with open(file_path, mode="rb") as file:
-            content = file.read()
-            return sha1(content).hexdigest()
+            # file_digest 使用固定大小的缓冲区分块读取
+            return file_digest(file, HASH_ALGORITHMS[algorithm]).hexdigest()
     except (IOError, OSError, FileNotFoundError):
         return None
 
 
+def calculate_file_sha1_code(file_path: str):
+    """
+    计算文件的 SHA1 码
+
+    Args:
+        file_path: 文件路径
+
+    Returns:
+        文件的 SHA1 码, 如果读取错误则返回 None
+    """
+    return calculate_file_hash_code(file_path, "sha1")
+
+
+def calculate_files_hash_code_parallel(file_paths: List[str], algorithm: str = DEFAULT_HASH_ALGORITHM):
+    """
+    并行计算文件的哈希码
+
+    Args:
+        file_paths: 文件路径列表
+        algorithm: 哈希算法, HASH_ALGORITHMS 中的键
+
+    Returns:
+        哈希码列表, 对应每个文件的哈希码, 如果读取错误则对应位置为 None
+    """
+    return execute_in_parallel(partial(calculate_file_hash_code, algorithm=algorithm), file_paths)
+
+
 def calculate_files_sha1_code_parallel(file_paths: List[str]):
     """
     并行计算文件的SHA1码
@@ -71,87 +306,258 @@ def calculate_files_sha1_code_parallel(file_paths: List[str]):
         >>>     else:
         >>>         print(f"{file_path}: SHA1码为 {sha1_code}")
     """
-    return execute_in_parallel(calculate_file_sha1_code, file_paths)
+    return calculate_files_hash_code_parallel(file_paths, "sha1")
 
 
-def rename_files_by_sha1(root: str):
-    """
-    重命名文件,并返回已经重命名文件字典 {old_name:new_name}
+def rename_files_by_hash(
+    root: str, manifest: FileHashManifest | None = None, algorithm: str = DEFAULT_HASH_ALGORITHM
+):
     """
-    cwd = os.getcwd()
-    os.chdir(root)
+    按文件内容哈希重命名文件,并返回已经重命名文件字典 {old_name:new_name}
 
-    file_names = os.listdir()
+    已按其他算法命名的文件哈希不一致, 会被重新命名, 调用方按返回的字典更新文档中的引用即完成迁移.
 
-    sha1_codes = calculate_files_sha1_code_parallel(file_names)
+    Args:
+        root: 文件目录
+        manifest: 文件哈希清单, stat 信息与清单一致的文件跳过哈希计算, 为 None 时计算全部文件
+        algorithm: 哈希算法, HASH_ALGORITHMS 中的键
+    """
+    # 所有路径都显式基于 root, 不切换进程工作目录, 可以在线程池中或与 sphinx-autobuild 同时运行
+    with os.scandir(root) as entries:
+        file_entries = [entry for entry in entries if entry.is_file()]
+    file_names = [entry.name for entry in file_entries]
+    file_paths = [entry.path for entry in file_entries]
+    file_stats = [entry.stat() for entry in file_entries]
+
+    hash_codes = [None] * len(file_names)
+    if manifest is not None:
+        hash_codes = [manifest.lookup(file_path, stat, algorithm) for file_path, stat in zip(file_paths, file_stats)]
+
+    # 只计算清单中没有命中的文件
+    pending_indexes = [index for index, hash_code in enumerate(hash_codes) if hash_code is None]
+    if pending_indexes:
+        pending_codes = calculate_files_hash_code_parallel(
+            [file_paths[index] for index in pending_indexes], algorithm
+        )
+        for index, hash_code in zip(pending_indexes, pending_codes):
+            hash_codes[index] = None if isinstance(hash_code, TaskError) else hash_code
 
-    if sha1_codes is None or None in sha1_codes:
+    if None in hash_codes:
         return None
 
     rename_dict = {}
+    final_paths = []
 
-    for file_name, sha1_code in zip(file_names, sha1_codes):
-        file_name_without_ext = os.path.splitext(os.path.basename(file_name))[0]
-        if file_name_without_ext != sha1_code:
+    for file_name, file_stat, hash_code in zip(file_names, file_stats, hash_codes):
+        file_name_without_ext = os.path.splitext(file_name)[0]
+        new_name = file_name
+        if file_name_without_ext != hash_code:
             old_name = file_name
-            new_name = file_name.replace(file_name_without_ext, sha1_code)
+            new_name = file_name.replace(file_name_without_ext, hash_code)
             rename_dict[old_name] = new_name
-            os.rename(old_name, new_name)
+            # os.replace 是原子操作, 目标已存在时 (内容相同的重复图片) 直接覆盖, Windows 下也不会报错
+            os.replace(os.path.join(root, old_name), os.path.join(root, new_name))
+
+        new_path = os.path.join(root, new_name)
+        final_paths.append(new_path)
+        if manifest is not None:
+            # 重命名不改变 inode 和 mtime, 沿用重命名前的 stat
+            manifest.update(new_path, hash_code, file_stat, algorithm)
+
+    if manifest is not None:
+        manifest.retain(final_paths, root)
+        manifest.save()
+
+    return rename_dict
+
 
-    os.chdir(cwd)
+def rename_images_by_hash(
+    root: str, conf_dir: str, manifest: FileHashManifest | None = None, algorithm: str | None = None
+):
+    """
+    按 conf.py 中记录的算法重命名图片, 返回值同 rename_files_by_hash
+
+    指定了与记录不同的算法时按新算法重命名全部图片, 成功后把新算法写入 conf.py, 之后不指定算法的运行沿用新算法.
+
+    Args:
+        root: 图片目录
+        conf_dir: conf.py 所在目录
+        manifest: 文件哈希清单
+        algorithm: 哈希算法, 为 None 时使用 conf.py 中记录的算法
+    """
+    configured = read_hash_algorithm(conf_dir)
+    algorithm = algorithm or configured
+    rename_dict = rename_files_by_hash(root, manifest, algorithm)
+    if rename_dict is not None and algorithm != configured:
+        save_hash_algorithm(conf_dir, algorithm)
+        print(f"图片命名算法由 {configured} 改为 {algorithm}, 已写入 conf.py.")
     return rename_dict
 
 
-def replace_file(file_path: str, old: str, new: str):
-    """替换更新文件"""
-    content = ""
+def rename_files_by_sha1(root: str, manifest: FileHashManifest | None = None):
+    """
+    重命名文件,并返回已经重命名文件字典 {old_name:new_name}
+    """
+    return rename_files_by_hash(root, manifest, "sha1")
+
+
+@io_bound
+def _scan_directory(directory: str) -> frozenset:
+    """列出目录中的文件名, 目录不存在或无法读取时返回空集合"""
+    try:
+        with os.scandir(directory) as entries:
+            return frozenset(os.path.normcase(entry.name) for entry in entries)
+    except OSError:
+        return frozenset()
+
+
+def check_files_exist_parallel(file_paths: List[str]) -> List[bool]:
+    """
+    批量判断文件是否存在
+
+    每个目录只 os.scandir 一次, 建立文件名索引后在内存中回答全部查询,
+    系统调用次数与目录数成正比, 而不是与文件数成正比.
+
+    Args:
+        file_paths: 文件路径列表
+
+    Returns:
+        与 file_paths 一一对应的是否存在列表
+    """
+    split_paths = []
+    for file_path in file_paths:
+        directory, file_name = os.path.split(os.path.abspath(file_path))
+        split_paths.append((directory, os.path.normcase(file_name)))
+
+    directories = list({directory for directory, _ in split_paths})
+    directory_index = dict(zip(directories, execute_in_parallel(_scan_directory, directories)))
+
+    return [file_name in directory_index[directory] for directory, file_name in split_paths]
+
+
+def find_missing_files(references: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """
+    查找整个文档集合中丢失的引用文件, 所有文档共用一次目录扫描
+
+    Args:
+        references: {文档路径: [引用的文件路径]}
+
+    Returns:
+        {文档路径: [丢失的文件路径]}, 只包含有文件丢失的文档
+    """
+    documents = []
+    file_paths = []
+    for document, document_file_paths in references.items():
+        for file_path in document_file_paths:
+            documents.append(document)
+            file_paths.append(file_path)
+
+    missing = {}
+    for document, file_path, exist in zip(documents, file_paths, check_files_exist_parallel(file_paths)):
+        if exist is False:
+            missing.setdefault(document, []).append(file_path)
+
+    return missing
+
+
+def replace_all(content: str, replace_dict: Dict[str, str]) -> str:
+    """
+    一次扫描完成多个字符串替换
+
+    所有待替换字符串合并成一个交替正则, 长的在前, 保证 "a.png" 和 "aa.png" 这类互为子串的路径按最长匹配替换,
+    并且替换结果不会被后续的替换再次修改.
+
+    Args:
+        content: 原文本
+        replace_dict: 替换字典 {old: new}
+
+    Returns:
+        替换后的文本
+    """
+    replace_dict = {old: new for old, new in replace_dict.items() if old and old != new}
+    if not replace_dict:
+        return content
+
+    if len(replace_dict) == 1:
+        ((old, new),) = replace_dict.items()
+        return content.replace(old, new)
+
+    pattern = re.compile("|".join(re.escape(old) for old in sorted(replace_dict, key=len, reverse=True)))
+    return pattern.sub(lambda match: replace_dict[match.group()], content)
+
+
+def write_file_atomic(file_path: str, content: str) -> None:
+    """
+    原子写入文件: 先写入同目录下的临时文件, 再用 os.replace 替换原文件
+
+    写入中途出错时原文件保持不变, Sphinx 也不会读到写了一半的文档
+    """
+    temp_path = file_path + ".tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(temp_path, file_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def replace_file_batch(file_path: str, replace_dict: Dict[str, str]) -> bool:
+    """
+    批量替换更新文件, 文件只读取一次, 最多原子写入一次
+
+    Args:
+        file_path: 文件路径
+        replace_dict: 替换字典 {old: new}
+
+    Returns:
+        文件内容是否发生变化, 未变化时不回写文件, 以免刷新 mtime 触发 Sphinx 增量重编译
+    """
+    original = ""
     with open(file_path, "r", encoding="utf-8") as file:
-        content = file.read().replace(old, new)
+        original = file.read()
+
+    if original == "":
+        return False
+
+    content = replace_all(original, replace_dict).strip() + "\n"
+    if content == original:
+        return False
+
+    write_file_atomic(file_path, content)
+    return True
+
 
-    if content != "":
-        with open(file_path, "w", encoding="utf-8") as file:
-            file.write(content.strip() + os.linesep)
+def replace_file(file_path: str, old: str, new: str) -> bool:
+    """
+    替换更新文件
 
+    Returns:
+        文件内容是否发生变化, 未变化时不回写文件, 以免刷新 mtime 触发 Sphinx 增量重编译
+    """
+    return replace_file_batch(file_path, {old: new})
 
-def format(file_path) -> None:
+
+def format(file_path) -> bool:
     """
     格式化
+
+    Returns:
+        文件内容是否发生变化, 未变化时不回写文件
     """
-    content = ""
+    original = ""
     with open(file_path, "r", encoding="utf-8") as file:
-        content = file.read()
+        original = file.read()
 
-    if content != "":
-        # 替换中文标点
-        content = (
-            content.replace("。", ".")
-            .replace("，", ",")
-            .replace("（", "(")
-            .replace("）", ")")
-            .replace("、", ",")
-            .replace("！", "!")
-            .replace("：", ":")
-            .replace("“", '"')
-            .replace("”", '"')
-            .replace("；", ";")
-            .replace("？", "?")
-        )
+    if original == "":
+        return False
+
+    content, changed = format_content(original)
+    if changed:
+        write_file_atomic(file_path, content)
 
-        # 去除中文之间的多余空格
-        content = re.sub(r"([\u4e00-\u9fa5]) +([\u4e00-\u9fa5])", r"\1\2", content)
-        # 去除英文之间的多余空格
-        content = re.sub(r"\b([a-zA-Z]) +([a-zA-Z])\b", r"\1 \2", content)
-        # 中英文之间添加一个空格
-        content = re.sub(r"([\u4e00-\u9fa5]) *([a-zA-Z])", r"\1 \2", content)
-        content = re.sub(r"([a-zA-Z]) *([\u4e00-\u9fa5])", r"\1 \2", content)
-        # 中文数字之间添加一个空格
-        content = re.sub(r"([\u4e00-\u9fa5]) *(\d+)", r"\1 \2", content)
-        content = re.sub(r"(\d+) *([\u4e00-\u9fa5])", r"\1 \2", content)
-        # 删除多余的换行
-        content = re.sub(r"\n\n+", r"\n\n", content)
-
-        with open(file_path, "w", encoding="utf-8") as file:
-            file.write(content.strip() + os.linesep)
+    return changed
 
 
 if __name__ == "__main__":
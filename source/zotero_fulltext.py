@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: zotero_fulltext.py
+文件作者: gaosiyan
+创建时间: 20260119
+功能说明: 把 zotero/storage/*/.zotero-ft-cache (Zotero 提取的附件全文) 写入 SQLite FTS5 全文索引, 在笔记中检索文献
+
+索引:
+    文本按段落切成约 CHUNK_CHARS 字的块, 每块一行, 检索结果按块给出上下文摘要.
+    FTS5 自带的 unicode61 分词器把连续的汉字当作一个词, 所以写入前先用 jieba 分词:
+    content 列是 jieba.cut 的分词结果, 词之间用零宽空格分隔, 去掉零宽空格即为原文, 摘要直接取自该列;
+    terms 列是 jieba.cut_for_search 额外切出的短词, 例如 "微积分学" 中的 "积分", 提高召回.
+    jieba 切出的中文词同时写入 vocabulary 表.
+
+增量更新:
+    sources 表记录每个全文缓存文件的 mtime 和大小, 只重新索引新增和变化的文件, 删除已不存在的文件.
+    没有变化时不导入 jieba, 更新耗时毫秒级.
+
+检索:
+    查询语句按 vocabulary 表做正向最大匹配分词, 不需要加载 jieba 词典 (约 1 秒), 检索耗时毫秒级.
+    单个汉字按前缀匹配. 结果按 bm25 排序, 每个附件只保留最相关的一块.
+
+用法:
+    python source/zotero_fulltext.py 正确推理         # 更新索引后检索
+    python source/zotero_fulltext.py "Fourier series" --limit 5
+    python source/zotero_fulltext.py --rebuild        # 重建索引
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+from zotero_library import ZoteroLibrary, ZoteroError, query_attachments
+
+FT_CACHE_NAME = ".zotero-ft-cache"
+CHUNK_CHARS = 2000  # 每块的字数, 块越小摘要越准, 索引越大
+SEPARATOR = "\u200b"  # 零宽空格, unicode61 分词器当作分隔符
+MAX_WORD_LENGTH = 8  # 查询分词时词的最大长度
+
+_INDEX_VERSION = "1"
+
+_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS sources (
+    attachment_key TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    item_key TEXT,
+    citekey TEXT,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS vocabulary (term TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(content, terms, attachment_key UNINDEXED, tokenize = 'unicode61');
+"""
+
+_SEARCH_SQL = """
+SELECT chunks.attachment_key, snippet(chunks, 0, ?, ?, '…', 24), bm25(chunks) AS score,
+       sources.item_key, sources.citekey, sources.title
+FROM chunks
+JOIN sources ON sources.attachment_key = chunks.attachment_key
+WHERE chunks MATCH ?
+ORDER BY score
+LIMIT ?
+"""
+
+_CJK_RE = re.compile("[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+_QUERY_TOKEN_RE = re.compile("[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[^\\W_]+")
+
+
+class FullTextError(Exception):
+    """全文索引读写失败"""
+
+    pass
+
+
+def iter_chunks(file_path: str, chunk_chars: int = CHUNK_CHARS) -> Iterator[str]:
+    """逐行读取全文缓存, 按段落拼成约 chunk_chars 字的块, 不一次读入整个文件"""
+    lines: List[str] = []
+    length = 0
+    with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+        for line in file:
+            lines.append(line)
+            length += len(line)
+            # 优先在空行处切分, 块过长时强制切分
+            if (length >= chunk_chars and not line.strip()) or length >= chunk_chars * 2:
+                yield "".join(lines)
+                lines = []
+                length = 0
+    if lines:
+        yield "".join(lines)
+
+
+def tokenize(text: str) -> Tuple[str, str, set]:
+    """
+    jieba 分词
+
+    Returns:
+        (content 列, terms 列, 中文词集合)
+    """
+    import jieba
+
+    words = list(jieba.cut(text))
+    cjk_words = {word for word in words if _CJK_RE.search(word)}
+    extra = [word for word in jieba.cut_for_search(text) if word not in cjk_words and _CJK_RE.search(word)]
+    return SEPARATOR.join(words), " ".join(extra), cjk_words | set(extra)
+
+
+class FullTextIndex:
+    """zotero/storage 全文缓存的 FTS5 索引"""
+
+    def __init__(self, index_path: str, storage_dir: str, zotero_db: str | None = None, cache_dir: str | None = None):
+        """
+        index_path: 索引文件路径, 例如 .cache/zotero/fulltext.sqlite
+        storage_dir: zotero/storage 目录
+        zotero_db: zotero.sqlite 路径, 用来把附件对应到文献的引用键和标题, 为 None 时只记录附件条目键
+        cache_dir: ZoteroLibrary 的缓存目录
+        """
+        self.index_path = index_path
+        self.storage_dir = storage_dir
+        self.zotero_db = zotero_db
+        self.cache_dir = cache_dir
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            try:
+                self._connection = sqlite3.connect(self.index_path)
+                self._connection.executescript(_SCHEMA_SQL)
+            except sqlite3.Error as e:
+                raise FullTextError(f"全文索引 {self.index_path} 打开失败: {e}") from e
+        return self._connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self) -> "FullTextIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _meta(self, key: str) -> str | None:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _scan_storage(self) -> Dict[str, os.stat_result]:
+        """{附件条目键: 全文缓存的 stat}"""
+        result = {}
+        if os.path.isdir(self.storage_dir) is False:
+            return result
+        for entry in os.scandir(self.storage_dir):
+            if entry.is_dir():
+                try:
+                    result[entry.name] = os.stat(os.path.join(entry.path, FT_CACHE_NAME))
+                except OSError:
+                    pass  # 没有提取全文的附件
+        return result
+
+    def _resolve_sources(self, library: ZoteroLibrary) -> Dict[str, Tuple[str | None, str, str]]:
+        items = library.items
+        citekeys = {item["zotero-key"]: citekey for citekey, item in items.items()}
+        result = {}
+        for attachment_key, (parent_key, title) in query_attachments(library.zotero_db).items():
+            citekey = citekeys.get(parent_key, "") if parent_key else ""
+            if citekey:
+                title = items[citekey].get("title", title)
+            result[attachment_key] = (parent_key, citekey, title)
+        return result
+
+    def update(self, rebuild: bool = False) -> Tuple[int, int]:
+        """
+        增量更新索引
+
+        Returns:
+            (重新索引的文件数, 删除的文件数)
+        """
+        connection = self.connection
+        if rebuild or self._meta("version") != _INDEX_VERSION:
+            with connection:
+                connection.executescript("DELETE FROM chunks; DELETE FROM sources; DELETE FROM vocabulary; DELETE FROM meta;")
+
+        stats = self._scan_storage()
+        known = {key: (mtime_ns, size) for key, mtime_ns, size in connection.execute("SELECT attachment_key, mtime_ns, size FROM sources")}
+        changed = sorted(key for key, stat in stats.items() if known.get(key) != (stat.st_mtime_ns, stat.st_size))
+        removed = sorted(known.keys() - stats.keys())
+
+        library = None
+        digest = ""
+        if self.zotero_db is not None and os.path.isfile(self.zotero_db):
+            library = ZoteroLibrary(self.zotero_db, cache_dir=self.cache_dir)
+            try:
+                library.load()
+                digest = library.digest or ""
+            except ZoteroError:
+                library = None
+        if not changed and not removed and digest == self._meta("library_digest"):
+            return 0, 0
+
+        sources = {}
+        if library is not None:
+            try:
+                sources = self._resolve_sources(library)
+            except ZoteroError:
+                pass  # 查询失败时只记录附件条目键
+
+        try:
+            with connection:
+                for key in removed + changed:
+                    connection.execute("DELETE FROM chunks WHERE attachment_key = ?", (key,))
+                    connection.execute("DELETE FROM sources WHERE attachment_key = ?", (key,))
+
+                for key in changed:
+                    vocabulary = set()
+                    rows = []
+                    for chunk in iter_chunks(os.path.join(self.storage_dir, key, FT_CACHE_NAME)):
+                        content, terms, words = tokenize(chunk)
+                        rows.append((content, terms, key))
+                        vocabulary |= words
+                    connection.executemany("INSERT INTO chunks (content, terms, attachment_key) VALUES (?, ?, ?)", rows)
+                    connection.executemany("INSERT OR IGNORE INTO vocabulary VALUES (?)", ((word,) for word in vocabulary))
+                    stat = stats[key]
+                    connection.execute(
+                        "INSERT INTO sources (attachment_key, mtime_ns, size) VALUES (?, ?, ?)",
+                        (key, stat.st_mtime_ns, stat.st_size),
+                    )
+
+                # 文献库变化 (例如修改了引用键) 时所有附件重新对应文献
+                connection.executemany(
+                    "UPDATE sources SET item_key = ?, citekey = ?, title = ? WHERE attachment_key = ?",
+                    (
+                        (*sources.get(key, (None, "", "")), key)
+                        for (key,) in connection.execute("SELECT attachment_key FROM sources").fetchall()
+                    ),
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (("version", _INDEX_VERSION), ("library_digest", digest)),
+                )
+        except (OSError, sqlite3.Error) as e:
+            raise FullTextError(f"全文索引 {self.index_path} 更新失败: {e}") from e
+        return len(changed), len(removed)
+
+    def segment_query(self, query: str) -> List[str]:
+        """按 vocabulary 表正向最大匹配切分查询中的中文, 英文和数字按单词切分"""
+        tokens = []
+        for run in _QUERY_TOKEN_RE.findall(query):
+            if not _CJK_RE.match(run):
+                tokens.append(run)
+                continue
+            candidates = sorted(
+                {run[i:j] for i in range(len(run)) for j in range(i + 2, min(len(run), i + MAX_WORD_LENGTH) + 1)}
+            )
+            known = set()
+            # 一次查询取出所有候选词, 每批不超过 SQLite 参数个数上限
+            for start in range(0, len(candidates), 500):
+                batch = candidates[start : start + 500]
+                sql = f"SELECT term FROM vocabulary WHERE term IN ({', '.join('?' * len(batch))})"
+                known.update(term for (term,) in self.connection.execute(sql, batch))
+            i = 0
+            while i < len(run):
+                j = min(len(run), i + MAX_WORD_LENGTH)
+                while j - i > 1 and run[i:j] not in known:
+                    j -= 1
+                tokens.append(run[i:j])
+                i = j
+        return tokens
+
+    def search(self, query: str, limit: int = 10, highlight: Tuple[str, str] = ("[", "]")) -> List[dict]:
+        """
+        检索
+
+        Returns:
+            按相关性排序的附件列表, 每个附件为
+            {"attachment_key", "item_key", "citekey", "title", "snippet", "score"}, score 越小越相关
+        """
+        tokens = self.segment_query(query)
+        if not tokens:
+            return []
+        # 单个汉字可能只是词的一部分, 按前缀匹配
+        match = " ".join(
+            '"' + token.replace('"', '""') + '"' + (" *" if len(token) == 1 and _CJK_RE.match(token) else "")
+            for token in tokens
+        )
+
+        results: Dict[str, dict] = {}
+        try:
+            # 同一附件可能有多块命中, 多取一些再按附件去重
+            rows = self.connection.execute(_SEARCH_SQL, (*highlight, match, limit * 5)).fetchall()
+        except sqlite3.Error as e:
+            raise FullTextError(f"检索 {query!r} 失败: {e}") from e
+        for attachment_key, snippet, score, item_key, citekey, title in rows:
+            if attachment_key in results:
+                continue
+            results[attachment_key] = {
+                "attachment_key": attachment_key,
+                "item_key": item_key,
+                "citekey": citekey or "",
+                "title": title or attachment_key,
+                "snippet": " ".join(snippet.replace(SEPARATOR, "").split()),
+                "score": score,
+            }
+            if len(results) == limit:
+                break
+        return list(results.values())
+
+
+if __name__ == "__main__":
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="检索 Zotero 附件全文")
+    arg_parser.add_argument("query", nargs="?", default="", help="检索词, 为空时只更新索引")
+    arg_parser.add_argument("--limit", type=int, default=10, help="最多列出的附件数")
+    arg_parser.add_argument("--rebuild", action="store_true", help="重建索引")
+    arg_parser.add_argument("--no-update", action="store_true", help="不更新索引, 直接检索")
+    arg_parser.add_argument("--db", default=os.path.join(root_dir, "zotero", "zotero.sqlite"), help="zotero.sqlite 路径")
+    arg_parser.add_argument("--storage", help="附件目录, 默认与 zotero.sqlite 同目录下的 storage")
+    arg_parser.add_argument("--cache", default=os.path.join(root_dir, ".cache", "zotero"), help="缓存目录, 索引保存为其中的 fulltext.sqlite")
+    args = arg_parser.parse_args()
+
+    storage_dir = args.storage or os.path.join(os.path.dirname(args.db), "storage")
+    with FullTextIndex(os.path.join(args.cache, "fulltext.sqlite"), storage_dir, args.db, args.cache) as index:
+        try:
+            if args.no_update is False:
+                start_time = time.perf_counter()
+                updated, removed = index.update(rebuild=args.rebuild)
+                print(f"更新索引: 重新索引 {updated} 个, 删除 {removed} 个, 耗时 {(time.perf_counter() - start_time) * 1000:.1f} ms")
+            if args.query:
+                start_time = time.perf_counter()
+                results = index.search(args.query, args.limit)
+                elapsed = time.perf_counter() - start_time
+                for result in results:
+                    print(f"{result['citekey'] or result['attachment_key']}: {result['title']}")
+                    print(f"    {result['snippet']}")
+                print(f"共 {len(results)} 个结果, 检索耗时 {elapsed * 1000:.1f} ms")
+        except (FullTextError, ZoteroError) as e:
+            print(e)
+            sys.exit(1)
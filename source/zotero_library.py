@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: zotero_library.py
+文件作者: gaosiyan
+创建时间: 20260118
+功能说明: 从 zotero.sqlite 只读提取文献条目, 转换为 CSL-JSON 结构, 供 extensions.zotero_cite 生成引用
+
+以 immutable URI 模式只读打开数据库, Zotero 运行时持有的文件锁不影响读取, 不需要先从 Zotero 导出.
+注意 immutable 模式不读取 -wal 文件, Zotero 尚未写回主文件的修改要等 Zotero 检查点或关闭后才能读到.
+
+一次 SQL 查询取出所有条目的字段, 作者和 Better BibTeX 引用键, 结果按数据库文件哈希缓存:
+数据库文件没有变化时直接读取缓存, 文件的 stat 信息没有变化时连哈希都不用计算.
+
+引用键的优先级: Better BibTeX 的 citationKey > Zotero 7 的 citationKey 字段 > Zotero 条目键.
+
+用法:
+    python source/zotero_library.py              # 列出所有条目
+    python source/zotero_library.py 微积分        # 按引用键和标题过滤
+"""
+
+import os
+import sys
+import time
+import pickle
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, Mapping, Tuple
+
+from utils import calculate_file_hash_code
+from file_hash_manifest import FileHashManifest
+
+# 不作为文献的条目类型
+SKIPPED_ITEM_TYPES = ("attachment", "note", "annotation")
+
+# Zotero 条目类型 -> CSL 类型, 未列出的类型使用 document
+CSL_TYPES = {
+    "book": "book",
+    "bookSection": "chapter",
+    "journalArticle": "article-journal",
+    "magazineArticle": "article-magazine",
+    "newspaperArticle": "article-newspaper",
+    "conferencePaper": "paper-conference",
+    "thesis": "thesis",
+    "report": "report",
+    "webpage": "webpage",
+    "blogPost": "post-weblog",
+    "forumPost": "post",
+    "encyclopediaArticle": "entry-encyclopedia",
+    "dictionaryEntry": "entry-dictionary",
+    "manuscript": "manuscript",
+    "patent": "patent",
+    "preprint": "article",
+    "computerProgram": "software",
+    "videoRecording": "motion_picture",
+    "film": "motion_picture",
+    "audioRecording": "song",
+    "presentation": "speech",
+    "map": "map",
+    "dataset": "dataset",
+    "standard": "standard",
+}
+
+# Zotero 字段 -> CSL 变量, 未列出的字段不导出
+CSL_FIELDS = {
+    "title": "title",
+    "shortTitle": "title-short",
+    "abstractNote": "abstract",
+    "publicationTitle": "container-title",
+    "bookTitle": "container-title",
+    "proceedingsTitle": "container-title",
+    "websiteTitle": "container-title",
+    "blogTitle": "container-title",
+    "encyclopediaTitle": "container-title",
+    "dictionaryTitle": "container-title",
+    "journalAbbreviation": "container-title-short",
+    "series": "collection-title",
+    "seriesNumber": "collection-number",
+    "publisher": "publisher",
+    "university": "publisher",
+    "institution": "publisher",
+    "place": "publisher-place",
+    "volume": "volume",
+    "numberOfVolumes": "number-of-volumes",
+    "issue": "issue",
+    "pages": "page",
+    "numPages": "number-of-pages",
+    "edition": "edition",
+    "reportNumber": "number",
+    "patentNumber": "number",
+    "thesisType": "genre",
+    "reportType": "genre",
+    "language": "language",
+    "DOI": "DOI",
+    "ISBN": "ISBN",
+    "ISSN": "ISSN",
+    "url": "URL",
+    "accessDate": "accessed",
+    "date": "issued",
+    "extra": "note",
+}
+
+# Zotero 作者类型 -> CSL 姓名变量, 未列出的类型不导出
+CSL_CREATORS = {
+    "author": "author",
+    "editor": "editor",
+    "seriesEditor": "collection-editor",
+    "translator": "translator",
+    "bookAuthor": "container-author",
+    "director": "director",
+    "interviewer": "interviewer",
+    "recipient": "recipient",
+    "reviewedAuthor": "reviewed-author",
+    "composer": "composer",
+    "programmer": "author",
+    "inventor": "author",
+    "presenter": "author",
+    "cartographer": "author",
+    "artist": "author",
+    "performer": "author",
+    "podcaster": "author",
+    "sponsor": "author",
+    "contributor": "contributor",
+}
+
+_CACHE_VERSION = 2
+
+# 一次查询取出字段 (kind=0), 作者 (kind=1) 和 Better BibTeX 引用键 (kind=2), 按条目聚合
+_ITEMS_SQL = """
+WITH live AS (
+    SELECT i.itemID, i.key, i.libraryID, t.typeName
+    FROM items i
+    JOIN itemTypesCombined t ON t.itemTypeID = i.itemTypeID
+    WHERE t.typeName NOT IN ({skipped})
+      AND i.itemID NOT IN (SELECT itemID FROM deletedItems)
+)
+SELECT live.itemID, live.key, live.typeName, 0, f.fieldName, v.value, NULL, NULL, NULL
+FROM live
+JOIN itemData d ON d.itemID = live.itemID
+JOIN fieldsCombined f ON f.fieldID = d.fieldID
+JOIN itemDataValues v ON v.valueID = d.valueID
+UNION ALL
+SELECT live.itemID, live.key, live.typeName, 1, ct.creatorType, c.lastName, c.firstName, c.fieldMode, ic.orderIndex
+FROM live
+JOIN itemCreators ic ON ic.itemID = live.itemID
+JOIN creators c ON c.creatorID = ic.creatorID
+JOIN creatorTypes ct ON ct.creatorTypeID = ic.creatorTypeID
+{bbt}
+ORDER BY 1, 4, 9
+"""
+
+_BBT_SQL = """
+UNION ALL
+SELECT live.itemID, live.key, live.typeName, 2, 'citationKey', b.citationKey, NULL, NULL, NULL
+FROM live
+JOIN bbt.citationkey b ON b.libraryID = live.libraryID AND b.itemKey = live.key
+"""
+
+# 附件条目键 -> 父条目键和附件标题, 附件的存储目录 storage/<附件条目键> 以条目键命名
+_ATTACHMENTS_SQL = """
+SELECT a.key, p.key, v.value
+FROM itemAttachments ia
+JOIN items a ON a.itemID = ia.itemID
+LEFT JOIN items p ON p.itemID = ia.parentItemID
+LEFT JOIN itemData d ON d.itemID = a.itemID AND d.fieldID = (SELECT fieldID FROM fieldsCombined WHERE fieldName = 'title')
+LEFT JOIN itemDataValues v ON v.valueID = d.valueID
+WHERE a.itemID NOT IN (SELECT itemID FROM deletedItems)
+"""
+
+
+class ZoteroError(Exception):
+    """读取 Zotero 数据库失败"""
+
+    pass
+
+
+def _readonly_uri(db_path: str) -> str:
+    # as_uri 会转义中文和空格
+    return Path(db_path).resolve().as_uri() + "?mode=ro&immutable=1"
+
+
+def connect_readonly(db_path: str) -> sqlite3.Connection:
+    """以 immutable 模式只读打开数据库, 不加锁, 不创建 -wal/-shm 文件"""
+    if os.path.isfile(db_path) is False:
+        raise ZoteroError(f"数据库 {db_path} 不存在")
+    try:
+        return sqlite3.connect(_readonly_uri(db_path), uri=True)
+    except sqlite3.Error as e:
+        raise ZoteroError(f"数据库 {db_path} 打开失败: {e}") from e
+
+
+def parse_date(value: str) -> dict | None:
+    """
+    Zotero 日期 "2013-05-00 May 2013" 的前 10 位是 SQL 日期, 未知部分为 00, 转换为 CSL date-parts
+    """
+    parts = []
+    for part in value[:10].split("-"):
+        if not part.isdigit() or int(part) == 0:
+            break
+        parts.append(int(part))
+    if not parts:
+        return {"literal": value} if value else None
+    return {"date-parts": [parts]}
+
+
+def _iter_rows(connection: sqlite3.Connection, with_bbt: bool) -> Iterator[tuple]:
+    skipped = ", ".join(f"'{name}'" for name in SKIPPED_ITEM_TYPES)
+    sql = _ITEMS_SQL.format(skipped=skipped, bbt=_BBT_SQL if with_bbt else "")
+    yield from connection.execute(sql)
+
+
+def query_items(zotero_db: str, bbt_db: str | None = None) -> Dict[str, dict]:
+    """
+    查询所有文献条目
+
+    Args:
+        zotero_db: zotero.sqlite 路径
+        bbt_db: better-bibtex.sqlite 路径, 为 None 或不存在时不使用 Better BibTeX 引用键
+
+    Returns:
+        {引用键: CSL-JSON 条目}, 条目额外包含 "zotero-key" (Zotero 条目键)
+    """
+    connection = connect_readonly(zotero_db)
+    try:
+        with_bbt = bbt_db is not None and os.path.isfile(bbt_db)
+        if with_bbt:
+            connection.execute("ATTACH DATABASE ? AS bbt", (_readonly_uri(bbt_db),))
+
+        records: Dict[int, dict] = {}
+        bbt_keys: Dict[int, str] = {}
+        for item_id, key, type_name, kind, name, value, first_name, field_mode, _ in _iter_rows(connection, with_bbt):
+            record = records.get(item_id)
+            if record is None:
+                record = records[item_id] = {"type": CSL_TYPES.get(type_name, "document"), "zotero-key": key}
+
+            if kind == 0:
+                if name == "citationKey":
+                    record.setdefault("id", value)
+                    continue
+                variable = CSL_FIELDS.get(name)
+                if variable is None or variable in record:
+                    continue
+                record[variable] = parse_date(value) if variable in ("issued", "accessed") else value
+            elif kind == 1:
+                variable = CSL_CREATORS.get(name)
+                if variable is None:
+                    continue
+                # fieldMode 为 1 时是单字段姓名, 例如机构名和中文姓名
+                if field_mode == 1 or not first_name:
+                    person = {"literal": value}
+                else:
+                    person = {"family": value, "given": first_name}
+                record.setdefault(variable, []).append(person)
+            else:
+                bbt_keys[item_id] = value
+    except sqlite3.Error as e:
+        raise ZoteroError(f"数据库 {zotero_db} 查询失败: {e}") from e
+    finally:
+        connection.close()
+
+    items: Dict[str, dict] = {}
+    for item_id, record in records.items():
+        citekey = bbt_keys.get(item_id) or record.get("id") or record["zotero-key"]
+        record["id"] = citekey
+        items.setdefault(citekey, record)  # 引用键重复时保留先添加的条目
+    return items
+
+
+def query_attachments(zotero_db: str) -> Dict[str, Tuple[str | None, str]]:
+    """
+    查询所有附件
+
+    Returns:
+        {附件条目键: (父条目键, 附件标题)}, 独立附件的父条目键为 None
+    """
+    connection = connect_readonly(zotero_db)
+    try:
+        return {key: (parent_key, title or "") for key, parent_key, title in connection.execute(_ATTACHMENTS_SQL)}
+    except sqlite3.Error as e:
+        raise ZoteroError(f"数据库 {zotero_db} 查询失败: {e}") from e
+    finally:
+        connection.close()
+
+
+class ItemStore(Mapping):
+    """
+    {引用键: 条目}, 每个条目单独序列化, 第一次访问时才反序列化
+
+    编译只用到被引用的少数条目, 数万条目的文献库读取缓存只需反序列化一个 {引用键: bytes} 字典.
+    """
+
+    def __init__(self, blobs: Dict[str, bytes], items: Dict[str, dict] | None = None) -> None:
+        self._blobs = blobs
+        self._items = items or {}
+
+    @classmethod
+    def from_items(cls, items: Dict[str, dict]) -> "ItemStore":
+        blobs = {citekey: pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL) for citekey, item in items.items()}
+        return cls(blobs, dict(items))
+
+    def __getitem__(self, citekey: str) -> dict:
+        item = self._items.get(citekey)
+        if item is None:
+            item = self._items[citekey] = pickle.loads(self._blobs[citekey])
+        return item
+
+    def __contains__(self, citekey: object) -> bool:
+        return citekey in self._blobs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._blobs)
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+
+class ZoteroLibrary:
+    """
+    按数据库文件哈希缓存的文献库
+
+    缓存目录中保存:
+        zotero_items.pickle     {"version": ..., "digest": ..., "blobs": {引用键: 序列化的条目}}
+        zotero_manifest.json    数据库文件的哈希清单, stat 信息不变时不重新计算哈希
+    """
+
+    def __init__(self, zotero_db: str, bbt_db: str | None = None, cache_dir: str | None = None) -> None:
+        """
+        zotero_db: zotero.sqlite 路径
+        bbt_db: better-bibtex.sqlite 路径, 为 None 时使用 zotero_db 同目录下的 better-bibtex.sqlite
+        cache_dir: 缓存目录, 为 None 时不缓存
+        """
+        self.zotero_db = zotero_db
+        self.bbt_db = bbt_db or os.path.join(os.path.dirname(zotero_db), "better-bibtex.sqlite")
+        self.cache_dir = cache_dir
+        self.items: ItemStore = ItemStore({})
+        self.digest: str | None = None
+        self.from_cache = False
+
+    def _digest(self, manifest: FileHashManifest) -> str:
+        digests = []
+        for db_path in (self.zotero_db, self.bbt_db):
+            if os.path.isfile(db_path) is False:
+                digests.append("")
+                continue
+            stat = os.stat(db_path)
+            digest = manifest.lookup(db_path, stat)
+            if digest is None:
+                digest = calculate_file_hash_code(db_path)
+                manifest.update(db_path, digest, stat)
+            digests.append(digest)
+        return ":".join(digests)
+
+    def load(self) -> ItemStore:
+        """
+        读取文献库, 数据库没有变化时使用缓存
+
+        Returns:
+            {引用键: CSL-JSON 条目}
+        """
+        if os.path.isfile(self.zotero_db) is False:
+            raise ZoteroError(f"数据库 {self.zotero_db} 不存在")
+
+        manifest_path = os.path.join(self.cache_dir, "zotero_manifest.json") if self.cache_dir else None
+        cache_path = os.path.join(self.cache_dir, "zotero_items.pickle") if self.cache_dir else None
+        manifest = FileHashManifest(manifest_path)
+        self.digest = self._digest(manifest)
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as file:
+                    data = pickle.load(file)
+                if data["version"] == _CACHE_VERSION and data["digest"] == self.digest:
+                    self.items = ItemStore(data["blobs"])
+                    self.from_cache = True
+                    manifest.save()
+                    return self.items
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+                pass  # 缓存损坏时重新查询
+
+        self.items = ItemStore.from_items(query_items(self.zotero_db, self.bbt_db))
+        self.from_cache = False
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = cache_path + ".tmp"
+            with open(temp_path, "wb") as file:
+                pickle.dump(
+                    {"version": _CACHE_VERSION, "digest": self.digest, "blobs": self.items._blobs},
+                    file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_path, cache_path)
+            manifest.save()
+        return self.items
+
+
+if __name__ == "__main__":
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="列出 Zotero 文献库中的条目和引用键")
+    arg_parser.add_argument("query", nargs="?", default="", help="按引用键和标题过滤")
+    arg_parser.add_argument("--db", default=os.path.join(root_dir, "zotero", "zotero.sqlite"), help="zotero.sqlite 路径")
+    arg_parser.add_argument("--bbt", help="better-bibtex.sqlite 路径, 默认与 zotero.sqlite 同目录")
+    arg_parser.add_argument("--cache", default=os.path.join(root_dir, ".cache", "zotero"), help="缓存目录")
+    args = arg_parser.parse_args()
+
+    start_time = time.perf_counter()
+    library = ZoteroLibrary(args.db, args.bbt, args.cache)
+    try:
+        items = library.load()
+    except ZoteroError as e:
+        print(e)
+        sys.exit(1)
+    elapsed = time.perf_counter() - start_time
+
+    for citekey, item in sorted(items.items()):
+        if args.query in citekey or args.query in item.get("title", ""):
+            print(f"{citekey}: {item.get('title', '')}")
+    source = "缓存" if library.from_cache else "数据库"
+    print(f"共 {len(items)} 个条目, 读取{source}耗时 {elapsed * 1000:.1f} ms")
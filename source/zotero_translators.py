@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+文件名称: zotero_translators.py
+文件作者: gaosiyan
+创建时间: 20260122
+功能说明: Zotero 转换器 (zotero/translators/*.js) 元数据索引, 按网址查找可用的网页转换器
+
+每个转换器文件开头是一段 JSON 头, 包含 target (网址正则), priority, translatorType 等, 后面是上千行的代码.
+索引只逐行读取到 JSON 头结束, 不读取代码; 头信息按文件 mtime 和大小缓存在一个索引文件中,
+文件没有变化时直接使用缓存, 只有新增和修改的文件重新读取.
+
+按网址匹配时不逐个执行 700 多个正则: 读取时从每个 target 中取出一定出现的最长字面串 (通常是域名),
+按字面串的前 4 个字符建立索引, 对网址扫描一遍得到出现在其中的字面串, 只对这些转换器和没有字面串的
+通用转换器执行完整的 target. target 在第一次用到时才编译, 按 Zotero 的规则不区分大小写.
+结果按 priority 从小到大排序 (数值小的优先).
+
+translatorType 是位掩码: 1 导入, 2 导出, 4 网页, 8 检索.
+
+用法:
+    python source/zotero_translators.py https://www.jstor.org/stable/123456
+    python source/zotero_translators.py --rebuild
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import Dict, List
+
+TYPE_IMPORT = 1
+TYPE_EXPORT = 2
+TYPE_WEB = 4
+TYPE_SEARCH = 8
+
+_INDEX_VERSION = 1
+
+# 索引中保存的头字段
+_HEADER_FIELDS = ("translatorID", "label", "creator", "target", "priority", "translatorType", "lastUpdated")
+
+# 字面串短于这个长度时 (例如 "://") 不足以筛选, 转换器按通用处理; 也是字面串索引键的长度
+MIN_LITERAL_LENGTH = 4
+
+# 正则中的元字符
+_META_CHARS = set(".^$*+?{}[]()|")
+
+# 转义后仍表示单个字符的转义序列, 其余 (\d, \w, \b 等) 不是字面字符
+_LITERAL_ESCAPES = set("./-:?=&#%~_+*()[]{}|^$\\ ")
+
+
+class TranslatorError(Exception):
+    """转换器文件或索引读取失败"""
+
+    pass
+
+
+def read_header(path: str) -> dict:
+    """
+    读取转换器的 JSON 头, 读到头结束的 "}" 行为止, 不读取后面的代码
+
+    Args:
+        path: .js 文件路径
+
+    Returns:
+        头信息
+    """
+    lines = []
+    try:
+        with open(path, "r", encoding="utf-8-sig") as file:
+            for line in file:
+                lines.append(line)
+                if line.rstrip() == "}":
+                    break
+    except (OSError, UnicodeDecodeError) as e:
+        raise TranslatorError(f"转换器 {path} 读取失败: {e}") from e
+
+    try:
+        header = json.loads("".join(lines))
+    except json.JSONDecodeError as e:
+        raise TranslatorError(f"转换器 {path} 的 JSON 头解析失败: {e}") from e
+    if not isinstance(header, dict) or "translatorID" not in header:
+        raise TranslatorError(f"转换器 {path} 没有 translatorID")
+    return header
+
+
+def required_literal(pattern: str) -> str:
+    """
+    target 正则中一定出现的最长字面串 (小写)
+
+    只看最外层: 括号, 字符集中的内容和带量词的字符都可能不出现, 会打断字面串;
+    最外层有 "|" 时没有一定出现的字面串.
+    """
+    runs = []
+    current = []
+    depth = 0
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        literal = None
+        if char == "\\" and index + 1 < length:
+            escaped = pattern[index + 1]
+            index += 2
+            if depth == 0 and escaped in _LITERAL_ESCAPES:
+                literal = escaped
+        elif char == "[":
+            # 跳过字符集, 字符集内的 "]" 和转义不结束字符集
+            index += 1
+            if index < length and pattern[index] == "^":
+                index += 1
+            if index < length and pattern[index] == "]":
+                index += 1
+            while index < length and pattern[index] != "]":
+                index += 2 if pattern[index] == "\\" else 1
+            index += 1
+        elif char == "(":
+            depth += 1
+            index += 1
+        elif char == ")":
+            depth -= 1
+            index += 1
+        elif char == "|" and depth == 0:
+            return ""
+        else:
+            index += 1
+            if depth == 0 and char not in _META_CHARS:
+                literal = char
+
+        if literal is not None and index < length and pattern[index] in "?*{":
+            literal = None  # 可以出现零次
+        if literal is not None:
+            current.append(literal)
+        else:
+            if current:
+                runs.append("".join(current))
+            current = []
+    if current:
+        runs.append("".join(current))
+    return max(runs, key=len, default="").lower()
+
+
+class TranslatorRegistry:
+    """
+    转换器元数据索引
+
+    索引文件 (JSON):
+        {"version": ..., "files": {文件名: {"mtime_ns": ..., "size": ..., "header": {...}}}}
+    """
+
+    def __init__(self, translators_dir: str, index_path: str | None = None) -> None:
+        """
+        translators_dir: 转换器目录
+        index_path: 索引文件路径, 为 None 时不缓存
+        """
+        self.translators_dir = translators_dir
+        self.index_path = index_path
+        self.translators: List[dict] = []
+        self.errors: Dict[str, str] = {}  # {文件名: 错误}
+        self.reread = 0  # 本次重新读取头的文件数
+        self._by_literal: Dict[str, List[int]] = {}  # {字面串: [转换器下标]}
+        self._by_prefix: Dict[str, List[str]] = {}  # {字面串的前 4 个字符: [字面串]}
+        self._generic: List[int] = []
+        self._targets: Dict[int, re.Pattern | None] = {}  # 已编译的 target
+
+    def _read_index(self) -> Dict[str, dict]:
+        if self.index_path is None or os.path.isfile(self.index_path) is False:
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return {}  # 索引损坏时重新读取全部文件
+        if not isinstance(data, dict) or data.get("version") != _INDEX_VERSION:
+            return {}
+        return data.get("files", {})
+
+    def _write_index(self, entries: Dict[str, dict]) -> None:
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"version": _INDEX_VERSION, "files": entries}, file, ensure_ascii=False)
+        os.replace(temp_path, self.index_path)
+
+    def load(self, rebuild: bool = False) -> "TranslatorRegistry":
+        """
+        读取所有转换器的头, mtime 和大小没有变化的文件使用索引中的缓存
+
+        Args:
+            rebuild: 为 True 时忽略索引, 重新读取全部文件
+        """
+        if os.path.isdir(self.translators_dir) is False:
+            raise TranslatorError(f"转换器目录 {self.translators_dir} 不存在")
+
+        cached = {} if rebuild else self._read_index()
+        entries: Dict[str, dict] = {}
+        self.errors = {}
+        self.reread = 0
+        with os.scandir(self.translators_dir) as iterator:
+            files = [entry for entry in iterator if entry.name.endswith(".js") and entry.is_file()]
+        files.sort(key=lambda entry: entry.name)
+        for entry in files:
+            stat = entry.stat()
+            previous = cached.get(entry.name)
+            if previous is not None and previous["mtime_ns"] == stat.st_mtime_ns and previous["size"] == stat.st_size:
+                entries[entry.name] = previous
+                continue
+            try:
+                header = read_header(entry.path)
+            except TranslatorError as e:
+                self.errors[entry.name] = str(e)
+                continue
+            self.reread += 1
+            entries[entry.name] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "header": {field: header.get(field) for field in _HEADER_FIELDS},
+            }
+
+        # 有文件新增, 修改或删除时写回索引
+        if self.index_path is not None and (self.reread or entries.keys() != cached.keys()):
+            self._write_index(entries)
+
+        self.translators = [{"file": name, **entry["header"]} for name, entry in entries.items()]
+        self._compile()
+        return self
+
+    def _compile(self) -> None:
+        """建立网页转换器的字面串索引"""
+        self._by_literal = {}
+        self._by_prefix = {}
+        self._generic = []
+        self._targets = {}
+        for index, translator in enumerate(self.translators):
+            target = translator.get("target")
+            if not (translator.get("translatorType") or 0) & TYPE_WEB or not target:
+                continue
+            literal = required_literal(target)
+            if len(literal) < MIN_LITERAL_LENGTH:
+                self._generic.append(index)
+                continue
+            if literal not in self._by_literal:
+                self._by_literal[literal] = []
+                self._by_prefix.setdefault(literal[:MIN_LITERAL_LENGTH], []).append(literal)
+            self._by_literal[literal].append(index)
+
+    def _target(self, index: int) -> re.Pattern | None:
+        if index not in self._targets:
+            translator = self.translators[index]
+            try:
+                self._targets[index] = re.compile(translator["target"], re.IGNORECASE)
+            except re.error as e:
+                self.errors[translator["file"]] = f"target 正则无效: {e}"
+                self._targets[index] = None
+        return self._targets[index]
+
+    def candidates(self, url: str) -> List[int]:
+        """字面串出现在网址中的转换器和通用转换器的下标, 对网址只扫描一遍, 取出所有 4 个字符的片段在索引中查找"""
+        lowered = url.lower()
+        length = MIN_LITERAL_LENGTH
+        grams = {lowered[position : position + length] for position in range(len(lowered) - length + 1)}
+        indexes = list(self._generic)
+        for gram in grams.intersection(self._by_prefix):
+            for literal in self._by_prefix[gram]:
+                if literal in lowered:
+                    indexes.extend(self._by_literal[literal])
+        return indexes
+
+    def match(self, url: str) -> List[dict]:
+        """
+        可以处理该网址的网页转换器
+
+        Returns:
+            按 priority 从小到大排序的转换器头信息
+        """
+        result = []
+        for index in self.candidates(url):
+            target = self._target(index)
+            if target is not None and target.search(url):
+                result.append(self.translators[index])
+        result.sort(key=lambda translator: (translator.get("priority") or 0, translator.get("label") or ""))
+        return result
+
+    def by_type(self, translator_type: int) -> List[dict]:
+        """指定类型的转换器, 例如 TYPE_IMPORT"""
+        return [
+            translator for translator in self.translators if (translator.get("translatorType") or 0) & translator_type
+        ]
+
+
+if __name__ == "__main__":
+    root_dir = Path(__file__).resolve().parent.parent
+    arg_parser = argparse.ArgumentParser(description="按网址查找 Zotero 网页转换器")
+    arg_parser.add_argument("urls", nargs="*", help="网址")
+    arg_parser.add_argument("--rebuild", action="store_true", help="忽略索引, 重新读取全部转换器")
+    arg_parser.add_argument("--dir", default=os.path.join(root_dir, "zotero", "translators"), help="转换器目录")
+    arg_parser.add_argument(
+        "--index", default=os.path.join(root_dir, ".cache", "zotero", "translators.json"), help="索引文件"
+    )
+    args = arg_parser.parse_args()
+
+    try:
+        start_time = time.perf_counter()
+        registry = TranslatorRegistry(args.dir, args.index).load(args.rebuild)
+        load_elapsed = time.perf_counter() - start_time
+    except TranslatorError as e:
+        print(e)
+        sys.exit(1)
+
+    for file_name, error in registry.errors.items():
+        print(f"跳过 {file_name}: {error}")
+    print(
+        f"读取 {len(registry.translators)} 个转换器 (重新读取 {registry.reread} 个), "
+        f"网页转换器 {len(registry.by_type(TYPE_WEB))} 个, "
+        f"耗时 {load_elapsed * 1000:.1f} ms"
+    )
+
+    for url in args.urls:
+        start_time = time.perf_counter()
+        matched = registry.match(url)
+        match_elapsed = time.perf_counter() - start_time
+        print(f"{url} ({match_elapsed * 1000:.2f} ms):")
+        for translator in matched:
+            print(f"    {translator['priority']:>4}  {translator['label']}  ({translator['file']})")
+        if not matched:
+            print("    没有可用的转换器")
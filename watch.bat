@@ -0,0 +1,12 @@
+@echo off
+
+:: ǰĿ¼ѹջлǰűڵĿ¼
+pushd %~dp0
+
+call setup-env.bat
+set path=%pixi_home%;%python_home%;%python_home%\Library\mingw-w64\bin;%python_home%\Library\usr\bin;%python_home%\Library\bin;%python_home%\Scripts;%python_home%\bin;%vscode_home%;%path%
+
+:: פ source Ŀ¼, Զʽ, 벢ˢ, Ctrl+C ˳
+python source/sphinx_watch.py --open
+
+popd